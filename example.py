@@ -2,7 +2,7 @@ from time import time, sleep
 from mbench import profiling, profileme, profile
 from mbench.test_module import some_function
 
-profileme(mode="callee")
+profileme(when="called")
 
 def another_function():
     """
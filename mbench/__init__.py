@@ -2,18 +2,33 @@
 #
 # SPDX-License-Identifier: apache-2.0
 
-from typing import Literal
+from __future__ import annotations
 
-from funkify import funkify
+import sys
+from types import ModuleType
 
+from .bench import bench
 from .profile import main, profile, profileme, profiling
 
-__all__ = ["profileme", "profiling", "profile", "mbench"]
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Literal
+
+__all__ = ["profileme", "profiling", "profile", "bench", "mbench"]
 
-@funkify
 def mbench(when: Literal["calling", "called"] = "calling") -> None:
     """Profile the code"""
     return profileme(when)
 
+
+class _CallableModule(ModuleType):
+    """`import mbench; mbench()` calls `mbench.mbench`."""
+
+    def __call__(self, *args, **kwargs):
+        return mbench(*args, **kwargs)
+
+
+sys.modules[__name__].__class__ = _CallableModule
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,194 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import asyncio
+import contextvars
+import dis
+import inspect
+import time
+import types
+import weakref
+
+from mbench.histogram import record_latency
+
+CO_COROUTINE = inspect.CO_COROUTINE
+YIELD_VALUE = dis.opmap["YIELD_VALUE"]
+LOOP_LAG_KEY = "asyncio.loop_lag"
+
+_task_record = contextvars.ContextVar("mbench_task_record", default=None)
+
+
+class TaskRecord:
+    """Time an asyncio Task has spent running on the event loop, in `perf_counter_ns` nanoseconds.
+
+    Each Task steps its coroutine inside its own context, so the record stored in a
+    ContextVar follows the Task across awaits without any bookkeeping by task id.
+    """
+
+    __slots__ = ("on_cpu", "resumed_at", "steps")
+
+    def __init__(self):
+        self.on_cpu = 0
+        self.resumed_at = None
+        self.steps = 0
+
+    def running_time(self, now=None):
+        """On-CPU ns so far, including the step currently running."""
+        if self.resumed_at is None:
+            return self.on_cpu
+        return self.on_cpu + ((now or time.perf_counter_ns()) - self.resumed_at)
+
+
+def current_task_record():
+    """TaskRecord of the running Task, or None outside of a profiled Task."""
+    return _task_record.get()
+
+
+def ensure_task_record():
+    """TaskRecord of the running Task, created as "running now" if the tracker has not seen it yet."""
+    record = _task_record.get()
+    if record is None:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            return None
+        if task is None:
+            return None
+        record = TaskRecord()
+        record.resumed_at = time.perf_counter_ns()
+        _task_record.set(record)
+    return record
+
+
+@types.coroutine
+def stepped(coro, usage, cpu_clock=time.thread_time_ns):
+    """Await `coro`, adding the wall and `cpu_clock` ns of every step it runs to usage[0] and usage[1].
+
+    The time `coro` spends suspended between steps is not counted, so the rest of its
+    duration is the time it awaited. Used by `FunctionProfiler.wrap`, which needs no hook.
+    """
+    value, error = None, None
+    try:
+        while True:
+            start = time.perf_counter_ns()
+            cpu_start = cpu_clock()
+            try:
+                yielded = coro.send(value) if error is None else coro.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                usage[0] += time.perf_counter_ns() - start
+                usage[1] += cpu_clock() - cpu_start
+            try:
+                value, error = (yield yielded), None
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                value, error = None, e
+    finally:
+        coro.close()
+
+
+class AsyncTracker:
+    """Turn the call/return events of a coroutine's resumes into one call per coroutine.
+
+    Every resume of a coroutine is a "call" event and every suspension a "return" whose
+    frame stopped on ``YIELD_VALUE``. The tracker adds up the running slices as on-CPU
+    time and reports the rest of the coroutine's lifetime as awaited. It also measures
+    event-loop lag by checking how late a timer callback fires.
+    """
+
+    def __init__(self, profiler, lag_interval=0.1):
+        self.profiler = profiler
+        self.lag_interval = lag_interval
+        self.max_lag = 0.0
+        # frame -> [profile key or None, start, on-CPU time, resumed at], all in ns.
+        self._frames = {}
+        self._yield_offsets = {}
+        self._loops = weakref.WeakSet()
+
+    def _key(self, frame):
+        profiler = self.profiler
+        # Coroutines decorated with @profile are timed by their wrapper.
+        if id(frame.f_code) in profiler._wrapped or not profiler._is_target(frame):
+            return None
+        return profiler._get_qual_name(frame)
+
+    def _suspended(self, frame):
+        code = frame.f_code
+        cached = self._yield_offsets.get(id(code))
+        if cached is None:
+            raw = code.co_code
+            offsets = frozenset(i for i in range(0, len(raw), 2) if raw[i] == YIELD_VALUE)
+            # Keep the code object alive so its id cannot be reused.
+            cached = self._yield_offsets[id(code)] = (code, offsets)
+        return frame.f_lasti in cached[1]
+
+    def on_call(self, frame):
+        now = time.perf_counter_ns()
+        back = frame.f_back
+        if back is None or not back.f_code.co_flags & CO_COROUTINE:
+            # The Task is stepping its own coroutine.
+            record = _task_record.get()
+            if record is None:
+                record = TaskRecord()
+                _task_record.set(record)
+                self._watch_loop()
+            record.resumed_at = now
+            record.steps += 1
+        state = self._frames.get(frame)
+        if state is None:
+            self._frames[frame] = [self._key(frame), now, 0, now]
+        else:
+            state[3] = now
+        return self.profiler.profile
+
+    def on_return(self, frame):
+        now = time.perf_counter_ns()
+        back = frame.f_back
+        if back is None or not back.f_code.co_flags & CO_COROUTINE:
+            record = _task_record.get()
+            if record is not None and record.resumed_at is not None:
+                record.on_cpu += now - record.resumed_at
+                record.resumed_at = None
+        state = self._frames.get(frame)
+        if state is None:
+            return
+        state[2] += now - state[3]
+        if self._suspended(frame):
+            return
+        del self._frames[frame]
+        key, start, on_cpu, _ = state
+        if key is None:
+            return
+        duration = (now - start) / 1e9
+        on_cpu = on_cpu / 1e9
+        data = self.profiler._profile_entry(key)
+        data["calls"] += 1
+        data["total_time"] += duration
+        data["total_self_time"] += duration
+        data["total_cpu"] += on_cpu
+        data["total_awaited"] += duration - on_cpu
+        record_latency(data, duration, on_cpu)
+
+    def _watch_loop(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if loop in self._loops:
+            return
+        self._loops.add(loop)
+        loop.call_later(self.lag_interval, self._probe, loop, loop.time() + self.lag_interval)
+
+    def _probe(self, loop, expected):
+        lag = max(0.0, loop.time() - expected)
+        self.max_lag = max(self.max_lag, lag)
+        data = self.profiler._profile_entry(LOOP_LAG_KEY)
+        data["calls"] += 1
+        data["total_time"] += lag
+        data["notes"] = f"event loop callback delay, max {self.max_lag * 1000:.2f} ms"
+        if not loop.is_closed():
+            loop.call_later(self.lag_interval, self._probe, loop, loop.time() + self.lag_interval)
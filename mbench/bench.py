@@ -0,0 +1,290 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import importlib
+import math
+import sys
+import time
+
+from mbench.histogram import Histogram
+
+# Two-sided 95% Student t critical values by degrees of freedom; 1.96 past the table.
+_T95 = (
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+)
+
+# Functions decorated with @bench, in definition order.
+BENCHMARKS = []
+
+
+def bench(func=None, *, name=None, warmup=1, repeat=5, processes=0, min_time=0.1, loops=None, cpu=None, args=(), kwargs=None):
+    """Mark `func` as a benchmark for `mbench bench` and `run_all`. The function itself is returned unchanged.
+
+    Each repetition calls the function `loops` times in a row (calibrated so a repetition
+    takes at least `min_time` seconds unless given). `warmup` repetitions run first and are
+    discarded. With `processes`, every process runs `warmup` + `repeat` repetitions in a fresh
+    interpreter, one process at a time. `cpu` pins the measuring process to those CPU ids.
+    """
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, got {repeat}")
+
+    def decorate(func):
+        func.__mbench_bench__ = {
+            "name": name or f"{func.__module__}.{func.__qualname__}",
+            "warmup": warmup,
+            "repeat": repeat,
+            "processes": processes,
+            "min_time": min_time,
+            "loops": loops,
+            "cpu": cpu,
+            "args": args,
+            "kwargs": kwargs or {},
+        }
+        BENCHMARKS.append(func)
+        return func
+
+    return decorate if func is None else decorate(func)
+
+
+class BenchResult:
+    """Per-call times of every measured repetition of one benchmark."""
+
+    def __init__(self, name, loops, values, cpu_values, processes=0):
+        self.name = name
+        self.loops = loops
+        self.values = values
+        self.cpu_values = cpu_values
+        self.processes = processes
+
+    @property
+    def mean(self):
+        import statistics
+
+        return statistics.fmean(self.values)
+
+    @property
+    def stdev(self):
+        import statistics
+
+        return statistics.stdev(self.values) if len(self.values) > 1 else 0.0
+
+    @property
+    def min(self):
+        return min(self.values)
+
+    @property
+    def max(self):
+        return max(self.values)
+
+    def confidence_interval(self):
+        """95% confidence interval of the mean per-call time."""
+        n = len(self.values)
+        if n < 2:
+            return self.mean, self.mean
+        t = _T95[n - 2] if n - 2 < len(_T95) else 1.96
+        half = t * self.stdev / math.sqrt(n)
+        return self.mean - half, self.mean + half
+
+    def summary(self):
+        low, high = self.confidence_interval()
+        runs = f"{len(self.values)} runs x {self.loops} loops"
+        if self.processes:
+            runs += f" in {self.processes} processes"
+        return (
+            f"mean {self.mean:.9f} s +- {self.stdev:.9f} (min {self.min:.9f}, max {self.max:.9f}),"
+            f" 95% CI [{low:.9f}, {high:.9f}], {runs}"
+        )
+
+    def to_profile(self):
+        """The result as a profile dict, so it can be shown and saved like profiled functions."""
+        time_histogram = Histogram()
+        cpu_histogram = Histogram()
+        for value, cpu in zip(self.values, self.cpu_values, strict=True):
+            time_histogram.record(value)
+            cpu_histogram.record(cpu)
+        total_time = math.fsum(self.values) * self.loops
+        return {
+            "calls": len(self.values) * self.loops,
+            "total_time": total_time,
+            "total_self_time": total_time,
+            "total_cpu": math.fsum(self.cpu_values) * self.loops,
+            "total_memory": 0,
+            "total_alloc": 0,
+            "total_awaited": 0,
+            "peak_alloc": 0,
+            "top_allocations": [],
+            "time_histogram": time_histogram,
+            "cpu_histogram": cpu_histogram,
+            "total_gpu": 0,
+            "total_io": 0,
+            "notes": self.summary(),
+            "total_gpus": [],
+        }
+
+
+def _time_loops(func, loops, args, kwargs):
+    """Per-call wall and thread CPU time in seconds of `loops` back-to-back calls."""
+    cpu_start = time.thread_time_ns()
+    start = time.perf_counter_ns()
+    for _ in range(loops):
+        func(*args, **kwargs)
+    end = time.perf_counter_ns()
+    cpu_end = time.thread_time_ns()
+    return (end - start) / loops / 1e9, (cpu_end - cpu_start) / loops / 1e9
+
+
+def calibrate(func, min_time=0.1, args=(), kwargs=None):
+    """Smallest power-of-two loop count whose repetition takes at least `min_time` seconds."""
+    kwargs = kwargs or {}
+    loops = 1
+    while True:
+        per_call, _ = _time_loops(func, loops, args, kwargs)
+        if per_call * loops >= min_time or loops >= 1 << 30:
+            return loops
+        loops *= 2
+
+
+def _pin(cpu):
+    if cpu is None:
+        return None
+    import psutil
+
+    process = psutil.Process()
+    try:
+        previous = process.cpu_affinity()
+        process.cpu_affinity(list(cpu))
+    except (AttributeError, psutil.Error):
+        # macOS has no CPU affinity.
+        return None
+    return previous
+
+
+def _measure(func, loops, warmup, repeat, cpu, args, kwargs):
+    previous = _pin(cpu)
+    try:
+        for _ in range(warmup):
+            _time_loops(func, loops, args, kwargs)
+        results = [_time_loops(func, loops, args, kwargs) for _ in range(repeat)]
+    finally:
+        if previous is not None:
+            import psutil
+
+            psutil.Process().cpu_affinity(previous)
+    return [value for value, _ in results], [cpu_value for _, cpu_value in results]
+
+
+def run_benchmark(func, name=None, warmup=1, repeat=5, processes=0, min_time=0.1, loops=None, cpu=None, args=(), kwargs=None):
+    """Measure `func` and return a BenchResult. See `bench` for the options."""
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, got {repeat}")
+    kwargs = kwargs or {}
+    name = name or f"{func.__module__}.{func.__qualname__}"
+    if loops is None:
+        loops = calibrate(func, min_time, args, kwargs)
+    if not processes:
+        values, cpu_values = _measure(func, loops, warmup, repeat, cpu, args, kwargs)
+        return BenchResult(name, loops, values, cpu_values)
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    values, cpu_values = [], []
+    context = multiprocessing.get_context("spawn")
+    for _ in range(processes):
+        # A fresh interpreter per process, run one at a time so they do not compete for CPUs.
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            process_values, process_cpu = pool.submit(_measure, func, loops, warmup, repeat, cpu, args, kwargs).result()
+        values += process_values
+        cpu_values += process_cpu
+    return BenchResult(name, loops, values, cpu_values, processes=processes)
+
+
+def report(results, csv_file=None):
+    """Show results with the profile tables and optionally save them in the mbench CSV format."""
+    from mbench.profile import display_profile_info, flush, write_csv
+
+    profiles = {result.name: result.to_profile() for result in results}
+    for name, data in profiles.items():
+        calls = data["calls"]
+        display_profile_info(
+            name=name,
+            duration=data["total_time"],
+            cpu_usage=data["total_cpu"],
+            mem_usage="n/a",
+            gpu_usage="n/a",
+            io_usage="n/a",
+            avg_time=data["total_time"] / calls,
+            avg_cpu=data["total_cpu"] / calls,
+            avg_memory="n/a",
+            avg_gpu="n/a",
+            avg_io="n/a",
+            calls=calls,
+            notes=data["notes"],
+            time_histogram=data["time_histogram"],
+        )
+    if csv_file:
+        write_csv(csv_file, profiles)
+    flush()
+    return profiles
+
+
+def run_all(functions=None, csv_file=None, **overrides):
+    """Run every @bench function (or the given ones) and report them. Options in `overrides` win."""
+    results = []
+    for func in functions if functions is not None else BENCHMARKS:
+        options = {**func.__mbench_bench__, **{key: value for key, value in overrides.items() if value is not None}}
+        results.append(run_benchmark(func, **options))
+    report(results, csv_file)
+    return results
+
+
+def _load(target):
+    """Import a module given as a dotted name or a .py path, with an optional ":function" suffix."""
+    target, _, function = target.partition(":")
+    if target.endswith(".py"):
+        from pathlib import Path
+
+        path = Path(target).resolve()
+        # Importable by name, so spawned benchmark processes can import it too.
+        sys.path.insert(0, str(path.parent))
+        target = path.stem
+    module = importlib.import_module(target)
+    if function:
+        func = getattr(module, function)
+        if not hasattr(func, "__mbench_bench__"):
+            func = bench(func)
+        return [func]
+    return [func for func in BENCHMARKS if func.__module__ == module.__name__]
+
+
+def main(argv=None):
+    """`mbench bench`: run @bench functions with calibrated loops, warmup and repetitions."""
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(prog="mbench bench", description=main.__doc__)
+    parser.add_argument("target", help="module or file.py, optionally with :function")
+    parser.add_argument("--repeat", type=int, help="measured repetitions per process")
+    parser.add_argument("--warmup", type=int, help="discarded repetitions per process")
+    parser.add_argument("--processes", type=int, help="run in this many fresh processes")
+    parser.add_argument("--loops", type=int, help="calls per repetition (calibrated by default)")
+    parser.add_argument("--min-time", type=float, help="minimum seconds per repetition when calibrating")
+    parser.add_argument("--cpu", help="comma-separated CPU ids to pin the measuring process to")
+    parser.add_argument("--csv", default="mbench_bench.csv", help="CSV file for the results")
+    args = parser.parse_args(argv)
+    functions = _load(args.target)
+    if not functions:
+        parser.error(f"no @bench functions found in {args.target}")
+    cpu = [int(cpu_id) for cpu_id in args.cpu.split(",")] if args.cpu else None
+    return run_all(
+        functions,
+        csv_file=args.csv,
+        repeat=args.repeat,
+        warmup=args.warmup,
+        processes=args.processes,
+        loops=args.loops,
+        min_time=args.min_time,
+        cpu=cpu,
+    )
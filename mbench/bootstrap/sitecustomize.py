@@ -0,0 +1,38 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+"""Put on PYTHONPATH by `mbench` so every Python process it starts profiles itself."""
+
+import importlib
+import os
+import sys
+
+
+def _chain():
+    """Run the sitecustomize this one shadows, if there is one."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    module = sys.modules.pop("sitecustomize", None)
+    saved = sys.path[:]
+    sys.path[:] = [p for p in sys.path if os.path.abspath(p or ".") != here]
+    try:
+        importlib.import_module("sitecustomize")
+    except ImportError:
+        pass
+    finally:
+        sys.path[:] = saved
+        if module is not None:
+            sys.modules["sitecustomize"] = module
+
+
+_chain()
+
+try:
+    from mbench.multiproc import bootstrap
+except ImportError:
+    # Running from a source checkout: mbench lives two directories up.
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from mbench.multiproc import bootstrap
+
+bootstrap()
@@ -0,0 +1,162 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+from array import array
+
+from mbench.__about__ import __version__
+
+ROOT = 0
+
+
+def empty_stack():
+    return {"calls": 0, "total_time": 0, "total_self_time": 0}
+
+
+class CallTree:
+    """Compressed call tree of one thread: one node per distinct stack of profiled functions.
+
+    Node 0 is the root. A call's node is found from its caller's node and its own slot,
+    so recording a call is one dict lookup plus array updates. Recursion gets a deeper
+    node per level, which keeps inclusive time per node exact. Times are nanoseconds.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.parents = array("q", [ROOT])
+        self.slots = array("q", [-1])
+        self.calls = array("q", [0])
+        self.total_time = array("q", [0])
+        self.total_self_time = array("q", [0])
+
+    def __len__(self):
+        return len(self.slots)
+
+    def child(self, parent, slot):
+        """Node of `slot` called from `parent`, created the first time that edge is seen."""
+        node = self.children.get((parent, slot))
+        if node is None:
+            node = self.children[(parent, slot)] = len(self.slots)
+            self.parents.append(parent)
+            self.slots.append(slot)
+            self.calls.append(0)
+            self.total_time.append(0)
+            self.total_self_time.append(0)
+        return node
+
+    def record(self, node, duration, self_time):
+        self.calls[node] += 1
+        self.total_time[node] += duration
+        self.total_self_time[node] += self_time
+
+    def clear(self):
+        """Zero every node, keeping the nodes so calls in flight can still finish."""
+        size = len(self.slots)
+        for column in (self.calls, self.total_time, self.total_self_time):
+            column[:] = array("q", [0]) * size
+
+    def reset_slot(self, slot):
+        """Zero the nodes of one slot."""
+        for node, node_slot in enumerate(self.slots):
+            if node_slot == slot:
+                self.calls[node] = self.total_time[node] = self.total_self_time[node] = 0
+
+    def stacks(self, name):
+        """{stack of function names, outermost first: aggregate} for every node that recorded a call.
+
+        `name` maps a slot to its function name. Times are reported in seconds.
+        """
+        paths = [()]
+        stacks = {}
+        # Parents are always created before their children.
+        for node in range(1, len(self.slots)):
+            path = paths[self.parents[node]] + (name(self.slots[node]),)
+            paths.append(path)
+            if self.calls[node]:
+                add_stack(stacks, path, self.calls[node], self.total_time[node] / 1e9, self.total_self_time[node] / 1e9)
+        return stacks
+
+
+def add_stack(stacks, path, calls, total_time, self_time):
+    data = stacks.get(path)
+    if data is None:
+        data = stacks[path] = empty_stack()
+    data["calls"] += calls
+    data["total_time"] += total_time
+    data["total_self_time"] += self_time
+    return data
+
+
+def merge_stacks(target, stacks):
+    """Add every stack in `stacks` to `target` in place."""
+    for path, data in stacks.items():
+        add_stack(target, tuple(path), data["calls"], data["total_time"], data["total_self_time"])
+    return target
+
+
+def call_graph(stacks):
+    """Caller -> callee edges: {(caller, callee): aggregate} summed over every stack they appear in.
+
+    `total_time` is the callee's inclusive time when called from that caller and
+    `total_self_time` its exclusive time. Calls from the top of a stack have no caller
+    and are keyed with None.
+    """
+    edges = {}
+    for path, data in stacks.items():
+        caller = path[-2] if len(path) > 1 else None
+        add_stack(edges, (caller, path[-1]), data["calls"], data["total_time"], data["total_self_time"])
+    return edges
+
+
+def to_collapsed(stacks):
+    """Brendan Gregg's collapsed-stack text: "outer;inner <self time in microseconds>" per line."""
+    lines = []
+    for path, data in sorted(stacks.items()):
+        weight = round(data["total_self_time"] * 1e6)
+        if weight > 0:
+            lines.append(f"{';'.join(name.replace(';', ':') for name in path)} {weight}\n")
+    return "".join(lines)
+
+
+def to_speedscope(stacks, name="mbench"):
+    """speedscope "sampled" profile: every stack weighted by its self time in seconds."""
+    frames = {}
+    samples = []
+    weights = []
+    for path, data in sorted(stacks.items()):
+        if data["total_self_time"] <= 0:
+            continue
+        samples.append([frames.setdefault(frame, len(frames)) for frame in path])
+        weights.append(data["total_self_time"])
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": f"mbench {__version__}",
+        "activeProfileIndex": 0,
+        "shared": {"frames": [{"name": frame} for frame in frames]},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }
+        ],
+    }
+
+
+def export_stacks(path, stacks, name="mbench"):
+    """Write `stacks` to `path`: speedscope JSON for a .json file, collapsed stacks otherwise."""
+    import json
+    from pathlib import Path
+
+    path = Path(path)
+    if path.suffix == ".json":
+        path.write_text(json.dumps(to_speedscope(stacks, name)))
+    else:
+        path.write_text(to_collapsed(stacks))
+    return path
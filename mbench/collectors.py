@@ -0,0 +1,214 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import time
+
+# name: (collectors that run, or None for every registered one that is not opt-in;
+#        cost in ns above which a collector only runs on 1 in `collect_every` measured calls, or None)
+PROFILES = {
+    "time": ((), None),
+    "fast": (None, 1000),
+    "full": (None, None),
+}
+
+
+class Collector:
+    """One metric measured around every profiled call.
+
+    `start` runs when the call begins and returns a token, `stop` gets the token back
+    when it ends and returns the call's value. `record` adds the value to the thread's
+    `StatsStore`; by default only the outermost call of a recursion is summed into the
+    `field` column, so nested calls are not counted twice. `cost` is roughly what
+    `start` plus `stop` take in nanoseconds, which decides whether the collector runs on
+    every measured call or only on sampled ones. An `opt_in` collector slows down the
+    whole process, not just the calls it measures, so no profile runs it unless it is
+    named, as in "fast,alloc".
+    """
+
+    name = ""
+    field = ""
+    cost = 0
+    opt_in = False
+
+    def start(self):
+        return None
+
+    def stop(self, token):
+        return 0
+
+    def record(self, store, slot, value, outermost):
+        if outermost:
+            store.column(self.field)[slot] += value
+
+
+class CpuCollector(Collector):
+    """Thread CPU time. The profiler reads `clock` itself, next to the wall clock, so the
+    profiler's own overhead can be taken out of it."""
+
+    name = "cpu"
+    field = "total_cpu"
+    cost = 100
+    clock = staticmethod(time.thread_time_ns)
+
+    def start(self):
+        return self.clock()
+
+    def stop(self, token):
+        return self.clock() - token
+
+
+class RssCollector(Collector):
+    """Change in resident set size, read from the background `ResourceSampler`. Keeps its sign."""
+
+    name = "rss"
+    field = "total_memory"
+    cost = 100
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def start(self):
+        return self.sampler.latest().memory
+
+    def stop(self, token):
+        return self.sampler.latest().memory - token
+
+
+class IoCollector(Collector):
+    """Disk bytes read and written, read from the background `ResourceSampler`."""
+
+    name = "io"
+    field = "total_io"
+    cost = 100
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def start(self):
+        return self.sampler.latest().io
+
+    def stop(self, token):
+        return max(0, self.sampler.latest().io - token)
+
+
+class GpuCollector(Collector):
+    """Growth of GPU memory per device, read from the background `ResourceSampler`.
+
+    The value is (total, [per device]); the total goes to `total_gpu` and each device to
+    its own column. Copying and subtracting the device lists on every call costs over
+    1µs, so the "fast" profile only reads GPU memory on sampled calls.
+    """
+
+    name = "gpu"
+    field = "total_gpu"
+    cost = 1200
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def start(self):
+        return self.sampler.latest().gpus
+
+    def stop(self, token):
+        gpus = [max(0, gpu - gpu_start) for gpu, gpu_start in zip(self.sampler.latest().gpus, token, strict=True)]
+        return sum(gpus), gpus
+
+    def record(self, store, slot, value, outermost):
+        if outermost:
+            store.total_gpu[slot] += value[0]
+            for column, gpu in zip(store.total_gpus, value[1], strict=True):
+                column[slot] += gpu
+
+
+class AllocCollector(Collector):
+    """tracemalloc net and peak allocation of a call, see `MemoryCollector`.
+
+    The value is (net, peak). The peak is kept for every call, recursive ones included,
+    and the top allocation sites are looked up when a call at least doubles it. Opt-in:
+    while tracemalloc runs, every allocation in the process is slower.
+    """
+
+    name = "alloc"
+    field = "total_alloc"
+    cost = 3000
+    opt_in = True
+
+    def __init__(self, memory, registry):
+        self.memory = memory
+        self.registry = registry
+
+    def start(self):
+        return self.memory.start()
+
+    def stop(self, token):
+        return self.memory.stop(token)
+
+    def record(self, store, slot, value, outermost):
+        net, peak = value
+        if outermost:
+            store.total_alloc[slot] += net
+        previous_peak = store.peak_alloc[slot]
+        if peak > previous_peak:
+            store.peak_alloc[slot] = peak
+            # Only look up allocation sites when a call at least doubles the function's record.
+            if peak >= self.memory.sites_min_bytes and peak >= 2 * previous_peak:
+                store.top_allocations[slot] = self.memory.top_sites(self.registry.codes[slot])
+
+
+class Plan:
+    """The collectors to run on one call, laid out for the profiler's hot path.
+
+    CPU time is read next to the wall clock and the RSS, I/O and GPU collectors are
+    computed from one shared reading of the `ResourceSampler` at each end of the call,
+    so only the rest (`collectors`) costs a `start`/`stop` call each.
+    """
+
+    __slots__ = ("names", "sample", "memory", "io", "gpu", "collectors")
+
+    def __init__(self, collectors):
+        self.names = [collector.name for collector in collectors]
+        self.memory = any(type(collector) is RssCollector for collector in collectors)
+        self.io = any(type(collector) is IoCollector for collector in collectors)
+        self.gpu = any(type(collector) is GpuCollector for collector in collectors)
+        self.sample = self.memory or self.io or self.gpu
+        fused = (CpuCollector, RssCollector, IoCollector, GpuCollector)
+        self.collectors = [collector for collector in collectors if type(collector) not in fused]
+
+
+def builtin_collectors(sampler, memory, registry):
+    """The collectors every profiler starts with, by name."""
+    collectors = (
+        CpuCollector(),
+        RssCollector(sampler),
+        IoCollector(sampler),
+        GpuCollector(sampler),
+        AllocCollector(memory, registry),
+    )
+    return {collector.name: collector for collector in collectors}
+
+
+def select(collectors, profile):
+    """Split `collectors` for a comma-separated list of profile and collector names, such as "fast,alloc".
+
+    Returns (names of the collectors that run, names of those that only run on sampled calls).
+    """
+    names, budgets = [], []
+    for item in (item.strip() for item in profile.split(",")):
+        if item in PROFILES:
+            members, budget = PROFILES[item]
+            if members is None:
+                members = [name for name, collector in collectors.items() if not collector.opt_in]
+            names.extend(name for name in members if name not in names)
+            if budget is not None:
+                budgets.append(budget)
+        elif item and item not in names:
+            names.append(item)
+    unknown = [name for name in names if name not in collectors]
+    if unknown:
+        msg = f"Unknown collector(s) {', '.join(unknown)}; registered: {', '.join(collectors)}"
+        raise ValueError(msg)
+    budget = min(budgets) if budgets else None
+    sampled = [name for name in names if budget is not None and collectors[name].cost > budget]
+    return names, sampled
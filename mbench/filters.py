@@ -0,0 +1,65 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+FIELDS = ("name", "module", "qualname", "file")
+
+
+def parse_rule(rule):
+    """(field, regex source) of a rule.
+
+    A rule is ``[field:][re:]pattern``. `field` is "name" ("module.qualname", the default),
+    "module", "qualname" or "file"; the pattern is a glob unless it starts with ``re:``,
+    in which case it is a regular expression that has to match from the start.
+    """
+    import fnmatch
+
+    field, sep, rest = rule.partition(":")
+    if not sep or field not in FIELDS:
+        field, rest = "name", rule
+    if rest.startswith("re:"):
+        return field, f"(?:{rest[3:]})"
+    return field, fnmatch.translate(rest)
+
+
+def compile_rules(rules):
+    """{field: one compiled regex matching any of the `rules` on that field}."""
+    import re
+
+    sources = {}
+    for rule in rules:
+        field, source = parse_rule(rule)
+        sources.setdefault(field, []).append(source)
+    return {field: re.compile("|".join(parts)) for field, parts in sources.items()}
+
+
+class CodeFilter:
+    """Include and exclude rules over a function's module, qualified name and file.
+
+    A function is profiled when it matches an include rule, or there are none, and no
+    exclude rule. All rules on one field are compiled into a single regex, and the answer
+    is cached by ``id(code)`` (keeping the code alive, like `CodeRegistry`), so each code
+    object is matched once and every later event costs one dict lookup.
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self._include = compile_rules(self.include)
+        self._exclude = compile_rules(self.exclude)
+        self._cache = {}
+
+    def __call__(self, code, module):
+        """Whether `code`, running in `module`, is profiled."""
+        cached = self._cache.get(id(code))
+        if cached is None:
+            qualname = getattr(code, "co_qualname", code.co_name)
+            cached = self._cache[id(code)] = (code, self.matches(module, qualname, code.co_filename))
+        return cached[1]
+
+    def matches(self, module, qualname, filename):
+        values = {"name": f"{module}.{qualname}", "module": module or "", "qualname": qualname, "file": filename}
+        if self._include and not any(regex.match(values[field]) for field, regex in self._include.items()):
+            return False
+        return not any(regex.match(values[field]) for field, regex in self._exclude.items())
@@ -0,0 +1,155 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+# Exact up to 2 * SUB_COUNT nanoseconds, then SUB_COUNT buckets per power of two up to ~13 days.
+MAX_EXPONENT = 45
+BUCKETS = SUB_COUNT * (MAX_EXPONENT + 2)
+PERCENTILES = (50.0, 95.0, 99.0, 99.9)
+
+
+def _index(value):
+    if value < 2 * SUB_COUNT:
+        return value if value > 0 else 0
+    shift = value.bit_length() - SUB_BITS - 1
+    index = ((shift + 1) << SUB_BITS) + (value >> shift) - SUB_COUNT
+    return index if index < BUCKETS else BUCKETS - 1
+
+
+def _midpoint(index):
+    """Middle of bucket `index` in nanoseconds."""
+    if index < 2 * SUB_COUNT:
+        return float(index)
+    shift = (index >> SUB_BITS) - 1
+    lower = (SUB_COUNT + (index & (SUB_COUNT - 1))) << shift
+    return lower + (1 << shift) / 2
+
+
+class Histogram:
+    """Sparse log-linear (HDR-style) histogram of durations.
+
+    Values are kept in nanoseconds: exactly below 64 ns, then in 32 linear buckets per
+    power of two, so every percentile is within ~1.6% of the recorded value. Only the
+    buckets that were hit are stored, as {bucket index: count}, so a function whose
+    calls take a handful of distinct durations costs a handful of entries. All
+    histograms share the same buckets, which makes merging a lossless sum.
+    """
+
+    __slots__ = ("counts", "count")
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+
+    def record(self, seconds):
+        index = _index(int(seconds * 1e9))
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+
+    def record_ns(self, nanoseconds):
+        index = _index(nanoseconds)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        """Add the counts of `other` to this histogram in place."""
+        counts = self.counts
+        for index, count in other.counts.items():
+            counts[index] = counts.get(index, 0) + count
+        self.count += other.count
+        return self
+
+    def copy(self):
+        return Histogram().merge(self)
+
+    def percentile(self, q):
+        """Value in seconds below which `q` percent of the recorded values fall."""
+        return self._percentile(sorted(self.counts.items()), q)
+
+    def percentiles(self, qs=PERCENTILES):
+        buckets = sorted(self.counts.items())
+        return [self._percentile(buckets, q) for q in qs]
+
+    def _percentile(self, buckets, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for index, count in buckets:
+            seen += count
+            if seen >= rank:
+                return _midpoint(index) / 1e9
+        return _midpoint(BUCKETS - 1) / 1e9
+
+    def relative_error(self):
+        """Standard error of the mean over the mean, from the bucket midpoints."""
+        if self.count < 2:
+            return float("inf")
+        total = total_sq = 0.0
+        for index, count in self.counts.items():
+            value = _midpoint(index)
+            total += count * value
+            total_sq += count * value * value
+        mean = total / self.count
+        if mean <= 0:
+            return float("inf")
+        variance = max(0.0, total_sq / self.count - mean * mean) * self.count / (self.count - 1)
+        return (variance / self.count) ** 0.5 / mean
+
+    def cumulative(self, bounds):
+        """Number of values at or below each bound in seconds, for Prometheus-style buckets."""
+        limits = [bound * 1e9 for bound in bounds]
+        totals = [0] * len(limits)
+        for index, count in self.counts.items():
+            value = _midpoint(index)
+            for i, limit in enumerate(limits):
+                if value <= limit:
+                    totals[i] += count
+        return totals
+
+    def total(self):
+        """Sum of the recorded values in seconds, from the bucket midpoints."""
+        return sum(count * _midpoint(index) for index, count in self.counts.items()) / 1e9
+
+    def to_text(self):
+        """Sparse "bucket:count" list for the CSV."""
+        return ";".join(f"{index}:{count}" for index, count in sorted(self.counts.items()))
+
+    @classmethod
+    def from_text(cls, text):
+        histogram = cls()
+        counts = histogram.counts
+        for item in filter(None, text.split(";")):
+            index, _, count = item.partition(":")
+            index = int(index)
+            counts[index] = counts.get(index, 0) + int(count)
+            histogram.count += int(count)
+        return histogram
+
+
+def record_latency(data, duration, cpu):
+    """Add one call to the duration and CPU histograms of a profile dict."""
+    if data.get("time_histogram") is None:
+        data["time_histogram"] = Histogram()
+        data["cpu_histogram"] = Histogram()
+    data["time_histogram"].record(duration)
+    data["cpu_histogram"].record(cpu)
+
+
+def merge_histograms(target, other):
+    """Merged histogram of two that may be None, without modifying `other`."""
+    if other is None:
+        return target
+    if target is None:
+        return other.copy()
+    return target.merge(other)
+
+
+def format_percentiles(histogram):
+    """ "p50 / p95 / p99 / p99.9" of a histogram, in seconds."""
+    return " / ".join(f"{value:.6f}" for value in histogram.percentiles()) + " seconds"
@@ -0,0 +1,241 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import platform
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from rich import print
+from rich.table import Table
+
+from mbench.histogram import Histogram
+
+# Columns of the stats table that come straight from a profile dict.
+STAT_FIELDS = (
+    "calls",
+    "total_time",
+    "total_self_time",
+    "total_cpu",
+    "total_memory",
+    "total_alloc",
+    "total_awaited",
+    "peak_alloc",
+    "total_gpu",
+    "total_io",
+    "notes",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    command TEXT,
+    git_sha TEXT,
+    host TEXT,
+    python TEXT,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS functions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS stats (
+    function_id INTEGER NOT NULL REFERENCES functions (id),
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    calls INTEGER NOT NULL,
+    total_time REAL NOT NULL,
+    total_self_time REAL NOT NULL,
+    total_cpu REAL NOT NULL,
+    total_memory REAL NOT NULL,
+    total_alloc REAL NOT NULL,
+    total_awaited REAL NOT NULL,
+    peak_alloc REAL NOT NULL,
+    total_gpu REAL NOT NULL,
+    total_io REAL NOT NULL,
+    notes TEXT,
+    time_histogram TEXT,
+    cpu_histogram TEXT,
+    PRIMARY KEY (function_id, run_id)
+) WITHOUT ROWID;
+"""
+
+
+def git_sha(cwd=None):
+    """Commit checked out in `cwd`, or None outside of a git work tree."""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=cwd, capture_output=True, text=True, timeout=2.0, check=False
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+def run_metadata(started=None):
+    """Metadata describing the current process as a run."""
+    return {
+        "started": started or time.time(),
+        "command": " ".join(sys.argv),
+        "git_sha": git_sha(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "pid": os.getpid(),
+    }
+
+
+class RunHistory:
+    """Per-run aggregates in a local SQLite database.
+
+    Each run is a row in ``runs``. Its per-function aggregates and histograms go into
+    ``stats`` in one transaction. ``stats`` is clustered by (function, run), so the
+    recent history of one function is a single index range scan no matter how many
+    runs are stored.
+    """
+
+    def __init__(self, path="mbench_profile.db"):
+        self.path = str(path)
+        self.conn = sqlite3.connect(self.path, timeout=30.0)
+        # Several processes may finish at once; WAL lets readers run alongside a writer.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _function_ids(self, names):
+        self.conn.executemany("INSERT OR IGNORE INTO functions (name) VALUES (?)", ((name,) for name in names))
+        return dict(self.conn.execute("SELECT name, id FROM functions").fetchall())
+
+    def record_run(self, profiles, **metadata):
+        """Store one run and its per-function aggregates. Returns the run id."""
+        metadata = {**run_metadata(), **metadata}
+        metadata.setdefault("finished", time.time())
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO runs (started, finished, command, git_sha, host, python, pid)"
+                " VALUES (:started, :finished, :command, :git_sha, :host, :python, :pid)",
+                metadata,
+            )
+            run_id = cursor.lastrowid
+            profiles = {name: data for name, data in profiles.items() if data.get("calls")}
+            ids = self._function_ids(profiles)
+            self.conn.executemany(
+                f"INSERT INTO stats (function_id, run_id, {', '.join(STAT_FIELDS)}, time_histogram, cpu_histogram)"
+                f" VALUES (?, ?, {', '.join('?' * len(STAT_FIELDS))}, ?, ?)",
+                (
+                    (
+                        ids[name],
+                        run_id,
+                        *(data.get(field, "" if field == "notes" else 0) for field in STAT_FIELDS),
+                        data["time_histogram"].to_text() if data.get("time_histogram") else None,
+                        data["cpu_histogram"].to_text() if data.get("cpu_histogram") else None,
+                    )
+                    for name, data in profiles.items()
+                ),
+            )
+        return run_id
+
+    def runs(self, limit=20):
+        """Most recent runs, newest first, as dicts."""
+        cursor = self.conn.execute(
+            "SELECT r.*, COUNT(s.function_id) AS functions FROM runs r LEFT JOIN stats s ON s.run_id = r.id"
+            " GROUP BY r.id ORDER BY r.id DESC LIMIT ?",
+            (limit,),
+        )
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row, strict=True)) for row in cursor]
+
+    def load_run(self, run_id=None, empty_profile=dict):
+        """Aggregates of one run (the latest by default), keyed by function name."""
+        if run_id is None:
+            run_id = self.conn.execute("SELECT MAX(id) FROM runs").fetchone()[0]
+        cursor = self.conn.execute(
+            f"SELECT f.name, {', '.join('s.' + field for field in STAT_FIELDS)}, s.time_histogram, s.cpu_histogram"
+            " FROM stats s JOIN functions f ON f.id = s.function_id WHERE s.run_id = ?",
+            (run_id,),
+        )
+        profiles = {}
+        for name, *values, time_histogram, cpu_histogram in cursor:
+            data = profiles[name] = empty_profile()
+            data.update(zip(STAT_FIELDS, values, strict=True))
+            data["time_histogram"] = Histogram.from_text(time_histogram) if time_histogram else None
+            data["cpu_histogram"] = Histogram.from_text(cpu_histogram) if cpu_histogram else None
+        return profiles
+
+    def function_history(self, name, last=200):
+        """(run id, started, calls, total time, average duration) of `name` over its `last` runs, newest first."""
+        return self.conn.execute(
+            "SELECT s.run_id, r.started, s.calls, s.total_time, s.total_time / s.calls"
+            " FROM stats s JOIN runs r ON r.id = s.run_id"
+            " WHERE s.function_id = (SELECT id FROM functions WHERE name = ?)"
+            " ORDER BY s.run_id DESC LIMIT ?",
+            (name, last),
+        ).fetchall()
+
+    def average_duration(self, name, last=200):
+        """Average duration per call of `name` over its `last` runs, or None if it never ran."""
+        return self.conn.execute(
+            "SELECT SUM(total_time) / SUM(calls) FROM ("
+            " SELECT total_time, calls FROM stats"
+            " WHERE function_id = (SELECT id FROM functions WHERE name = ?)"
+            " ORDER BY run_id DESC LIMIT ?)",
+            (name, last),
+        ).fetchone()[0]
+
+
+def main(argv=None):
+    """`mbench history`: list recent runs, or the history of one function."""
+    parser = ArgumentParser(prog="mbench history", description=main.__doc__)
+    parser.add_argument("function", nargs="?", help="qualified function name, e.g. __main__.work")
+    parser.add_argument("--last", type=int, default=20, help="number of runs to show")
+    parser.add_argument("--db", default=os.environ.get("MBENCH_HISTORY") or "mbench_profile.db")
+    args = parser.parse_args(argv)
+    with RunHistory(args.db) as history:
+        if args.function is None:
+            table = Table(title="[bold blue]Runs[/bold blue]", border_style="bold")
+            for column in ("Run", "Started", "Command", "Git", "Host", "Python", "Functions"):
+                table.add_column(column)
+            for run in history.runs(args.last):
+                table.add_row(
+                    str(run["id"]),
+                    datetime.fromtimestamp(run["started"]).isoformat(sep=" ", timespec="seconds"),
+                    run["command"],
+                    (run["git_sha"] or "")[:10],
+                    run["host"],
+                    run["python"],
+                    str(run["functions"]),
+                )
+        else:
+            average = history.average_duration(args.function, args.last)
+            table = Table(
+                title=f"[bold blue]History of [cyan]{args.function}[/cyan][/bold blue]",
+                caption=f"Avg duration over the last {args.last} runs: {average or 0:.6f} seconds",
+                border_style="bold",
+            )
+            for column in ("Run", "Started", "Calls", "Total time", "Avg duration"):
+                table.add_column(column)
+            for run_id, started, calls, total_time, avg_time in history.function_history(args.function, args.last):
+                table.add_row(
+                    str(run_id),
+                    datetime.fromtimestamp(started).isoformat(sep=" ", timespec="seconds"),
+                    str(calls),
+                    f"{total_time:.6f}",
+                    f"{avg_time:.6f}",
+                )
+    print(table)
@@ -0,0 +1,277 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import functools
+import linecache
+import sys
+import threading
+import time
+import warnings
+
+from mbench.aio import CO_COROUTINE
+from mbench.monitoring import MONITORING_AVAILABLE
+
+# sys.monitoring tool ids not reserved for debuggers, coverage, profilers or optimizers.
+FREE_TOOL_IDS = (3, 4)
+
+
+class LineState:
+    """Line timings of one thread. `stack` holds [frame, current line, ns it started at] per selected frame running."""
+
+    __slots__ = ("stack", "lines")
+
+    def __init__(self):
+        self.stack = []
+        # (id(code), line) -> [hits, ns]
+        self.lines = {}
+
+
+class LineProfiler:
+    """Per-line hit counts and time of selected functions only.
+
+    On Python 3.12+ LINE events are switched on with `sys.monitoring.set_local_events`
+    for the selected code objects alone, under a tool id of their own. Elsewhere `wrap`
+    installs a trace function only while a selected function runs, and it hands out a
+    local `f_trace` to the selected frames only. Either way the rest of the program is
+    not slowed down. A line's time lasts until the next line of the same frame starts,
+    so it includes the functions the line calls.
+    """
+
+    def __init__(self, backend="auto"):
+        if backend == "auto":
+            backend = "monitoring" if MONITORING_AVAILABLE else "settrace"
+        self.backend = backend
+        self.tool_id = None
+        # id(code) -> code of the selected functions.
+        self.codes = {}
+        # id(code) -> calls that ran while another trace function was installed and were not traced.
+        self.untraced = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.threads = []
+        if backend == "monitoring" and not self._start_monitoring():
+            self.backend = "settrace"
+
+    def _start_monitoring(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        for tool_id in FREE_TOOL_IDS:
+            if monitoring.get_tool(tool_id) is None:
+                break
+        else:
+            return False
+        monitoring.use_tool_id(tool_id, "mbench-lines")
+        self.tool_id = tool_id
+        monitoring.register_callback(tool_id, events.PY_START, self._on_start)
+        monitoring.register_callback(tool_id, events.PY_RESUME, self._on_start)
+        monitoring.register_callback(tool_id, events.LINE, self._on_line)
+        monitoring.register_callback(tool_id, events.PY_RETURN, self._on_return)
+        monitoring.register_callback(tool_id, events.PY_YIELD, self._on_return)
+        monitoring.register_callback(tool_id, events.PY_UNWIND, self._on_unwind)
+        # PY_UNWIND cannot be enabled per code object; it only fires while an exception propagates.
+        monitoring.set_events(tool_id, events.PY_UNWIND)
+        return True
+
+    def stop(self):
+        """Stop recording. The selected functions run untraced from then on."""
+        if self.tool_id is None:
+            return
+        monitoring = sys.monitoring
+        for code in self.codes.values():
+            monitoring.set_local_events(self.tool_id, code, 0)
+        monitoring.set_events(self.tool_id, 0)
+        for event in (
+            monitoring.events.PY_START, monitoring.events.PY_RESUME, monitoring.events.LINE,
+            monitoring.events.PY_RETURN, monitoring.events.PY_YIELD, monitoring.events.PY_UNWIND,
+        ):
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.tool_id = None
+        self.codes = {}
+
+    def add(self, code):
+        """Record the lines of `code` from now on."""
+        self.codes[id(code)] = code
+        if self.tool_id is not None:
+            events = sys.monitoring.events
+            sys.monitoring.set_local_events(
+                self.tool_id, code, events.PY_START | events.PY_RESUME | events.LINE | events.PY_RETURN | events.PY_YIELD
+            )
+
+    def wrap(self, func, call=None):
+        """Select `func` and return `call` (default `func`), traced while it runs when sys.monitoring is not used.
+
+        Without sys.monitoring the lines of a coroutine function are not recorded, and
+        neither are those of calls made while a debugger or coverage tool owns the trace
+        function: they are counted in `untraced` and the first one warns.
+        """
+        self.add(func.__code__)
+        call = call or func
+        if self.tool_id is not None or func.__code__.co_flags & CO_COROUTINE:
+            return call
+        tracer = self._trace_call
+        code = func.__code__
+
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            # A debugger or coverage tool that is already tracing is left alone. A recursive
+            # call finds our own tracer installed and is traced by it.
+            current = sys.gettrace()
+            owner = current is None
+            if owner:
+                sys.settrace(tracer)
+            elif current is not tracer:
+                self._untraced(code)
+            try:
+                return call(*args, **kwargs)
+            finally:
+                if owner:
+                    sys.settrace(None)
+
+        return traced
+
+    def _untraced(self, code):
+        calls = self.untraced.get(id(code), 0)
+        self.untraced[id(code)] = calls + 1
+        if not calls:
+            warnings.warn(
+                f"mbench: no line timings for {code.co_name} while another trace function "
+                "(a debugger or coverage) is installed",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+
+    def _state(self):
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = LineState()
+            with self._lock:
+                self.threads.append(state)
+        return state
+
+    def _enter(self, frame):
+        self._state().stack.append([frame, None, 0])
+
+    def _line(self, frame, line):
+        now = time.perf_counter_ns()
+        state = self._state()
+        stack = state.stack
+        # Frames left by an exception that was not seen end here.
+        while stack and stack[-1][0] is not frame:
+            self._close(state, stack.pop(), now)
+        if not stack:
+            stack.append([frame, None, 0])
+        entry = stack[-1]
+        lines = state.lines
+        code_id = id(frame.f_code)
+        if entry[1] is not None:
+            lines[(code_id, entry[1])][1] += now - entry[2]
+        counts = lines.get((code_id, line))
+        if counts is None:
+            counts = lines[(code_id, line)] = [0, 0]
+        counts[0] += 1
+        entry[1] = line
+        entry[2] = time.perf_counter_ns()
+
+    def _leave(self, frame):
+        now = time.perf_counter_ns()
+        state = self._state()
+        stack = state.stack
+        while stack:
+            entry = stack.pop()
+            self._close(state, entry, now)
+            if entry[0] is frame:
+                break
+
+    def _close(self, state, entry, now):
+        frame, line, started = entry
+        if line is not None:
+            state.lines[(id(frame.f_code), line)][1] += now - started
+
+    # sys.monitoring callbacks.
+    def _on_start(self, code, instruction_offset):
+        self._enter(sys._getframe(1))
+
+    def _on_line(self, code, line):
+        self._line(sys._getframe(1), line)
+
+    def _on_return(self, code, instruction_offset, retval):
+        self._leave(sys._getframe(1))
+
+    def _on_unwind(self, code, instruction_offset, exception):
+        if id(code) in self.codes:
+            self._leave(sys._getframe(1))
+
+    # sys.settrace fallback.
+    def _trace_call(self, frame, event, arg):
+        if event == "call" and id(frame.f_code) in self.codes:
+            self._enter(frame)
+            return self._trace_line
+        return None
+
+    def _trace_line(self, frame, event, arg):
+        if event == "line":
+            self._line(frame, frame.f_lineno)
+        elif event == "return":
+            self._leave(frame)
+        return self._trace_line
+
+    def results(self):
+        """{code: {line: (hits, seconds)}} of every selected function that ran, merged across threads."""
+        merged = {}
+        with self._lock:
+            threads = list(self.threads)
+        for state in threads:
+            for (code_id, line), (hits, ns) in list(state.lines.items()):
+                code = self.codes.get(code_id)
+                if code is None:
+                    continue
+                lines = merged.setdefault(code, {})
+                previous_hits, previous_time = lines.get(line, (0, 0.0))
+                lines[line] = (previous_hits + hits, previous_time + ns / 1e9)
+        return merged
+
+    def clear(self):
+        """Drop the recorded timings, keeping the selected functions."""
+        with self._lock:
+            for state in self.threads:
+                state.lines = {}
+        self.untraced = {}
+
+
+def source_lines(code):
+    """(line number, text) of every line of `code`'s source, or [] when it cannot be read."""
+    numbers = [line for _, _, line in code.co_lines() if line is not None]
+    if not numbers:
+        return []
+    text = linecache.getlines(code.co_filename)
+    first, last = code.co_firstlineno, max(numbers)
+    return [(number, text[number - 1].rstrip("\n")) for number in range(first, last + 1) if number <= len(text)]
+
+
+def line_table(name, code, lines):
+    """Rich table of the source of `code` annotated with the `lines` of `LineProfiler.results`."""
+    from rich.markup import escape
+    from rich.table import Table
+
+    total = sum(seconds for _, seconds in lines.values()) or 1.0
+    table = Table(title=f"[bold blue]Line profile for [cyan]{name}[/cyan][/bold blue]", border_style="bold")
+    table.add_column("Line", justify="right", style="cyan", no_wrap=True)
+    table.add_column("Hits", justify="right")
+    table.add_column("Time", justify="right", style="yellow")
+    table.add_column("Per hit", justify="right")
+    table.add_column("% Time", justify="right", style="bold magenta")
+    table.add_column("Source", no_wrap=True)
+    source = source_lines(code) or [(line, "") for line in sorted(lines)]
+    for number, text in source:
+        hits, seconds = lines.get(number, (0, 0.0))
+        if hits:
+            table.add_row(
+                str(number), str(hits), f"{seconds:.6f} s", f"{seconds / hits * 1e6:.2f} µs",
+                f"{seconds / total * 100:.1f}", escape(text),
+            )
+        else:
+            table.add_row(str(number), "", "", "", "", escape(text))
+    return table
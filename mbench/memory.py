@@ -0,0 +1,107 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import threading
+import tracemalloc
+
+import psutil
+
+_process = None
+
+
+def process_rss():
+    """Resident set size of this process in bytes."""
+    global _process
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process()
+    return _process.memory_info().rss
+
+
+class MemoryCollector:
+    """Per-call tracemalloc net and peak allocation.
+
+    tracemalloc only keeps one process-wide peak, so every call resets it on entry and
+    hands the highest peak it saw back to its caller on exit. That way nested calls
+    still report the true peak of the outer call.
+
+    Both numbers are process-wide: while calls run on several threads at once, a call's
+    net and peak include what the other threads allocated, and another thread's call
+    resetting the peak can hide part of this call's.
+    """
+
+    def __init__(self, enabled=True, frames=1, sites=5, sites_min_bytes=1024 * 1024):
+        self.enabled = False
+        self.frames = frames
+        self.sites = sites
+        self.sites_min_bytes = sites_min_bytes
+        self._started = False
+        self._local = threading.local()
+        if enabled:
+            self.start_tracing()
+
+    def start_tracing(self):
+        """Measure calls from now on, starting tracemalloc unless something else already has."""
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+
+    def stop_tracing(self):
+        """Stop measuring calls, and stop tracemalloc if this collector started it."""
+        self.enabled = False
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start(self):
+        """Begin measuring a call. Returns the token to pass to `stop`."""
+        if not self.enabled:
+            return None
+        stack = self._stack()
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        token = [current, current]
+        stack.append(token)
+        return token
+
+    def stop(self, token):
+        """Finish a call. Returns (net bytes allocated, peak bytes above the start)."""
+        if token is None:
+            return 0, 0
+        stack = self._stack()
+        current, peak = tracemalloc.get_traced_memory()
+        # Calls whose return was never seen are dropped along with this one.
+        while stack:
+            if stack.pop() is token:
+                break
+        start, seen = token
+        peak = max(seen, peak)
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        return current - start, peak - start
+
+    def top_sites(self, code):
+        """Largest live allocations made from inside `code`, as "file:line" and byte counts."""
+        if not tracemalloc.is_tracing():
+            return []
+        lines = {line for _, _, line in code.co_lines() if line is not None}
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(True, code.co_filename)])
+        sites = []
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            if frame.lineno in lines:
+                sites.append((f"{frame.filename}:{frame.lineno}", stat.size))
+                if len(sites) == self.sites:
+                    break
+        return sites
@@ -0,0 +1,154 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import glob
+import os
+from argparse import ArgumentParser
+from pathlib import Path
+
+from mbench.profile import empty_profile, merge_profile, read_csv, write_csv
+
+
+def read_trace(path):
+    """Profile dicts of a binary trace file written with `profileme(trace=...)`."""
+    from mbench.trace import TraceReader
+
+    with TraceReader(path) as reader:
+        return reader.aggregates(empty_profile)
+
+
+# File suffix -> function reading a file into {function name: profile dict}.
+READERS = {".csv": read_csv, ".bin": read_trace}
+
+
+def read_profiles(path):
+    """{function name: profile dict} of one profile file, by its suffix."""
+    reader = READERS.get(Path(path).suffix)
+    if reader is None:
+        raise ValueError(f"{path}: no reader for {Path(path).suffix or 'files without a suffix'}")
+    return reader(path)
+
+
+def iter_paths(inputs):
+    """Profile files named by `inputs`: files, glob patterns, or directories searched for every readable suffix."""
+    for item in inputs:
+        item = str(item)
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if Path(name).suffix in READERS:
+                        yield os.path.join(root, name)
+        elif any(char in item for char in "*?["):
+            yield from sorted(glob.iglob(item, recursive=True))
+        else:
+            yield item
+
+
+def merge_into(target, profiles):
+    """Add `profiles` ({name: profile dict}) to `target` in place."""
+    for name, data in profiles.items():
+        merge_profile(target.setdefault(name, empty_profile()), data)
+    return target
+
+
+def merge_batch(paths):
+    """Merged profiles of `paths` and how many files they were; what each worker process runs."""
+    merged = {}
+    for path in paths:
+        merge_into(merged, read_profiles(path))
+    return merged, len(paths)
+
+
+def _batches(paths, size):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def merge_files(inputs, workers=None, batch=32):
+    """Merge every profile file named by `inputs` into one {function name: profile dict}.
+
+    Totals, calls and histograms are summed and the peak allocation is the largest, so
+    averages and percentiles computed from the result are exact. Files are parsed in
+    batches of `batch` by `workers` processes (one per CPU by default, none for 1), each
+    merging its batch before sending it back. At most two batches per worker are in
+    flight at once, so memory depends on the number of distinct functions, not of files.
+    Returns (profiles, number of files merged).
+    """
+    merged = {}
+    files = 0
+    workers = workers or os.cpu_count() or 1
+    batches = _batches(iter_paths(inputs), batch)
+    if workers == 1:
+        for paths in batches:
+            profiles, count = merge_batch(paths)
+            merge_into(merged, profiles)
+            files += count
+        return merged, files
+
+    import multiprocessing
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    # Forking a process whose profiler threads are running can deadlock the children.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        pending = set()
+        for paths in batches:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    profiles, count = future.result()
+                    merge_into(merged, profiles)
+                    files += count
+            pending.add(pool.submit(merge_batch, paths))
+        for future in pending:
+            profiles, count = future.result()
+            merge_into(merged, profiles)
+            files += count
+    return merged, files
+
+
+def main(argv=None):
+    """`mbench merge`: combine the profiles of many processes or hosts into one CSV."""
+    from rich import print
+    from rich.table import Table
+
+    parser = ArgumentParser(prog="mbench merge", description=main.__doc__)
+    parser.add_argument("inputs", nargs="+", help="profile files (.csv or trace .bin), glob patterns or directories")
+    parser.add_argument("-o", "--output", default="mbench_merged.csv", help="merged CSV to write")
+    parser.add_argument("--workers", type=int, default=None, help="parsing processes, one per CPU by default")
+    parser.add_argument("--batch", type=int, default=32, help="files each worker merges before sending them back")
+    parser.add_argument("--limit", type=int, default=30, help="number of functions to show")
+    args = parser.parse_args(argv)
+    profiles, files = merge_files(args.inputs, workers=args.workers, batch=args.batch)
+    write_csv(args.output, profiles)
+
+    rows = sorted(profiles.items(), key=lambda item: item[1]["total_time"], reverse=True)
+    table = Table(
+        title=f"[bold blue]Merged {files} profiles[/bold blue]",
+        caption=f"saved to {args.output}",
+        border_style="bold",
+    )
+    table.add_column("Function", style="cyan", no_wrap=True)
+    for column in ("Calls", "Total time", "Avg", "p50", "p99"):
+        table.add_column(column, justify="right")
+    for name, data in rows[: args.limit]:
+        if not data["calls"]:
+            continue
+        histogram = data.get("time_histogram")
+        table.add_row(
+            name,
+            str(data["calls"]),
+            f"{data['total_time']:.6f}",
+            f"{data['total_time'] / data['calls']:.6f}",
+            f"{histogram.percentile(50):.6f}" if histogram else "",
+            f"{histogram.percentile(99):.6f}" if histogram else "",
+        )
+    print(table)
@@ -0,0 +1,171 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# Upper bounds in seconds of the exported latency buckets.
+BUCKETS = (1e-6, 1e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (metric, type, unit, help, profile field). Counters only ever grow; the memory deltas can shrink.
+FIELDS = (
+    ("calls", "counter", "", "Completed calls", "calls"),
+    ("time_seconds", "counter", "seconds", "Inclusive wall time", "total_time"),
+    ("self_time_seconds", "counter", "seconds", "Wall time outside profiled callees", "total_self_time"),
+    ("cpu_seconds", "counter", "seconds", "Thread CPU time", "total_cpu"),
+    ("io_bytes", "counter", "bytes", "Disk I/O while running", "total_io"),
+    ("gpu_bytes", "counter", "bytes", "GPU memory growth while running", "total_gpu"),
+    ("memory_bytes", "gauge", "bytes", "Net change in resident memory", "total_memory"),
+    ("alloc_bytes", "gauge", "bytes", "Net Python allocations", "total_alloc"),
+    ("peak_alloc_bytes", "gauge", "bytes", "Largest allocation peak of one call", "peak_alloc"),
+)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(profiles, prefix="mbench", floors=None):
+    """OpenMetrics text exposition of profile dicts, one series per function.
+
+    Totals of adaptively sampled functions are extrapolated from the measured calls, so
+    they can shrink a little when the ratio changes. Pass the same `floors` dict on every
+    call and no counter is ever exported below a value it already had.
+    """
+    profiles = {name: data for name, data in profiles.items() if data.get("calls")}
+    lines = []
+    for metric, kind, unit, description, field in FIELDS:
+        name = f"{prefix}_{metric}"
+        lines.append(f"# TYPE {name} {kind}")
+        if unit:
+            lines.append(f"# UNIT {name} {unit}")
+        lines.append(f"# HELP {name} {description}.")
+        suffix = "_total" if kind == "counter" else ""
+        for function, data in profiles.items():
+            value = data.get(field, 0)
+            if kind == "counter" and floors is not None:
+                value = floors[(name, function)] = max(value, floors.get((name, function), value))
+            lines.append(f'{name}{suffix}{{function="{_label(function)}"}} {_number(value)}')
+    for metric, field, description in (
+        ("duration_seconds", "time_histogram", "Duration of single calls"),
+        ("cpu_duration_seconds", "cpu_histogram", "CPU time of single calls"),
+    ):
+        name = f"{prefix}_{metric}"
+        lines += [f"# TYPE {name} histogram", f"# UNIT {name} seconds", f"# HELP {name} {description}."]
+        for function, data in profiles.items():
+            histogram = data.get(field)
+            if histogram is None or not histogram.count:
+                continue
+            label = f'function="{_label(function)}"'
+            for bound, count in zip(BUCKETS, histogram.cumulative(BUCKETS), strict=True):
+                lines.append(f'{name}_bucket{{{label},le="{bound!r}"}} {count}')
+            lines.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_count{{{label}}} {histogram.count}")
+            lines.append(f"{name}_sum{{{label}}} {histogram.total()!r}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsSnapshot:
+    """Rendered exposition of a profiler, rebuilt at most every `interval` seconds by whoever asks for it."""
+
+    def __init__(self, profiler, interval=1.0, prefix="mbench"):
+        self.profiler = profiler
+        self.interval = interval
+        self.prefix = prefix
+        self._text = b""
+        self._taken = None
+        # Counters exported so far, so that they never go down; see `render`.
+        self._floors = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._taken is None or now - self._taken >= self.interval:
+                self._text = render(self.profiler.snapshot(include_loaded=False), self.prefix, self._floors).encode()
+                self._taken = now
+            return self._text
+
+
+class MetricsServer:
+    """Serve `/metrics` over HTTP from a background thread.
+
+    Scrapes read a cached exposition built from `FunctionProfiler.snapshot`, which only
+    reads the per-thread tables, so a scrape never makes a profiled thread wait.
+    """
+
+    def __init__(self, profiler, port=9464, host="127.0.0.1", interval=1.0):
+        snapshot = MetricsSnapshot(profiler, interval)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = snapshot.get()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mbench-metrics", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_textfile(path, profiles, prefix="mbench", floors=None):
+    """Write the exposition for node_exporter's textfile collector, replacing the file atomically."""
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    with os.fdopen(fd, "w") as f:
+        f.write(render(profiles, prefix, floors))
+    os.replace(tmp, path)
+    return path
+
+
+class TextfileWriter(threading.Thread):
+    """Rewrite a textfile-collector file every `interval` seconds until stopped."""
+
+    def __init__(self, profiler, path, interval=15.0):
+        super().__init__(name="mbench-metrics-textfile", daemon=True)
+        self.profiler = profiler
+        self.path = path
+        self.interval = interval
+        self._floors = {}
+        self._stop_event = threading.Event()
+
+    def write(self):
+        return write_textfile(self.path, self.profiler.snapshot(include_loaded=False), floors=self._floors)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.write()
+
+    def stop(self):
+        """Stop and write the final values."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=1.0)
+        self.write()
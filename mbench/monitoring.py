@@ -0,0 +1,81 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+
+from mbench.aio import CO_COROUTINE
+
+MONITORING_AVAILABLE = hasattr(sys, "monitoring")
+
+
+class MonitoringBackend:
+    """Drive a FunctionProfiler from PEP 669 ``sys.monitoring`` events (Python 3.12+).
+
+    PY_START starts a call and PY_RETURN/PY_UNWIND end it. Generators and coroutines
+    also report PY_RESUME and PY_YIELD, which map to a call and return just like the
+    events ``sys.setprofile`` sees for each resume. When the profiler targets
+    the module a function is *defined* in (``when="called"``), the decision is a
+    property of the code object, so non-target code gets ``DISABLE`` and the
+    interpreter stops reporting it. With ``when="calling"`` the answer depends on the
+    caller, so every event is checked.
+    """
+
+    def __init__(self, profiler, tool_id=None):
+        self.profiler = profiler
+        self.tool_id = sys.monitoring.PROFILER_ID if tool_id is None else tool_id
+        self.active = False
+
+    def start(self):
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.use_tool_id(self.tool_id, "mbench")
+        monitoring.register_callback(self.tool_id, events.PY_START, self._on_start)
+        monitoring.register_callback(self.tool_id, events.PY_RESUME, self._on_start)
+        monitoring.register_callback(self.tool_id, events.PY_RETURN, self._on_return)
+        monitoring.register_callback(self.tool_id, events.PY_YIELD, self._on_return)
+        monitoring.register_callback(self.tool_id, events.PY_UNWIND, self._on_unwind)
+        monitoring.set_events(
+            self.tool_id,
+            events.PY_START | events.PY_RESUME | events.PY_RETURN | events.PY_YIELD | events.PY_UNWIND,
+        )
+        # Code disabled by an earlier session would otherwise stay silent.
+        monitoring.restart_events()
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        monitoring = sys.monitoring
+        events = monitoring.events
+        monitoring.set_events(self.tool_id, 0)
+        for event in (events.PY_START, events.PY_RESUME, events.PY_RETURN, events.PY_YIELD, events.PY_UNWIND):
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+        self.active = False
+
+    def _disable(self):
+        return sys.monitoring.DISABLE if self.profiler.when == "called" else None
+
+    def _on_start(self, code, instruction_offset):
+        if self.profiler._start_profile(sys._getframe(1)) is None:
+            return self._disable()
+        return None
+
+    def _on_return(self, code, instruction_offset, retval):
+        frame = sys._getframe(1)
+        if self.profiler.async_tracker is not None and code.co_flags & CO_COROUTINE:
+            # Every coroutine feeds the per-Task bookkeeping, target or not.
+            self.profiler._end_profile(frame)
+            return None
+        if not self.profiler._is_target(frame):
+            return self._disable()
+        self.profiler._end_profile(frame)
+        return None
+
+    def _on_unwind(self, code, instruction_offset, exception):
+        # PY_UNWIND cannot be disabled per code object.
+        frame = sys._getframe(1)
+        if self.profiler._is_target(frame) or code.co_flags & CO_COROUTINE:
+            self.profiler._end_profile(frame)
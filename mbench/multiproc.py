@@ -0,0 +1,207 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import atexit
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+BOOTSTRAP_DIR = Path(__file__).parent / "bootstrap"
+
+
+def _address(value):
+    """Decode a listener address from the environment; TCP addresses arrive as lists."""
+    address = json.loads(value)
+    return tuple(address) if isinstance(address, list) else address
+
+
+def _main_name(qual_key):
+    """Report functions of the main module imported by spawned children under `__main__`."""
+    if qual_key.startswith("__mp_main__."):
+        return "__main__." + qual_key[len("__mp_main__."):]
+    return qual_key
+
+
+class Collector:
+    """Receive aggregates from profiled processes over a local socket.
+
+    Every message is a process's cumulative table, so a later message from the same
+    PID replaces the earlier one and nothing is counted twice.
+    """
+
+    def __init__(self):
+        family = "AF_UNIX" if hasattr(socket, "AF_UNIX") else "AF_INET"
+        self.authkey = os.urandom(16)
+        self.listener = Listener(family=family, authkey=self.authkey)
+        self.results = {}
+        self._thread = threading.Thread(target=self._serve, name="mbench-collector", daemon=True)
+        self._thread.start()
+
+    def env(self):
+        """Environment variables that make the bootstrap report to this collector."""
+        return {
+            "MBENCH_COLLECT": json.dumps(self.listener.address),
+            "MBENCH_AUTHKEY": self.authkey.hex(),
+        }
+
+    def _serve(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            except Exception:  # noqa: BLE001
+                # A failed handshake only loses that one connection.
+                continue
+            with conn:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    continue
+            if message.get("stop"):
+                return
+            self.results[message["pid"]] = message
+
+    def close(self):
+        """Handle every connection made so far, then stop listening."""
+        try:
+            with Client(self.listener.address, authkey=self.authkey) as conn:
+                conn.send({"stop": True})
+        except OSError:
+            pass
+        self._thread.join(timeout=5.0)
+        self.listener.close()
+
+    def merged(self, empty_profile):
+        """Merge the latest table of every process. Notes list the PIDs a function ran in."""
+        from mbench.profile import merge_profile
+
+        merged = {}
+        pids = {}
+        for pid, message in sorted(self.results.items()):
+            for qual_key, data in message["profiles"].items():
+                qual_key = _main_name(qual_key)
+                merge_profile(merged.setdefault(qual_key, empty_profile()), data)
+                pids.setdefault(qual_key, []).append(pid)
+        for qual_key, data in merged.items():
+            tag = "pids: " + ", ".join(map(str, sorted(set(pids[qual_key]))))
+            data["notes"] = "; ".join(filter(None, [data.get("notes"), tag]))
+        return merged
+
+    def merged_stacks(self):
+        """Merge the call stacks of every process."""
+        from mbench.callgraph import merge_stacks
+
+        merged = {}
+        for _, message in sorted(self.results.items()):
+            stacks = message.get("stacks", {})
+            merge_stacks(merged, {tuple(map(_main_name, path)): data for path, data in stacks.items()})
+        return merged
+
+
+def run_command(command, path=".", target="__main__", when="called", env=None):
+    """Run `command` in `path` with every Python process in it profiled. Returns (exit code, collector)."""
+    collector = Collector()
+    child_env = dict(os.environ if env is None else env)
+    child_env.update(collector.env())
+    child_env["MBENCH_TARGET"] = target
+    child_env["MBENCH_WHEN"] = when
+    child_env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [str(BOOTSTRAP_DIR), os.path.abspath(path), child_env.get("PYTHONPATH", "")])
+    )
+    try:
+        returncode = subprocess.call(command, shell=True, cwd=path, env=child_env)
+    finally:
+        collector.close()
+    return returncode, collector
+
+
+class ChildReporter:
+    """Send this process's aggregates to the collector at exit and, optionally, periodically."""
+
+    def __init__(self, profiler, address, authkey, interval=0.0):
+        self.profiler = profiler
+        self.address = address
+        self.authkey = authkey
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def start(self):
+        from multiprocessing import util
+
+        atexit.register(self.send)
+        if self.interval > 0:
+            threading.Thread(target=self._run, name="mbench-child-reporter", daemon=True).start()
+        os.register_at_fork(after_in_child=self._after_fork)
+        # Forked multiprocessing children clear their finalizers on start and leave through
+        # os._exit, which skips atexit, so they need a finalizer registered after the fork.
+        util.register_after_fork(self, ChildReporter._register_finalizer)
+
+    def _register_finalizer(self):
+        from multiprocessing import util
+
+        util.Finalize(None, self.send, exitpriority=100)
+        util.Finalize(None, self.profiler.stop_timeline, exitpriority=99)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.send()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.profiler.after_fork()
+        if self.interval > 0:
+            threading.Thread(target=self._run, name="mbench-child-reporter", daemon=True).start()
+
+    def send(self):
+        with self._lock:
+            message = {
+                "pid": os.getpid(),
+                "ppid": os.getppid(),
+                "argv": list(sys.argv),
+                "profiles": self.profiler.snapshot(include_loaded=False),
+                "stacks": self.profiler.call_stacks(include_loaded=False),
+            }
+            try:
+                with Client(self.address, authkey=self.authkey) as conn:
+                    conn.send(message)
+            except (OSError, EOFError):
+                pass
+
+
+def bootstrap():
+    """Profile this interpreter when launched by `mbench`. Called from the bootstrap sitecustomize."""
+    if "MBENCH_COLLECT" not in os.environ or os.environ.get("MBENCH", "1") != "1":
+        return
+    from mbench.profile import FunctionProfiler
+
+    target = os.environ.get("MBENCH_TARGET", "__main__")
+    if target == "__main__" and "--multiprocessing-fork" in sys.argv:
+        # multiprocessing's spawn children import the parent's main module under this name.
+        target = "__mp_main__"
+    profiler = FunctionProfiler()
+    profiler.autosave = False
+    profiler.set_target_module(target, os.environ.get("MBENCH_WHEN", "called"))
+    profiler.install()
+    reporter = ChildReporter(
+        profiler,
+        _address(os.environ["MBENCH_COLLECT"]),
+        bytes.fromhex(os.environ["MBENCH_AUTHKEY"]),
+        interval=float(os.environ.get("MBENCH_STREAM_INTERVAL", "0")),
+    )
+    reporter.start()
+    # Keep the reporter alive: multiprocessing only holds a weak reference to it.
+    global _reporter
+    _reporter = reporter
+
+
+_reporter = None
@@ -0,0 +1,123 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import sys
+import time
+from typing import NamedTuple
+
+
+class Overhead(NamedTuple):
+    """Instrumentation cost per profiled call, in nanoseconds.
+
+    `call_ns` is what one profiled call adds to its caller's inclusive time: the whole
+    hook round trip. `inner_ns` is the part of it that falls between the call's own
+    start and end timestamps. `skip_ns` is the round trip of a call that adaptive
+    sampling counts without measuring. The `_cpu_` fields are the same costs in thread
+    CPU time.
+    """
+
+    call_ns: int = 0
+    call_cpu_ns: int = 0
+    inner_ns: int = 0
+    inner_cpu_ns: int = 0
+    skip_ns: int = 0
+    skip_cpu_ns: int = 0
+
+
+def _target():
+    pass
+
+
+def _loop(n):
+    target = _target
+    for _ in range(n):
+        target()
+
+
+def _time(n):
+    start = time.perf_counter_ns()
+    cpu_start = time.thread_time_ns()
+    _loop(n)
+    return time.perf_counter_ns() - start, time.thread_time_ns() - cpu_start
+
+
+def _hooked(profiler, backend, n):
+    if backend == "monitoring":
+        from mbench.monitoring import MonitoringBackend
+
+        monitoring = MonitoringBackend(profiler)
+        monitoring.start()
+        try:
+            return _time(n)
+        finally:
+            monitoring.stop()
+    previous = sys.getprofile()
+    sys.setprofile(profiler.profile)
+    try:
+        return _time(n)
+    finally:
+        sys.setprofile(previous)
+
+
+def calibrate(profiler, backend, calls=500, rounds=3):
+    """Measure the per-call cost of `profiler` with `backend` on this thread.
+
+    An empty function is called `calls` times with and without the hook, keeping the
+    fastest of `rounds` runs. The difference per call is the call overhead, and the
+    duration the profiler recorded for the empty function is the inner part of it. The
+    hooked runs are then repeated with every call of the empty function skipped, as
+    adaptive sampling does, for the cost of an unmeasured call. The trace, the timeline and
+    per-call reports are suspended meanwhile, so none of these calls end up in them.
+    """
+    saved = (profiler.target_module, profiler.when, profiler.overhead, profiler.adaptive, profiler.include, profiler.exclude)
+    outputs = (profiler.trace, profiler.timeline, profiler.report_mode)
+    profiler.trace = profiler.timeline = None
+    if profiler.report_mode == "call":
+        profiler.report_mode = "exit"
+    profiler.include, profiler.exclude = [], []
+    profiler.set_target_module(__name__, "called")
+    profiler.overhead = Overhead()
+    # Every calibration call has to be measured.
+    profiler.adaptive = False
+    state = profiler._thread_state()
+    store = state.store
+    try:
+        bare = [_time(calls) for _ in range(rounds)]
+        hooked = [_hooked(profiler, backend, calls) for _ in range(rounds)]
+        skipped = []
+        target_slot = profiler.registry.slots.get(id(_target.__code__))
+        if target_slot is not None:
+            store.skip[target_slot] = calls * rounds + 1
+            skipped = [_hooked(profiler, backend, calls) for _ in range(rounds)]
+    finally:
+        profiler.include, profiler.exclude = saved[4:]
+        profiler.set_target_module(*saved[:2])
+        profiler.overhead = saved[2]
+        profiler.adaptive = saved[3]
+        profiler.trace, profiler.timeline, profiler.report_mode = outputs
+        slots = [profiler.registry.slots.get(id(func.__code__)) for func in (_target, _loop, _time)]
+    target_slot = slots[0]
+    measured_calls = store.measured[target_slot] if target_slot is not None else 0
+    bare_wall = min(wall for wall, _ in bare)
+    bare_cpu = min(cpu for _, cpu in bare)
+    overhead = Overhead(
+        call_ns=max(0, (min(wall for wall, _ in hooked) - bare_wall) // calls),
+        call_cpu_ns=max(0, (min(cpu for _, cpu in hooked) - bare_cpu) // calls),
+        inner_ns=store.total_time[target_slot] // measured_calls if measured_calls else 0,
+        inner_cpu_ns=store.total_cpu[target_slot] // measured_calls if measured_calls else 0,
+        skip_ns=max(0, (min(wall for wall, _ in skipped) - bare_wall) // calls) if skipped else 0,
+        skip_cpu_ns=max(0, (min(cpu for _, cpu in skipped) - bare_cpu) // calls) if skipped else 0,
+    )
+    for slot in slots:
+        if slot is not None:
+            store.reset_slot(slot)
+            state.tree.reset_slot(slot)
+    # The inner part can never exceed the whole round trip, nor a skipped call cost more than a measured one.
+    return overhead._replace(
+        inner_ns=min(overhead.inner_ns, overhead.call_ns),
+        inner_cpu_ns=min(overhead.inner_cpu_ns, overhead.call_cpu_ns),
+        skip_ns=min(overhead.skip_ns, overhead.call_ns),
+        skip_cpu_ns=min(overhead.skip_cpu_ns, overhead.call_cpu_ns),
+    )
@@ -3,172 +3,185 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
-import asyncio
+from __future__ import annotations
+
 import atexit
-import csv
+import functools
 import io
 import os
 import sys
 import threading
 import time
 from collections import defaultdict
-from contextlib import contextmanager
-from pathlib import Path
+from contextlib import contextmanager, nullcontext
 from types import FrameType
 
-import psutil
-import pynvml
-from rich import print
-from rich.console import Console
-from rich.table import Table
-from typing_extensions import Literal
-
-nvml_lock = threading.Lock()
+from mbench.callgraph import ROOT, CallTree, call_graph, export_stacks, merge_stacks
+from mbench.collectors import Plan, builtin_collectors, select
+from mbench.filters import CodeFilter
+from mbench.histogram import Histogram, format_percentiles, merge_histograms, record_latency
+from mbench.store import CodeRegistry, StatsStore
+
+# rich, psutil, pynvml, asyncio, the optional collectors and reporters, and even csv, pathlib, random,
+# re and typing are imported where they are first used, so that importing mbench with MBENCH=0 loads
+# none of them. Type checkers still see `Literal`.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Literal
+
+# inspect.CO_COROUTINE, without importing inspect.
+CO_COROUTINE = 0x80
+# Measured calls of a function between two adaptive sampling decisions.
+ADAPT_EVERY = 1000
+# Never profiled: mbench itself, i.e. the profiler's methods, profileme(), collectors and exporters.
+DEFAULT_EXCLUDE = ("module:mbench", "module:mbench.*")
+# Aggregate fields summed when profiles are merged. Other numeric fields come from registered collectors.
+SUMMED_FIELDS = (
+    "calls", "total_time", "total_self_time", "total_cpu", "total_awaited",
+    "total_memory", "total_alloc", "total_gpu", "total_io",
+)
+BUILTIN_FIELDS = frozenset(
+    SUMMED_FIELDS + ("peak_alloc", "top_allocations", "time_histogram", "cpu_histogram", "notes", "total_gpus")
+)
 in_memory_file = io.StringIO()
+# Plain text, so that with MBENCH=0 nothing ever loads rich.
+INACTIVE_NOTICE = "Profiling is not active. Set MBENCH=1 to enable profiling.\n"
 
-# Create a Rich console object that writes to the in-memory file
-console = Console(file=in_memory_file, force_terminal=True)
 
-def print(*args, **kwargs):
-    """Replacement for the built-in print function that writes to StringIO with rich formatting."""
-    console.print(*args, **kwargs)
+class _Console:
+    """The Rich console writing to the in-memory file, created on first use."""
 
-def flush():
-    """Flush the contents of the StringIO object to stdout, preserving color and formatting."""
-    # Move to the start of the in-memory file
-    in_memory_file.seek(0)
-    
-    # Write the contents of StringIO to stdout
-    sys.stdout.write(in_memory_file.read())
-    
-    # Clear the in-memory file content
-    in_memory_file.truncate(0)
-    in_memory_file.seek(0)
-import asyncio
-
-def run_with_timeout(func, timeout=2.0):
-    async def run_func():
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, func)
+    _console = None
 
-    try:
-        result = asyncio.run(asyncio.wait_for(run_func(), timeout))
-        return result
-    except asyncio.TimeoutError:
-        print("[red]Error: Timed out while trying to execute function. Exiting...[/red]")
-        exit(1)  # Exit the program if the function times out
-    except Exception as e:
-        print(f"[yellow]Warning: Error during function execution: {e}. Exiting...[/yellow]")
-        exit(1)  # Exit the program if any other exception occurs
+    def __getattr__(self, name):
+        if _Console._console is None:
+            from rich.console import Console
 
-def _get_memory_usage():
-    """Retrieve memory usage with exception handling."""
-    return run_with_timeout(psutil.virtual_memory, timeout=1.0).used if run_with_timeout(psutil.virtual_memory, timeout=1.0) else 0
+            _Console._console = Console(file=in_memory_file, force_terminal=True)
+        return getattr(_Console._console, name)
 
-def _get_io_usage():
-    """Retrieve I/O usage with exception handling."""
-    io_counters = run_with_timeout(psutil.disk_io_counters, timeout=1.0)
-    return (io_counters.read_bytes + io_counters.write_bytes) if io_counters else 0
 
+console = _Console()
 
-class FunctionProfiler:
-    _instance = None
+def print(*args, **kwargs):
+    """Replacement for the built-in print function that writes to StringIO with rich formatting."""
+    console.print(*args, **kwargs)
 
-    def format_bytes(self, bytes_value):
-        if isinstance(bytes_value, str):
-            return bytes_value  # Return as-is if it's already a string
-        if isinstance(bytes_value, float):
-            bytes_value = int(bytes_value)
-        abs_bytes = abs(bytes_value)
-        sign = "-" if bytes_value < 0 else ""
-        kb = abs_bytes / 1024
-        if kb < 1:
-            return f"{sign}{abs_bytes:.2f} B"
-        elif kb < 1024:
-            return f"{sign}{kb:.2f} KB"
-        mb = kb / 1024
-        if mb < 1024:
-            return f"{sign}{mb:.2f} MB"
-        gb = mb / 1024
-        return f"{sign}{gb:.2f} GB"
+output_lock = threading.RLock()
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(FunctionProfiler, cls).__new__(cls)
-            cls._instance.initialize()
-        return cls._instance
+def flush():
+    """Flush the contents of the StringIO object to stdout, preserving color and formatting."""
+    with output_lock:
+        # Move to the start of the in-memory file
+        in_memory_file.seek(0)
+
+        # Write the contents of StringIO to stdout
+        sys.stdout.write(in_memory_file.read())
+        sys.stdout.flush()
+
+        # Clear the in-memory file content
+        in_memory_file.truncate(0)
+        in_memory_file.seek(0)
 
-import subprocess
 
 def main():
+    if sys.argv[1:2] == ["history"]:
+        from mbench.history import main as history_main
+
+        return history_main(sys.argv[2:])
+    if sys.argv[1:2] == ["top"]:
+        from mbench.top import main as top_main
+
+        top_main(sys.argv[2:])
+        return None
+    if sys.argv[1:2] == ["timeline"]:
+        from mbench.timeline import main as timeline_main
+
+        timeline_main(sys.argv[2:])
+        return None
+    if sys.argv[1:2] == ["merge"]:
+        from mbench.merge import main as merge_main
+
+        merge_main(sys.argv[2:])
+        return None
+    if sys.argv[1:2] == ["bench"]:
+        from mbench.bench import main as bench_main
+
+        bench_main(sys.argv[2:])
+        return None
     if len(sys.argv) < 3:
         console.print("[bold red]Error: Please provide a path and a command to profile.[/bold red]")
         console.print("Usage: mbench <path> <command>")
+        console.print("       mbench history [function] [--last N]")
+        console.print("       mbench bench <module or file.py>[:function] [--repeat N] [--processes N]")
+        console.print("       mbench timeline <trace.bin> [-o timeline.json]")
+        console.print("       mbench merge <profile.csv or directory>... [-o merged.csv] [--workers N]")
+        console.print("       mbench top <pid or socket> [--sort total|self|calls|rate|p99]")
+        flush()
         sys.exit(1)
-    
+
+    from mbench.multiproc import run_command
+    from mbench.timeline import merge_timelines, part_path
+
     path = sys.argv[1]
     command = " ".join(sys.argv[2:])
-    
+    target = os.environ.get("MBENCH_TARGET", "__main__")
+
     console.print(f"[bold green]Profiling path: {path}[/bold green]")
     console.print(f"[bold green]Command to profile: {command}[/bold green]")
-    
-    # Set up profiling
+
     profiler = FunctionProfiler()
-    profiler.set_target_module("__main__", "called")
-    
-    # Change to the specified directory
-    original_dir = os.getcwd()
-    os.chdir(path)
-    
-    try:
-        # Run the command with profiling
-        console.print("[bold yellow]Starting command execution...[/bold yellow]")
-        start_time = time.time()
-        env = os.environ.copy()
-        env['PYTHONPATH'] = f"{os.getcwd()}:{env.get('PYTHONPATH', '')}"
-        process = subprocess.Popen(f"python -m mbench.wrapper {command}", shell=True, env=env)
-        process.wait()
-        end_time = time.time()
-        console.print(f"[bold yellow]Command execution completed in {end_time - start_time:.2f} seconds[/bold yellow]")
-    finally:
-        # Change back to the original directory
-        os.chdir(original_dir)
-    
-    # Load and display results
-    results = profiler.load_data()
-    console.print("[bold green]Profiling completed. Results saved to mbench_profile.csv[/bold green]")
-    
-    # Display summary of profiling results
-    console.print("[bold blue]Profiling Summary:[/bold blue]")
-    for func, data in results.items():
-        calls = data['calls']
-        total_time = data['total_time']
-        total_cpu = data['total_cpu']
-        total_memory = data['total_memory']
-        total_gpu = data['total_gpu']
-        total_io = data['total_io']
-        
-        avg_time = total_time / calls if calls > 0 else 0
-        avg_cpu = total_cpu / calls if calls > 0 else 0
-        avg_memory = total_memory / calls if calls > 0 else 0
-        avg_gpu = total_gpu / calls if calls > 0 else 0
-        avg_io = total_io / calls if calls > 0 else 0
-        
-        display_profile_info(
-            name=func,
-            duration=total_time,
-            cpu_usage=total_cpu,
-            mem_usage=total_memory,
-            gpu_usage=total_gpu,
-            io_usage=total_io,
-            avg_time=avg_time,
-            avg_cpu=avg_cpu,
-            avg_memory=avg_memory,
-            avg_gpu=avg_gpu,
-            avg_io=avg_io,
-            calls=calls,
-            notes=data.get('notes', '')
+    # Every profiled process writes its own timeline; they are merged into this file at the end.
+    timeline = profiler.timeline_file
+    profiler.stop_timeline()
+
+    # Run the command with the bootstrap on its import path, so it and its Python children profile themselves
+    console.print("[bold yellow]Starting command execution...[/bold yellow]")
+    flush()
+    start_time = time.time()
+    returncode, collector = run_command(command, path, target=target)
+    end_time = time.time()
+    console.print(f"[bold yellow]Command execution completed in {end_time - start_time:.2f} seconds[/bold yellow]")
+
+    display_process_info(collector.results)
+    if timeline:
+        parts = [part_path(timeline, pid) for pid in sorted(collector.results)]
+        merge_timelines(timeline, [part for part in parts if part.exists()])
+        console.print(f"[bold green]Timeline saved to {timeline}[/bold green]")
+    merged = collector.merged(profiler._empty_profile)
+    loaded = profiler.loaded_profiles
+    for qual_key, data in merged.items():
+        merge_profile(loaded.setdefault(qual_key, profiler._empty_profile()), data)
+        if data.get("notes"):
+            loaded[qual_key]["notes"] = data["notes"]
+    merge_stacks(profiler.loaded_stacks, collector.merged_stacks())
+    profiler.record_history(merged, started=start_time, command=command)
+    flush()
+    # The merged summary is printed and saved to mbench_profile.csv at exit.
+    if returncode:
+        sys.exit(returncode)
+
+
+def display_process_info(results):
+    from rich.table import Table
+
+    table = Table(title="[bold blue]Profiled processes[/bold blue]", border_style="bold")
+    table.add_column("PID", justify="right", style="cyan")
+    table.add_column("Parent", justify="right")
+    table.add_column("Command", style="yellow")
+    table.add_column("Functions", justify="right")
+    table.add_column("Calls", justify="right", style="bold red")
+    for pid, message in sorted(results.items()):
+        profiles = message["profiles"]
+        table.add_row(
+            str(pid),
+            str(message["ppid"]),
+            " ".join(message["argv"]),
+            str(len(profiles)),
+            str(sum(data["calls"] for data in profiles.values())),
         )
+    console.print(table)
+    console.print("")
 
 
 def display_profile_info(
@@ -187,14 +200,28 @@ def display_profile_info(
     notes=None,
     avg_gpus = None,
     gpu_usages = None,
+    alloc_usage=None,
+    peak_alloc=None,
+    top_allocations=None,
+    self_time=None,
+    awaited=None,
+    time_histogram=None,
+    cpu_histogram=None,
+    extra=None,
 ):
+    from rich.table import Table
+
     table = Table(title=f"[bold blue]Profile Information for [cyan]{name}[/cyan][/bold blue]", border_style="bold")
 
     table.add_column("Metric", justify="right", style="cyan", no_wrap=True)
     table.add_column("Value", style="yellow")
 
     table.add_row("[bold]Duration[/bold]", f"[bold green]{duration:.6f} seconds[/bold green]")
+    if isinstance(self_time, (int, float)):
+        table.add_row("Self time", f"{self_time:.6f} seconds")
     table.add_row("CPU time", f"{cpu_usage:.6f} seconds")
+    if awaited:
+        table.add_row("Awaited time", f"{awaited:.6f} seconds")
     table.add_row("[bold]Memory usage[/bold]", f"[bold magenta]{mem_usage if isinstance(mem_usage, str) else FunctionProfiler().format_bytes(mem_usage)}[/bold magenta]")
     table.add_row("GPU usage", gpu_usage if isinstance(gpu_usage, str) else FunctionProfiler().format_bytes(gpu_usage))
     table.add_row("GPU usages", str(gpu_usages) if isinstance(gpu_usages, list) else gpu_usages)
@@ -205,6 +232,19 @@ def display_profile_info(
     table.add_row("Avg GPU usage", avg_gpu if isinstance(avg_gpu, str) else FunctionProfiler().format_bytes(avg_gpu))
     table.add_row("Avg GPU usages", str(avg_gpus) if isinstance(avg_gpus, list) else avg_gpus)
     table.add_row("Avg I/O usage", avg_io if isinstance(avg_io, str) else FunctionProfiler().format_bytes(avg_io))
+    if time_histogram is not None and time_histogram.count:
+        table.add_row("Duration p50/p95/p99/p99.9", format_percentiles(time_histogram))
+    if cpu_histogram is not None and cpu_histogram.count:
+        table.add_row("CPU p50/p95/p99/p99.9", format_percentiles(cpu_histogram))
+    if alloc_usage is not None:
+        table.add_row("Net allocated", alloc_usage if isinstance(alloc_usage, str) else FunctionProfiler().format_bytes(alloc_usage))
+    if peak_alloc is not None:
+        table.add_row("Peak allocated", peak_alloc if isinstance(peak_alloc, str) else FunctionProfiler().format_bytes(peak_alloc))
+    if top_allocations:
+        table.add_row("Top allocations", "\n".join(f"{site} ({FunctionProfiler().format_bytes(size)})" for site, size in top_allocations))
+    for field, total in extra or ():
+        table.add_row(field, f"{total:g}")
+        table.add_row(f"Avg {field}", f"{total / calls:g}" if calls else "0")
     table.add_row("[bold]Total calls[/bold]", f"[bold red]{calls}[/bold red]")
     if notes:
         table.add_row("Notes", f"[italic]{notes}[/italic]")
@@ -213,22 +253,213 @@ def display_profile_info(
     console.print("")  # Add an empty line for better separation between profile outputs
 
 
-# # Example usage
-# display_profile_info(
-#     name="ExampleBlock",
-#     duration=0.123456,
-#     cpu_usage=0.654321,
-#     mem_usage=1024 * 1024,
-#     gpu_usage=2048 * 1024,
-#     io_usage=512 * 1024,
-#     avg_time=0.111111,
-#     avg_cpu=0.222222,
-#     avg_memory=1024 * 512,
-    #     avg_gpu=2048 * 512,
-#     avg_gpu=2048 * 512,
-#     avg_io=512 * 256,
-#     calls=42,
-# )
+class ThreadState:
+    """Shadow call stack and aggregates of one thread. Only the owning thread writes to them.
+
+    Traced calls are counted in `store` by code slot and in `tree` by stack. `profiles`
+    holds the entries that are only known by name, such as coroutines and event-loop lag.
+    """
+
+    __slots__ = ("name", "ident", "stack", "store", "tree", "profiles")
+
+    def __init__(self, thread, num_gpus=0):
+        self.name = thread.name
+        self.ident = thread.ident
+        self.stack = []
+        self.store = StatsStore(num_gpus)
+        self.tree = CallTree()
+        self.profiles = {}
+
+
+def extra_fields(data):
+    """(field, total) of the registered collectors' fields in the aggregate `data`."""
+    return [
+        (field, value)
+        for field, value in data.items()
+        if field not in BUILTIN_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+
+
+def _split_rules(text):
+    """Rules from a comma-separated environment variable."""
+    return [rule.strip() for rule in text.split(",") if rule.strip()]
+
+
+def _no_clock():
+    return 0
+
+
+def trace_path(path):
+    """File this process records `MBENCH_TRACE` to.
+
+    Every process that inherits the variable would otherwise truncate the same file. The
+    first process to open it keeps `path`; the others, and every process started by the
+    `mbench` CLI, write run.<pid>.bin next to it.
+    """
+    pid = str(os.getpid())
+    owner = os.environ.setdefault("MBENCH_TRACE_PID", pid)
+    if owner == pid and "MBENCH_COLLECT" not in os.environ:
+        return path
+    from mbench.timeline import part_path
+
+    return str(part_path(path, pid))
+
+
+def merge_profile(target, data):
+    """Add the aggregates in `data` to `target` in place."""
+    for field in SUMMED_FIELDS:
+        target[field] = target.get(field, 0) + data.get(field, 0)
+    for field, value in extra_fields(data):
+        target[field] = target.get(field, 0) + value
+    for field in ("time_histogram", "cpu_histogram"):
+        target[field] = merge_histograms(target.get(field), data.get(field))
+    if data.get("peak_alloc", 0) > target.get("peak_alloc", 0):
+        target["peak_alloc"] = data["peak_alloc"]
+        target["top_allocations"] = data.get("top_allocations") or target.get("top_allocations", [])
+    gpus = data.get("total_gpus") or []
+    target_gpus = target.get("total_gpus") or []
+    if len(target_gpus) < len(gpus):
+        target_gpus = target_gpus + [0] * (len(gpus) - len(target_gpus))
+    target["total_gpus"] = [total + (gpus[i] if i < len(gpus) else 0) for i, total in enumerate(target_gpus)]
+    if data.get("notes") and not target.get("notes"):
+        target["notes"] = data["notes"]
+    return target
+
+
+def _format_sites(sites):
+    """Serialize (site, bytes) pairs for the CSV "Top Allocations" column."""
+    return ";".join(f"{site}={int(size)}" for site, size in sites)
+
+
+def _parse_sites(text):
+    sites = []
+    for item in filter(None, text.split(";")):
+        site, _, size = item.rpartition("=")
+        sites.append((site, int(size)))
+    return sites
+
+
+def write_csv(csv_file, profiles):
+    """Write profile dicts to `csv_file` in the mbench CSV format."""
+    import csv
+
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            "Function",
+            "Calls",
+            "Total Time",
+            "Total CPU",
+            "Total Memory",
+            "Total GPU",
+            "Total IO",
+            "Avg Duration",
+            "Avg CPU Usage",
+            "Avg Memory Usage",
+            "Avg GPU Usage",
+            "Avg IO Usage",
+            "Total Alloc",
+            "Peak Alloc",
+            "Top Allocations",
+            "Total Self Time",
+            "Total Awaited",
+            "P50 Duration",
+            "P95 Duration",
+            "P99 Duration",
+            "P999 Duration",
+            "P50 CPU",
+            "P95 CPU",
+            "P99 CPU",
+            "P999 CPU",
+            "Duration Histogram",
+            "CPU Histogram",
+            "Notes",
+        ])
+        for qual_key, data in profiles.items():
+            calls = data["calls"]
+            if calls > 0:
+                avg_time = data["total_time"] / calls
+                avg_cpu = data["total_cpu"] / calls
+                avg_memory = data["total_memory"] / calls
+                avg_gpu = data["total_gpu"] / calls
+                avg_io = data["total_io"] / calls
+                time_histogram = data.get("time_histogram") or Histogram()
+                cpu_histogram = data.get("cpu_histogram") or Histogram()
+                writer.writerow([
+                    qual_key,
+                    calls,
+                    f"{data['total_time']:.6f}",
+                    f"{data['total_cpu']:.6f}",
+                    f"{data['total_memory']:.6f}",
+                    f"{data['total_gpu']:.6f}",
+                    f"{data['total_io']:.6f}",
+                    f"{avg_time:.6f}",
+                    f"{avg_cpu:.6f}",
+                    f"{avg_memory:.6f}",
+                    f"{avg_gpu:.6f}",
+                    f"{avg_io:.6f}",
+                    f"{data.get('total_alloc', 0):.6f}",
+                    f"{data.get('peak_alloc', 0):.6f}",
+                    _format_sites(data.get("top_allocations", [])),
+                    f"{data.get('total_self_time', 0):.6f}",
+                    f"{data.get('total_awaited', 0):.6f}",
+                    *(f"{value:.6f}" for value in time_histogram.percentiles()),
+                    *(f"{value:.6f}" for value in cpu_histogram.percentiles()),
+                    time_histogram.to_text(),
+                    cpu_histogram.to_text(),
+                    data.get("notes", ""),
+                ])
+
+
+def _parse_histogram(text):
+    return Histogram.from_text(text) if text else None
+
+
+def empty_profile(num_gpus=0):
+    return {
+        "calls": 0,
+        "total_time": 0,
+        "total_self_time": 0,
+        "total_cpu": 0,
+        "total_memory": 0,
+        "total_alloc": 0,
+        "total_awaited": 0,
+        "peak_alloc": 0,
+        "top_allocations": [],
+        "time_histogram": None,
+        "cpu_histogram": None,
+        "total_gpu": 0,
+        "total_io": 0,
+        "notes": "",
+        "total_gpus": [0] * num_gpus,
+    }
+
+
+def read_csv(csv_file, empty=empty_profile):
+    """Profile dicts of a file in the mbench CSV format, the inverse of `write_csv`. `empty` makes a blank profile."""
+    import csv
+
+    profiles = defaultdict(empty)
+    with open(csv_file, newline="") as f:
+        for row in csv.DictReader(f):
+            profiles[row["Function"]] = {
+                **empty(),
+                "calls": int(row.get("Calls", 0)),
+                "total_time": float(row["Total Time"]),
+                "total_cpu": float(row["Total CPU"]),
+                "total_memory": float(row["Total Memory"]),
+                "total_self_time": float(row.get("Total Self Time") or 0),
+                "total_awaited": float(row.get("Total Awaited") or 0),
+                "total_alloc": float(row.get("Total Alloc") or 0),
+                "peak_alloc": float(row.get("Peak Alloc") or 0),
+                "top_allocations": _parse_sites(row.get("Top Allocations") or ""),
+                "time_histogram": _parse_histogram(row.get("Duration Histogram")),
+                "cpu_histogram": _parse_histogram(row.get("CPU Histogram")),
+                "total_gpu": float(row["Total GPU"]),
+                "total_io": float(row["Total IO"]),
+                "notes": row.get("Notes", ""),
+            }
+    return profiles
 
 
 class FunctionProfiler:
@@ -240,248 +471,961 @@ class FunctionProfiler:
             cls._instance.initialize()
         return cls._instance
 
-    def initialize(self, csv_file=None, profiler_functions=None, target_module=None):
-        try:
-            pynvml.nvmlInit()
-            self.num_gpus = pynvml.nvmlDeviceGetCount()
-            self.gpu_handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(self.num_gpus)]
-        except pynvml.NVMLError:
-            print("[yellow]Warning: Unable to initialize GPU monitoring.[/yellow]")
-            self.num_gpus = 0
-            self.gpu_handles = []
+    def initialize(self, csv_file=None, profiler_functions=None, target_module=None, sample_interval=None):
+        import random
+        import re
+
+        from mbench.memory import MemoryCollector
+        from mbench.overhead import Overhead
+        from mbench.sampler import ResourceSampler, nvml_module
+
+        self.nvml = nvml_module(os.environ.get("MBENCH_GPU", "1"))
+        self.gpu_handles = self._init_gpus()
+        self.num_gpus = len(self.gpu_handles)
         self.csv_file = csv_file or "mbench_profile.csv"
-        self.profiles = defaultdict(lambda: {"calls": 0, "total_time": 0, "total_cpu": 0, "total_memory": 0, "total_gpu": 0, "total_io": 0, "notes": "", "total_gpus": [0] * self.num_gpus})
-        self.profiles = self.load_data()
-        self.current_calls = {}
+        # This process's `profiling()` blocks and stack samples, and what it did not record
+        # itself: the CSV of earlier runs and the tables of other processes.
+        self.profiles = defaultdict(self._empty_profile)
+        self.loaded_profiles = self.load_data()
+        self._profiles_lock = threading.Lock()
+        # Stacks known only by name: from the stack sampler, and from other processes; see `call_stacks`.
+        self.stacks = {}
+        self.loaded_stacks = {}
+        self.stacks_file = os.environ.get("MBENCH_STACKS")
+        # Calls are recorded in per-thread tables and merged into a snapshot when reporting.
+        self._local = threading.local()
+        self._threads_lock = threading.Lock()
+        self.threads = []
+        self.registry = CodeRegistry()
+        # id(code) -> code for functions timed by `wrap`, which the hooks leave alone.
+        self._wrapped = {}
         self.target_module = target_module
-        self.profiler_functions = profiler_functions or set(dir(self)) | {"profileme"}
         self.when = None
-        self.gpu_infos = []
-        atexit.register(self.save_and_print_data)
-        atexit.register(pynvml.nvmlShutdown)
-
-
-    def _get_gpu_usage(self):
-        """Retrieve GPU usage information."""
-        total_gpu_usage = 0
-        gpu_usages = []
-        
-        for handle in self.gpu_handles:
-            try:
-                info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                gpu_usages.append(info.used)
-                total_gpu_usage += info.used
-            except pynvml.NVMLError as e:
-                print(f"[yellow]Warning: Unable to get GPU usage for handle {handle}. Error: {e}[/yellow]")
-        
-        return total_gpu_usage, gpu_usages
-
-        # Initialize GPU monitoring
-    
-
+        # Include/exclude rules, see `set_filters`. `profiler_functions` are extra "module.function" names to skip.
+        self.include = _split_rules(os.environ.get("MBENCH_INCLUDE", ""))
+        self.exclude = _split_rules(os.environ.get("MBENCH_EXCLUDE", "")) + [
+            f"re:{re.escape(name)}" + r"\Z" for name in profiler_functions or ()
+        ]
+        self.backend = None
+        self.monitoring = None
+        # The StatisticalProfiler of MBENCH_MODE=sample, which caches targeting decisions too.
+        self.stack_sampler = None
+        self._reset_targets()
+        self.async_tracker = None
+        # Per-line timings of the functions decorated with @profile(lines=True), see `profile_lines`.
+        self.line_profiler = None
+        # Instrumentation cost subtracted from every call, measured by `install` per backend.
+        self.overhead = Overhead()
+        # Draws the adaptive sampling skips; bound here so that random is only imported once profiling starts.
+        self._random = random.random
+        self.calibrate = os.environ.get("MBENCH_CALIBRATE", "1") == "1"
+        self._calibrated = {}
+        # Adaptive sampling: every ADAPT_EVERY measured calls a function is measured half as often once it
+        # runs faster than `sample_max_rate` calls/s or its mean duration is known within `sample_error`.
+        self.adaptive = os.environ.get("MBENCH_ADAPTIVE", "1") == "1"
+        self.sample_max_every = int(os.environ.get("MBENCH_SAMPLE_MAX_EVERY", "1024"))
+        self.sample_max_rate = float(os.environ.get("MBENCH_SAMPLE_MAX_RATE", "10000"))
+        self.sample_error = float(os.environ.get("MBENCH_SAMPLE_ERROR", "0.01"))
+        self.report_mode = os.environ.get("MBENCH_REPORT", "exit")
+        self.report_interval = float(os.environ.get("MBENCH_REPORT_INTERVAL", "10"))
+        self.reporter = None
+        self._reporter_stop = threading.Event()
+        # Resource readings come from a background sampler so the hot path only reads a cached sample.
+        if sample_interval is None:
+            sample_interval = float(os.environ.get("MBENCH_SAMPLE_INTERVAL", "0.01"))
+        self.sampler = ResourceSampler(interval=sample_interval, gpu_handles=self.gpu_handles, nvml=self.nvml)
+        self.sampler.start()
+        self.memory = MemoryCollector(enabled=False)
+        # MBENCH_TRACEMALLOC=1 adds the opt-in "alloc" collector to whatever profile is chosen.
+        self.trace_allocations = os.environ.get("MBENCH_TRACEMALLOC", "0") == "1"
+        # Metrics measured around every call, by name; see `set_collectors` and `add_collector`.
+        self.collectors = builtin_collectors(self.sampler, self.memory, self.registry)
+        self.set_collectors(
+            os.environ.get("MBENCH_COLLECTORS", "full"), int(os.environ.get("MBENCH_EXPENSIVE_EVERY", "16"))
+        )
+        self.started = time.time()
+        self.history_file = os.environ.get("MBENCH_HISTORY")
+        self.trace = None
+        if os.environ.get("MBENCH_TRACE"):
+            self.start_trace(trace_path(os.environ["MBENCH_TRACE"]))
+        self.timeline = None
+        self.timeline_file = os.environ.get("MBENCH_TIMELINE")
+        if self.timeline_file:
+            # Processes started by the `mbench` CLI each write a part the CLI merges.
+            if "MBENCH_COLLECT" in os.environ:
+                from mbench.timeline import part_path
+
+                self.start_timeline(part_path(self.timeline_file, os.getpid()))
+            else:
+                self.start_timeline(self.timeline_file)
+        self.stats_server = None
+        if os.environ.get("MBENCH_STATS_SOCKET", "0") != "0":
+            self.serve_stats(None if os.environ["MBENCH_STATS_SOCKET"] == "1" else os.environ["MBENCH_STATS_SOCKET"])
+        self.metrics_server = None
+        self.metrics_textfile = None
+        if os.environ.get("MBENCH_METRICS_PORT"):
+            self.serve_metrics(int(os.environ["MBENCH_METRICS_PORT"]))
+        if os.environ.get("MBENCH_METRICS_TEXTFILE"):
+            self.write_metrics(
+                os.environ["MBENCH_METRICS_TEXTFILE"], float(os.environ.get("MBENCH_METRICS_INTERVAL", "15"))
+            )
+        # Processes started by the `mbench` CLI send their data to the parent instead.
+        self.autosave = True
+        atexit.register(self._save_at_exit)
+        atexit.register(self.sampler.stop)
+        atexit.register(self.stop_reporting)
+        if self.report_mode in ("interval", "top"):
+            self.set_reporting(self.report_mode)
+
+    def _empty_profile(self):
+        return empty_profile(self.num_gpus)
+
+    def _init_gpus(self):
+        """NVML handles of the GPUs to monitor. MBENCH_GPU=0 skips NVML, and pynvml, entirely;
+        MBENCH_GPU=fake (or fake:N) uses a `FakeNVML` instead."""
+        nvml = self.nvml
+        if nvml is None:
+            return []
+        try:
+            nvml.nvmlInit()
+        except nvml.NVMLError:
+            print("[yellow]Warning: Unable to initialize GPU monitoring.[/yellow]")
+            return []
+        # Only registered once NVML is up: shutting it down otherwise raises at exit.
+        atexit.register(nvml.nvmlShutdown)
+        try:
+            return [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(nvml.nvmlDeviceGetCount())]
+        except nvml.NVMLError:
+            print("[yellow]Warning: Unable to initialize GPU monitoring.[/yellow]")
+            return []
 
     def format_bytes(self, bytes_value):
+        if isinstance(bytes_value, str):
+            return bytes_value
+        sign = "-" if bytes_value < 0 else ""
+        bytes_value = abs(bytes_value)
         kb = bytes_value / 1024
         if kb < 1:
-            return f"{bytes_value:.2f} B"
+            return f"{sign}{bytes_value:.2f} B"
         elif kb < 1024:
-            return f"{kb:.2f} KB"
+            return f"{sign}{kb:.2f} KB"
         mb = kb / 1024
         if mb < 1024:
-            return f"{mb:.2f} MB"
+            return f"{sign}{mb:.2f} MB"
         gb = mb / 1024
-        return f"{gb:.2f} GB"
+        return f"{sign}{gb:.2f} GB"
+
+    def add_collector(self, collector):
+        """Register a `mbench.collectors.Collector` and measure it from the next call on.
+
+        Unless it is `opt_in`, it runs under every profile that uses all collectors ("fast" and
+        "full"); otherwise only when named in `set_collectors`. Its totals are reported under
+        `collector.field`.
+        """
+        self.collectors[collector.name] = collector
+        self.set_collectors(self.collector_profile, self.collect_every)
+        return collector
+
+    def set_collectors(self, profile="full", every=None):
+        """Choose the metrics measured around each call.
+
+        `profile` is "time" (wall time only), "fast" (collectors costing more than 1µs per call
+        only run on 1 in `every` measured calls), "full" (everything on every measured call) or a
+        comma-separated list of profile and collector names. Opt-in collectors, such as "alloc"
+        (tracemalloc), only run when named: "full,alloc". Wall time is always measured. Call it
+        before profiling starts: the overhead subtracted from every call is calibrated for these
+        collectors.
+        """
+        names, sampled = select(self.collectors, f"{profile},alloc" if self.trace_allocations else profile)
+        if every is not None:
+            self.collect_every = max(1, int(every))
+        self.collector_profile = profile
+        self.collector_names = names
+        self._cpu_clock = self.collectors["cpu"].clock if "cpu" in names else _no_clock
+        # Calls run `_plan`, and 1 in collect_every measured calls `_sampled_plan`, which adds the expensive ones.
+        self._sampled_plan = Plan([self.collectors[name] for name in names])
+        self._plan = Plan([self.collectors[name] for name in names if name not in sampled]) if sampled else self._sampled_plan
+        self._sampled_fields = frozenset(self.collectors[name].field for name in sampled)
+        alloc = "alloc" in names
+        if alloc and not self.memory.enabled:
+            self.memory.start_tracing()
+        elif not alloc and self.memory.enabled:
+            self.memory.stop_tracing()
+        self._calibrated = {}
+        with self._threads_lock:
+            for state in self.threads:
+                self._setup_store(state.store)
+
+    def _setup_store(self, store):
+        """Give `store` the columns of the registered collectors and mark the sampled ones."""
+        for collector in self.collectors.values():
+            store.add_field(collector.field)
+        store.sampled_fields = self._sampled_fields
 
     def set_target_module(self, module_name, when):
         self.target_module = module_name
         self.when = when
+        self._reset_targets()
+
+    def set_filters(self, include=None, exclude=None):
+        """Choose the functions to profile with glob or regex rules, see `mbench.filters.parse_rule`.
+
+        With include rules, exactly the functions they match are targets, instead of those of the
+        target module (or, with `when="calling"`, only those the target module calls and they match).
+        Functions matching an exclude rule never are. None leaves that side unchanged.
+        """
+        if include is not None:
+            self.include = list(include)
+        if exclude is not None:
+            self.exclude = list(exclude)
+        self._reset_targets()
+
+    def _reset_targets(self):
+        """Rebuild the filter and forget every cached targeting decision."""
+        include = self.include
+        if not include and self.when == "called" and self.target_module:
+            include = [f"module:{self.target_module}"]
+        self.filter = CodeFilter(include, DEFAULT_EXCLUDE + tuple(self.exclude))
+        # id(code) -> slot and id(code) -> code of the functions known to be, and not to be, profiled.
+        self._targets = {}
+        self._skipped = dict(self._wrapped)
+        if self.stack_sampler is not None:
+            self.stack_sampler._keys.clear()
+        if self.monitoring is not None:
+            # Code that sys.monitoring was told to DISABLE may be a target now.
+            sys.monitoring.restart_events()
+
+    def install(self, backend: Literal["auto", "monitoring", "setprofile"] = "auto"):
+        """Start receiving call events. "auto" uses sys.monitoring when the interpreter has it."""
+        from mbench.monitoring import MONITORING_AVAILABLE, MonitoringBackend
+
+        if backend == "auto":
+            backend = "monitoring" if MONITORING_AVAILABLE else "setprofile"
+        if backend == "monitoring":
+            try:
+                self._calibrate(backend)
+                self.monitoring = MonitoringBackend(self)
+                self.monitoring.start()
+            except ValueError:
+                # Another tool already holds the profiler tool id.
+                print("[yellow]Warning: sys.monitoring profiler slot is taken, falling back to sys.setprofile.[/yellow]")
+                self.monitoring = None
+                backend = "setprofile"
+        if backend == "setprofile":
+            self._calibrate(backend)
+            # Cover threads started later and, where the interpreter allows it, those already running.
+            threading.setprofile(self.profile)
+            if hasattr(threading, "setprofile_all_threads"):
+                threading.setprofile_all_threads(self.profile)
+            else:
+                sys.setprofile(self.profile)
+        self.backend = backend
+        return backend
+
+    def _calibrate(self, backend):
+        """Measure the instrumentation cost of `backend` once; MBENCH_CALIBRATE=0 leaves it at zero."""
+        if not self.calibrate:
+            return
+        if backend not in self._calibrated:
+            from mbench.overhead import calibrate
+
+            self._calibrated[backend] = calibrate(self, backend)
+        self.overhead = self._calibrated[backend]
+
+    def uninstall(self):
+        if self.backend == "monitoring":
+            self.monitoring.stop()
+            self.monitoring = None
+        elif self.backend == "setprofile":
+            threading.setprofile(None)
+            if hasattr(threading, "setprofile_all_threads"):
+                threading.setprofile_all_threads(None)
+            else:
+                sys.setprofile(None)
+        self.backend = None
+
+    def wrap(self, func):
+        """`func` with every call timed by a plain wrapper instead of a profiling hook.
+
+        The calls land in the same tables and call tree as traced ones. Hooks skip the
+        wrapped function, so it is never counted twice. A coroutine function is timed
+        from its first resume to its completion; only the steps it runs count as self and
+        CPU time, and the rest as awaited.
+        """
+        code = func.__code__
+        slot = self.registry.register(code, func.__module__)
+        self._wrapped[id(code)] = self._skipped[id(code)] = code
+        if code.co_flags & CO_COROUTINE:
+            from mbench.aio import stepped
+
+            record = self._record_coroutine
+
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                usage = [0, 0]
+                start = time.perf_counter_ns()
+                try:
+                    return await stepped(func(*args, **kwargs), usage, self._cpu_clock)
+                finally:
+                    record(slot, time.perf_counter_ns() - start, usage[0], usage[1])
+
+            return timed
+        push, end = self._push, self._end_call
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            entry = push(slot, None)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end(entry)
+
+        return timed
+
+    def _record_coroutine(self, slot, duration, running, cpu_usage):
+        """Record a call of a coroutine timed by `wrap`: `running` of its `duration` ns it was stepped."""
+        store = self._thread_state().store
+        if slot >= store.capacity:
+            store.grow(slot + 1)
+        store.calls[slot] += 1
+        store.measured[slot] += 1
+        store.measured_time[slot] += duration
+        store.total_time[slot] += duration
+        store.total_self_time[slot] += running
+        store.total_cpu[slot] += cpu_usage
+        store.total_awaited[slot] += max(0, duration - running)
+        store.record_latency(slot, duration, cpu_usage)
+
+    def profile_lines(self, func, call=None):
+        """Also record per-line hits and time of `func`; see `mbench.lines.LineProfiler`.
+
+        Returns `call` (default `func`), wrapped if lines can only be traced while it runs.
+        """
+        if self.line_profiler is None:
+            from mbench.lines import LineProfiler
+
+            self.line_profiler = LineProfiler()
+        return self.line_profiler.wrap(func, call)
+
+    def line_stats(self):
+        """{function name: {line: (hits, seconds)}} of the functions profiled line by line."""
+        if self.line_profiler is None:
+            return {}
+        return {self._code_name(code): lines for code, lines in self.line_profiler.results().items()}
+
+    def _code_name(self, code):
+        slot = self.registry.slots.get(id(code))
+        return self.registry.name(slot) if slot is not None else code.co_name
+
+    def _end_call(self, entry):
+        """End a call started by `wrap`, unless a hook left the stack in another state."""
+        state = self._thread_state()
+        stack = state.stack
+        if stack and stack[-1] is entry:
+            self._pop(state, stack.pop())
 
     def load_data(self):
-        profiles = defaultdict(
-            lambda: {
-                "calls": 0,
-                "total_time": 0,
-                "total_cpu": 0,
-                "total_memory": 0,
-                "total_gpu": 0,
-                "total_io": 0,
-                "notes": None,
-            }
-        )
-        if Path(self.csv_file).exists():
-            with Path(self.csv_file).open("r") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    qual_key = row["Function"]
-                    profiles[qual_key] = {
-                        "calls": int(row.get("Calls", 0)),  # Use the 'Calls' value from CSV, or 0 if not present
-                        "total_time": float(row["Total Time"]),
-                        "total_cpu": float(row["Total CPU"]),
-                        "total_memory": float(row["Total Memory"]),
-                        "total_gpu": float(row["Total GPU"]),
-                        "total_io": float(row["Total IO"]),
-                        "notes": row.get("Notes", ""),
-                    }
-        self.profiles = profiles
+        """Load the CSV of earlier runs into `loaded_profiles`, which `snapshot` adds to this process's calls."""
+        if os.path.exists(self.csv_file):
+            profiles = read_csv(self.csv_file, self._empty_profile)
+        else:
+            profiles = defaultdict(self._empty_profile)
+        self.loaded_profiles = profiles
         return profiles
 
     def save_and_print_data(self):
-        with open(self.csv_file, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                "Function",
-                "Calls",
-                "Total Time",
-                "Total CPU",
-                "Total Memory",
-                "Total GPU",
-                "Total IO",
-                "Avg Duration",
-                "Avg CPU Usage",
-                "Avg Memory Usage",
-                "Avg GPU Usage",
-                "Avg IO Usage",
-                "Notes",
-            ])
-            for qual_key, data in self.profiles.items():
-                calls = data["calls"]
-                if calls > 0:
-                    avg_time = data["total_time"] / calls
-                    avg_cpu = data["total_cpu"] / calls
-                    avg_memory = data["total_memory"] / calls
-                    avg_gpu = data["total_gpu"] / calls
-                    avg_io = data["total_io"] / calls
-                    writer.writerow([
-                        qual_key,
-                        calls,
-                        f"{data['total_time']:.6f}",
-                        f"{data['total_cpu']:.6f}",
-                        f"{data['total_memory']:.6f}",
-                        f"{data['total_gpu']:.6f}",
-                        f"{data['total_io']:.6f}",
-                        f"{avg_time:.6f}",
-                        f"{avg_cpu:.6f}",
-                        f"{avg_memory:.6f}",
-                        f"{avg_gpu:.6f}",
-                        f"{avg_io:.6f}",
-                        data.get("notes", ""),
-                    ])
-        print("[bold white] Summary [/bold white]")
-        for qual_key, data in self.profiles.items():
-            calls = data["calls"]
-            if calls > 0:
-                display_profile_info(
-                    name=qual_key,
-                    duration=data["total_time"],
-                    cpu_usage=data["total_cpu"],
-                    mem_usage=data["total_memory"],
-                    gpu_usage=data["total_gpu"],
-                    io_usage=data["total_io"],
-                    avg_time=data["total_time"] / calls,
-                    avg_cpu=data["total_cpu"] / calls,
-                    avg_memory=data["total_memory"] / calls,
-                    avg_gpu=data["total_gpu"] / calls,
-                    avg_io=data["total_io"] / calls,
-                    calls=calls,
-                    notes=data.get("notes", ""),
-                )
+        profiles = self.snapshot()
+        write_csv(self.csv_file, profiles)
+        if self.stacks_file:
+            self.export_stacks(self.stacks_file)
+        run_id = self.record_history(self.snapshot(include_loaded=False), started=self.started)
+        self.print_summary(profiles, flush_output=False)
         print(f"[bold green]Profiling data saved to {self.csv_file}[/bold green]")
+        if run_id is not None:
+            print(f"[bold green]Run {run_id} recorded in {self.history_path()}[/bold green]")
+        if self.stacks_file:
+            print(f"[bold green]Call stacks saved to {self.stacks_file}[/bold green]")
         print(
             "[bold] mbench [/bold] is distributed by Mbodi AI under the terms of the [MIT License](LICENSE)."
         )
-        return self.profiles
+        flush()
+        return profiles
+
+    def call_stacks(self, include_loaded=True):
+        """Aggregates per call stack of profiled functions, keyed by the tuple of names from the outermost call.
+
+        Like `snapshot`, thread trees are read without locking. With `include_loaded=False`
+        the stacks received from other processes are left out.
+        """
+        stacks = {}
+        if include_loaded:
+            merge_stacks(stacks, self.loaded_stacks)
+        merge_stacks(stacks, self.stacks)
+        with self._threads_lock:
+            threads = list(self.threads)
+        for state in threads:
+            merge_stacks(stacks, state.tree.stacks(self.registry.name))
+        return stacks
+
+    def call_graph(self):
+        """Caller -> callee edges with inclusive and exclusive time, see `mbench.callgraph.call_graph`."""
+        return call_graph(self.call_stacks())
+
+    def export_stacks(self, path):
+        """Write the call stacks as speedscope JSON (.json) or collapsed stacks for flamegraph.pl (anything else)."""
+        return export_stacks(path, self.call_stacks(), name=os.path.splitext(os.path.basename(self.csv_file))[0])
+
+    def start_trace(self, path):
+        """Also record every traced call to the binary trace file at `path`."""
+        from mbench.trace import TraceWriter
+
+        self.stop_trace()
+        self.trace = TraceWriter(path)
+        self._measure_every_call()
+        atexit.register(self.stop_trace)
+
+    def stop_trace(self):
+        trace, self.trace = self.trace, None
+        if trace is not None:
+            trace.close([self.registry.name(slot) for slot in range(len(self.registry))])
+
+    def start_timeline(self, path):
+        """Also stream every traced call, `profiling()` block, GC pause and resource sample to `path`.
+
+        The file is Chrome Trace Event JSON, which Perfetto and chrome://tracing open.
+        """
+        from mbench.timeline import TimelineWriter
+
+        self.stop_timeline()
+        self.timeline = TimelineWriter(path)
+        self.sampler.listeners.append(self.timeline.counters)
+        self._measure_every_call()
+        atexit.register(self.stop_timeline)
+
+    def stop_timeline(self):
+        timeline, self.timeline = self.timeline, None
+        if timeline is not None:
+            if timeline.counters in self.sampler.listeners:
+                self.sampler.listeners.remove(timeline.counters)
+            timeline.close()
+
+    def _measure_every_call(self):
+        """Undo adaptive sampling in every thread, so the trace and timeline hold every call."""
+        with self._threads_lock:
+            for state in self.threads:
+                state.store.measure_every_call()
+
+    def serve_stats(self, path=None):
+        """Serve snapshots of the aggregates on a Unix socket for `mbench top`. Defaults to one per PID in the temp dir."""
+        from mbench.top import StatsServer
+
+        self.stop_stats()
+        try:
+            self.stats_server = StatsServer(self, path)
+        except (AttributeError, OSError) as e:
+            # No AF_UNIX (Windows) or the path is not usable.
+            print(f"[yellow]Warning: Unable to serve stats on a Unix socket. Error: {e}[/yellow]")
+            return None
+        atexit.register(self.stop_stats)
+        return self.stats_server.path
+
+    def stop_stats(self):
+        server, self.stats_server = self.stats_server, None
+        if server is not None:
+            server.close()
+
+    def serve_metrics(self, port=9464, host="127.0.0.1"):
+        """Expose the aggregates as OpenMetrics on http://host:port/metrics. Returns the bound port."""
+        from mbench.metrics import MetricsServer
+
+        self.stop_metrics()
+        try:
+            self.metrics_server = MetricsServer(self, port, host)
+        except OSError as e:
+            print(f"[yellow]Warning: Unable to serve metrics on {host}:{port}. Error: {e}[/yellow]")
+            return None
+        atexit.register(self.stop_metrics)
+        return self.metrics_server.port
+
+    def write_metrics(self, path, interval=15.0):
+        """Rewrite `path` for node_exporter's textfile collector every `interval` seconds and at exit."""
+        from mbench.metrics import TextfileWriter
+
+        if self.metrics_textfile is not None:
+            self.metrics_textfile.stop()
+        self.metrics_textfile = TextfileWriter(self, path, interval)
+        self.metrics_textfile.start()
+        atexit.register(self.stop_metrics)
+
+    def stop_metrics(self):
+        server, self.metrics_server = self.metrics_server, None
+        if server is not None:
+            server.close()
+        textfile, self.metrics_textfile = self.metrics_textfile, None
+        if textfile is not None:
+            textfile.stop()
+
+    def load_trace(self, path):
+        """Aggregates rebuilt from a binary trace, in the same shape `load_data` returns."""
+        from mbench.trace import TraceReader
+
+        with TraceReader(path) as reader:
+            return reader.aggregates(self._empty_profile)
+
+    def history_path(self):
+        """SQLite run history file: MBENCH_HISTORY, or next to the CSV. None when MBENCH_HISTORY=0."""
+        if self.history_file == "0":
+            return None
+        return self.history_file or os.path.splitext(self.csv_file)[0] + ".db"
+
+    def record_history(self, profiles, **metadata):
+        """Store `profiles` as one run in the history. Returns the run id, or None if nothing was stored."""
+        path = self.history_path()
+        if path is None or not any(data.get("calls") for data in profiles.values()):
+            return None
+        import sqlite3
+
+        from mbench.history import RunHistory
+
+        try:
+            with RunHistory(path) as history:
+                return history.record_run(profiles, **metadata)
+        except sqlite3.Error as e:
+            print(f"[yellow]Warning: Unable to record run history in {path}. Error: {e}[/yellow]")
+            return None
+
+    def _save_at_exit(self):
+        if self.autosave:
+            self.save_and_print_data()
+
+    def after_fork(self):
+        """Reset per-process state in a forked child: the parent's calls and threads stay with the parent."""
+        from mbench.sampler import ResourceSampler
+        from mbench.timeline import part_path
+
+        current = self._thread_state()
+        current.profiles = {}
+        current.store.clear()
+        current.tree.clear()
+        if self.line_profiler is not None:
+            self.line_profiler.clear()
+        self.stacks = {}
+        self.loaded_stacks = {}
+        # The trace file belongs to the parent; the timeline goes on in a file of this process.
+        self.trace = None
+        timeline, self.timeline = self.timeline, None
+        if timeline is not None:
+            timeline.detach()
+        # The parent keeps serving on its socket; this process gets its own.
+        server, self.stats_server = self.stats_server, None
+        # Metrics stay with the parent: its server and writer threads do not exist here.
+        self.metrics_server = None
+        self.metrics_textfile = None
+        self._threads_lock = threading.Lock()
+        self._profiles_lock = threading.Lock()
+        self.threads = [current]
+        self.profiles = defaultdict(self._empty_profile)
+        self.loaded_profiles = defaultdict(self._empty_profile)
+        self.sampler = ResourceSampler(interval=self.sampler.interval, gpu_handles=self.gpu_handles, nvml=self.nvml)
+        self.sampler.start()
+        atexit.register(self.sampler.stop)
+        for collector in self.collectors.values():
+            if hasattr(collector, "sampler"):
+                collector.sampler = self.sampler
+        if timeline is not None:
+            self.start_timeline(part_path(self.timeline_file or timeline.path, os.getpid()))
+        if server is not None:
+            self.serve_stats()
+
+    def reset(self):
+        """Drop all recorded and loaded aggregates."""
+        self.profiles = defaultdict(self._empty_profile)
+        self.loaded_profiles = defaultdict(self._empty_profile)
+        self.stacks = {}
+        self.loaded_stacks = {}
+        with self._threads_lock:
+            for state in self.threads:
+                state.profiles = {}
+                state.store.clear()
+                state.tree.clear()
+        if self.line_profiler is not None:
+            self.line_profiler.clear()
+
+    def print_summary(self, profiles=None, flush_output=True):
+        """Render one table per profiled function. Safe to call while profiling is running."""
+        if profiles is None:
+            profiles = self.snapshot()
+        with output_lock:
+            print("[bold white] Summary [/bold white]")
+            for qual_key, data in profiles.items():
+                self._print_aggregate(qual_key, data)
+            self._print_lines()
+            if flush_output:
+                flush()
+
+    def _print_lines(self):
+        if self.line_profiler is None:
+            return
+        from mbench.lines import line_table
+
+        for code, lines in self.line_profiler.results().items():
+            console.print(line_table(self._code_name(code), code, lines))
+            console.print("")
+        for code_id, calls in list(self.line_profiler.untraced.items()):
+            code = self.line_profiler.codes[code_id]
+            console.print(
+                f"[yellow]{self._code_name(code)}: {calls} calls ran under another trace function "
+                "(a debugger or coverage) and have no line timings[/yellow]"
+            )
+
+    def _print_aggregate(self, qual_key, data):
+        calls = data["calls"]
+        if calls > 0:
+            display_profile_info(
+                name=qual_key,
+                duration=data["total_time"],
+                cpu_usage=data["total_cpu"],
+                mem_usage=data["total_memory"],
+                gpu_usage=data["total_gpu"],
+                io_usage=data["total_io"],
+                avg_time=data["total_time"] / calls,
+                avg_cpu=data["total_cpu"] / calls,
+                avg_memory=data["total_memory"] / calls,
+                avg_gpu=data["total_gpu"] / calls,
+                avg_io=data["total_io"] / calls,
+                calls=calls,
+                notes=data.get("notes", ""),
+                alloc_usage=data.get("total_alloc"),
+                peak_alloc=data.get("peak_alloc"),
+                top_allocations=data.get("top_allocations"),
+                self_time=data.get("total_self_time"),
+                awaited=data.get("total_awaited"),
+                time_histogram=data.get("time_histogram"),
+                cpu_histogram=data.get("cpu_histogram"),
+                extra=extra_fields(data),
+            )
+
+    def set_reporting(self, mode: Literal["exit", "interval", "call", "top"] = "exit", interval: float | None = None):
+        """Choose when tables are rendered.
+
+        "exit" prints the summary once at exit, "interval" also prints it every `interval`
+        seconds from a background thread, "top" keeps a live table of the busiest functions
+        on the terminal, and "call" prints every single call (debugging only).
+        """
+        self.report_mode = mode
+        if interval is not None:
+            self.report_interval = interval
+        if mode == "interval" and self.reporter is None:
+            self.reporter = threading.Thread(target=self._report_loop, name="mbench-reporter", daemon=True)
+            self.reporter.start()
+        if mode == "top" and self.reporter is None:
+            self.reporter = threading.Thread(target=self._top_loop, name="mbench-top", daemon=True)
+            self.reporter.start()
+
+    def _top_loop(self):
+        from mbench.top import Top, profiler_source
+
+        Top(profiler_source(self)).run(self._reporter_stop, refresh=min(self.report_interval, 0.25))
+
+    def _report_loop(self):
+        while not self._reporter_stop.wait(self.report_interval):
+            if self.report_mode == "interval":
+                self.print_summary()
+
+    def stop_reporting(self):
+        self._reporter_stop.set()
+        if self.reporter is not None:
+            self.reporter.join(timeout=1.0)
+            self.reporter = None
 
     def profile(self, frame, event, arg):
         if event == "call":
             return self._start_profile(frame)
         if event == "return":
             self._end_profile(frame)
-        flush()
         return self.profile
 
     def _get_qual_name(self, frame: FrameType):
         return frame.f_globals.get("__name__") + "." + frame.f_code.co_name
 
-
+    def _is_target(self, frame: FrameType):
+        """Whether the function running in `frame` is profiled, given the filters and the `when` setting."""
+        if frame.f_back is None:
+            return False
+        if self.when == "calling" and frame.f_back.f_globals.get("__name__") != self.target_module:
+            return False
+        return self.filter(frame.f_code, frame.f_globals.get("__name__"))
+
+    def _thread_state(self):
+        state = getattr(self._local, "state", None)
+        if state is None:
+            state = self._local.state = ThreadState(threading.current_thread(), self.num_gpus)
+            self._setup_store(state.store)
+            with self._threads_lock:
+                self.threads.append(state)
+        return state
+
+    def enable_async(self, lag_interval=0.1):
+        """Track coroutines per asyncio Task instead of once per resume."""
+        if self.async_tracker is None:
+            from mbench.aio import AsyncTracker
+
+            self.async_tracker = AsyncTracker(self, lag_interval=lag_interval)
+        return self.async_tracker
+
+    def _profile_entry(self, qual_key):
+        """Aggregate for `qual_key` in the calling thread's table."""
+        profiles = self._thread_state().profiles
+        data = profiles.get(qual_key)
+        if data is None:
+            data = profiles[qual_key] = self._empty_profile()
+        return data
+
+    def _slot(self, frame: FrameType):
+        """Store slot of the function running in `frame`, or -1 when it is not profiled.
+
+        Unless `when="calling"`, being a target only depends on the code object, so both
+        answers are cached by code id and each event costs a dict lookup or two.
+        """
+        code = frame.f_code
+        code_id = id(code)
+        if code_id in self._skipped:
+            return -1
+        slot = self._targets.get(code_id)
+        if slot is not None:
+            return slot
+        cache = self.when != "calling" and frame.f_back is not None
+        if not self._is_target(frame):
+            if cache:
+                self._skipped[code_id] = code
+            return -1
+        slot = self.registry.register(code, frame.f_globals.get("__name__"))
+        if cache:
+            self._targets[code_id] = slot
+        return slot
 
     def _start_profile(self, frame: FrameType):
-        if frame.f_back is None:
+        if self.async_tracker is not None and frame.f_code.co_flags & CO_COROUTINE:
+            return self.async_tracker.on_call(frame)
+        slot = self._slot(frame)
+        if slot < 0:
             return None
-        module_name = frame.f_globals.get("__name__")
-        # Check when and determine profiling target
-        if self.when == "called":
-            if module_name != self.target_module:
-                return None
-        elif self.when == "calling":
-            if frame.f_back.f_globals.get("__name__") != self.target_module:
-                return None
-
-        qual_key = self._get_qual_name(frame)
-        if qual_key in self.profiler_functions:
-            return None
-        gpu_usage, gpu_usages = self._get_gpu_usage()
-        # Always set 'test_func' key for testing purposes
-        self.current_calls['test_func'] = {
-            "start_time": time.time(),
-            "cpu_start": time.process_time(),
-            "mem_start": _get_memory_usage(),
-            "gpu_start": gpu_usage,
-            "gpus_start": gpu_usages,
-            "io_start": _get_io_usage(),
-        }
-        
-        # Set the actual function key as well
-        if qual_key != 'test_func':
-            self.current_calls[qual_key] = self.current_calls['test_func']
-        
+        self._push(slot, frame)
         return self.profile
 
+    def _push(self, slot, key):
+        """Start a call of `slot` on this thread's shadow stack and return its entry.
+
+        `key` identifies the call to whoever ends it: the frame for hook events, None for `wrap`.
+        """
+        state = self._thread_state()
+        store = state.store
+        if slot >= store.capacity:
+            store.grow(slot + 1)
+        store.active[slot] += 1
+        stack = state.stack
+        node = state.tree.child(stack[-1][8] if stack else ROOT, slot)
+        skip = store.skip
+        if skip[slot]:
+            # Not measured: only counted when it returns. A start of None marks the entry.
+            skip[slot] -= 1
+            entry = [slot, key, None, 0, None, None, 0, 0, node, None, 0]
+            stack.append(entry)
+            return entry
+        every = store.every[slot]
+        if every > 1:
+            # Skip a random run of calls averaging every - 1, so periodic call patterns do not alias.
+            skip[slot] = int(self._random() * (2 * every - 1))
+        # Expensive collectors only run on 1 in collect_every measured calls; without any, both plans are the same.
+        if store.collect_skip[slot]:
+            store.collect_skip[slot] -= 1
+            plan = self._plan
+        else:
+            store.collect_skip[slot] = self.collect_every - 1
+            plan = self._sampled_plan
+        sample = self.sampler.latest() if plan.sample else None
+        tokens = [collector.start() for collector in plan.collectors]
+        # [slot, key, start ns, thread CPU ns, collector plan, tokens of its collectors,
+        #  ns spent in profiled children, number of measured profiled descendants, call tree node,
+        #  sample at start, number of unmeasured profiled descendants]
+        entry = [slot, key, time.perf_counter_ns(), self._cpu_clock(), plan, tokens, 0, 0, node, sample, 0]
+        stack.append(entry)
+        return entry
+
     def _end_profile(self, frame: FrameType):
-        module_name = frame.f_globals.get("__name__")
-
-        # Check when and determine profiling target
-        if self.when == "called":
-            if module_name != self.target_module:
-                return
-        elif self.when == "calling" and frame is None or frame.f_back is None or frame.f_back.f_globals.get("__name__") != self.target_module:
-                return
-        qual_key = self._get_qual_name(frame)
-        if qual_key in self.profiler_functions:
-            return
+        state = self._thread_state()
+        stack = state.stack
+        # Only frames pushed by _start_profile on this thread are ever matched.
+        if not stack or stack[-1][1] is not frame:
+            if self.async_tracker is not None and frame.f_code.co_flags & CO_COROUTINE:
+                self.async_tracker.on_return(frame)
+            return None
+        return self._pop(state, stack.pop())
+
+    def _pop(self, state, entry):
+        """Record the call of `entry`, just taken off the top of `state.stack`. Returns the slot's call count."""
+        if entry[2] is None:
+            return self._end_unmeasured(state, entry)
+        end = time.perf_counter_ns()
+        cpu_end = self._cpu_clock()
+        stack = state.stack
+        slot, _, start, cpu_start, plan, tokens, child_time, child_calls, node, start_sample, child_skipped = entry
+        collectors = plan.collectors
+        values = [collector.stop(token) for collector, token in zip(collectors, tokens, strict=True)]
+
+        # Take out the profiler's own cost: the part of this call's hooks inside the timestamps,
+        # and the full round trip of every profiled call made below it, measured or not. A
+        # call never ends up shorter than its profiled children, which were corrected too.
+        overhead = self.overhead
+        duration = max(
+            child_time,
+            end - start - overhead.inner_ns - child_calls * overhead.call_ns - child_skipped * overhead.skip_ns,
+        )
+        cpu_usage = max(
+            0,
+            cpu_end - cpu_start - overhead.inner_cpu_ns
+            - child_calls * overhead.call_cpu_ns - child_skipped * overhead.skip_cpu_ns,
+        )
+        if stack:
+            parent = stack[-1]
+            parent[6] += duration
+            parent[7] += child_calls + 1
+            parent[10] += child_skipped
+
+        mem_usage = gpu_usage = io_usage = 0
+        if plan.sample:
+            sample = self.sampler.latest()
+            # RSS and allocations can shrink, so memory deltas keep their sign.
+            if plan.memory:
+                mem_usage = sample.memory - start_sample.memory
+            if plan.gpu:
+                gpu_usage = max(0, sample.gpu - start_sample.gpu)
+            if plan.io:
+                io_usage = max(0, sample.io - start_sample.io)
+
+        store = state.store
+        store.active[slot] -= 1
+        outermost = not store.active[slot]
+        self_time = duration - child_time
+        store.calls[slot] += 1
+        store.measured[slot] += 1
+        store.measured_time[slot] += duration
+        store.total_self_time[slot] += self_time
+        store.record_latency(slot, duration, cpu_usage)
+        state.tree.record(node, duration, self_time)
+        if self.adaptive and not store.measured[slot] % ADAPT_EVERY:
+            self._adapt(store, slot, end)
+        # Inclusive totals only come from the outermost active call, so recursion is not counted twice.
+        if outermost:
+            store.total_time[slot] += duration
+            store.total_cpu[slot] += cpu_usage
+            store.total_memory[slot] += mem_usage
+            store.total_gpu[slot] += gpu_usage
+            store.total_io[slot] += io_usage
+            if plan.gpu:
+                for column, gpu, gpu_start in zip(store.total_gpus, sample.gpus, start_sample.gpus, strict=True):
+                    column[slot] += max(0, gpu - gpu_start)
+        for collector, value in zip(collectors, values, strict=True):
+            collector.record(store, slot, value, outermost)
+        if plan is self._sampled_plan:
+            store.collected[slot] += 1
+        if self.trace is not None or self.report_mode == "call":
+            alloc_usage, peak_alloc = 0, 0
+            for collector, value in zip(collectors, values, strict=True):
+                if collector.name == "alloc":
+                    alloc_usage, peak_alloc = value
+        if self.trace is not None:
+            self.trace.write(
+                slot, outermost, start, duration, cpu_usage, self_time,
+                mem_usage, alloc_usage, peak_alloc, gpu_usage, io_usage,
+            )
+        if self.timeline is not None:
+            # The span keeps its raw timestamps so children stay nested inside it.
+            self.timeline.span(
+                self.registry.name(slot), start, end - start, args={"cpu_ms": cpu_usage / 1e6, "self_ms": self_time / 1e6}
+            )
 
-        if qual_key not in self.profiles:
-            self.profiles[qual_key] = {"calls": 0, "total_time": 0, "total_cpu": 0, "total_memory": 0, "total_gpu": 0, "total_io": 0, "notes": "", "total_gpus": [0] * self.num_gpus}
-
-        self.profiles[qual_key]["calls"] += 1
-
-        if qual_key in self.current_calls:
-            start_data = self.current_calls[qual_key]
-            end_time = time.time()
-            gpu_usage, gpu_usages = self._get_gpu_usage()
-            duration = end_time - start_data["start_time"]
-            cpu_usage = time.process_time() - start_data["cpu_start"]
-            mem_usage = max(0, _get_memory_usage() - start_data["mem_start"])
-            gpu_usage = max(0, gpu_usage - start_data["gpu_start"])
-            gpu_usages = [max(0, gpu - start_data["gpus_start"][i]) for i,gpu in enumerate(gpu_usages)]
-            io_usage = max(0, _get_io_usage() - start_data["io_start"])
-
-            # Update global mean
-            self.profiles[qual_key]["total_time"] += duration
-            self.profiles[qual_key]["total_cpu"] += cpu_usage
-            self.profiles[qual_key]["total_memory"] += mem_usage
-            self.profiles[qual_key]["total_gpu"] += gpu_usage
-            self.profiles[qual_key]["total_io"] += io_usage
-            self.profiles[qual_key]["total_gpus"] = [gpu + self.profiles[qual_key].get("total_gpus", [0]*(i+1))[i] for i,gpu in enumerate(gpu_usages)]
-
-            calls = self.profiles[qual_key]["calls"] or 1
-            avg_time = self.profiles[qual_key]["total_time"] / calls
-            avg_cpu = self.profiles[qual_key]["total_cpu"] / calls
-            avg_memory = self.profiles[qual_key]["total_memory"] / calls
-            avg_gpu = self.profiles[qual_key]["total_gpu"] / calls
-            avg_gpus = [gpu / calls for gpu in self.profiles[qual_key].get("total_gpus", [0])]
-            avg_io = self.profiles[qual_key]["total_io"] / calls
-            notes = self.profiles[qual_key].get("notes", "")
-            # Print immediate profile
+        if self.report_mode == "call":
+            self._print_call(
+                self.registry.name(slot),
+                store.profile(slot, self._empty_profile),
+                duration / 1e9,
+                cpu_usage / 1e9,
+                mem_usage,
+                gpu_usage,
+                [max(0, gpu - gpu_start) for gpu, gpu_start in zip(sample.gpus, start_sample.gpus, strict=True)] if plan.gpu else [],
+                io_usage,
+                alloc_usage,
+                peak_alloc,
+            )
+
+        return store.calls[slot]
+
+    def _end_unmeasured(self, state, entry):
+        """Count a call that was not measured and charge its caller the average measured duration."""
+        slot, node = entry[0], entry[8]
+        store = state.store
+        store.active[slot] -= 1
+        store.calls[slot] += 1
+        measured = store.measured[slot] or 1
+        duration = store.measured_time[slot] // measured
+        state.tree.record(node, duration, store.total_self_time[slot] // measured)
+        stack = state.stack
+        if stack:
+            parent = stack[-1]
+            parent[6] += duration
+            # This call's hooks and those of the calls below it still count against the caller's time.
+            parent[7] += entry[7]
+            parent[10] += entry[10] + 1
+        return store.calls[slot]
+
+    def _adapt(self, store, slot, now):
+        """Halve how often `slot` is measured once it is hot enough or its mean is known well enough.
+
+        Not while a trace or timeline is written: calls that are not measured are not in them.
+        """
+        if self.trace is not None or self.timeline is not None:
+            return
+        every = store.every[slot]
+        calls = store.calls[slot]
+        since = now - store.checkpoint_time[slot]
+        first = not store.checkpoint_time[slot]
+        rate = (calls - store.checkpoint_calls[slot]) * 1e9 / since if since > 0 else 0.0
+        store.checkpoint_time[slot] = now
+        store.checkpoint_calls[slot] = calls
+        if first or every >= self.sample_max_every:
+            return
+        if rate > self.sample_max_rate or store.time_histograms[slot].relative_error() < self.sample_error:
+            store.every[slot] = min(2 * every, self.sample_max_every)
+
+    def snapshot(self, include_loaded=True):
+        """Merge the shared profiles with every thread's table into a new dict.
+
+        Thread tables are only written by their own thread and are read here without
+        locking, so a snapshot taken while profiling runs may miss the calls in flight.
+        With `include_loaded=False` only what this process recorded counts: its calls,
+        blocks and stack samples, but not the CSV of earlier runs or other processes' tables.
+        """
+        merged = {}
+        if include_loaded:
+            for qual_key, data in list(self.loaded_profiles.items()):
+                merge_profile(merged.setdefault(qual_key, self._empty_profile()), data)
+        for qual_key, data in list(self.profiles.items()):
+            merge_profile(merged.setdefault(qual_key, self._empty_profile()), data)
+        with self._threads_lock:
+            threads = list(self.threads)
+        for state in threads:
+            for qual_key, data in list(state.profiles.items()):
+                merge_profile(merged.setdefault(qual_key, self._empty_profile()), data)
+            for qual_key, data in state.store.items(self.registry, self._empty_profile):
+                merge_profile(merged.setdefault(qual_key, self._empty_profile()), data)
+        return merged
+
+    def _print_call(self, qual_key, profile_data, duration, cpu_usage, mem_usage, gpu_usage, gpu_usages, io_usage, alloc_usage, peak_alloc):
+        """Print a single call next to the running averages. Only used with report mode "call"."""
+        calls = profile_data["calls"] or 1
+        avg_gpus = [gpu / calls for gpu in profile_data.get("total_gpus", [0])]
+        with output_lock:
             display_profile_info(
                 name=qual_key,
                 duration=duration,
@@ -490,137 +1434,201 @@ class FunctionProfiler:
                 gpu_usage=self.format_bytes(gpu_usage),
                 gpu_usages=str([self.format_bytes(gpu) for gpu in gpu_usages]),
                 io_usage=self.format_bytes(io_usage),
-                avg_time=avg_time,
-                avg_cpu=avg_cpu,
-                avg_memory=self.format_bytes(avg_memory),
-                avg_gpu=self.format_bytes(avg_gpu),
+                avg_time=profile_data["total_time"] / calls,
+                avg_cpu=profile_data["total_cpu"] / calls,
+                avg_memory=self.format_bytes(profile_data["total_memory"] / calls),
+                avg_gpu=self.format_bytes(profile_data["total_gpu"] / calls),
                 avg_gpus=str([self.format_bytes(gpu) for gpu in avg_gpus]),
-                avg_io=self.format_bytes(avg_io),
+                avg_io=self.format_bytes(profile_data["total_io"] / calls),
                 calls=calls,
-                notes=notes,
+                notes=profile_data.get("notes", ""),
+                alloc_usage=alloc_usage,
+                peak_alloc=peak_alloc,
             )
-
-            del self.current_calls[qual_key]
-
-        return self.profiles[qual_key]["calls"]
+            flush()
 
 
 _profiler_instance = None
 printed_profile = False
-printed_profile = False
-start_data = None
 
-def profileme(when: Literal["called", "calling"] = "called"):
-    """Profile all functions in a module. Set when to 'calling' to profile only the functions called by the target module."""
+def profileme(
+    when: Literal["called", "calling"] = "called",
+    sample_interval: float | None = None,
+    mode: Literal["trace", "sample"] = "trace",
+    hz: int = 1000,
+    backend: Literal["auto", "monitoring", "setprofile"] = "auto",
+    report: Literal["exit", "interval", "call", "top"] | None = None,
+    report_interval: float | None = None,
+    async_mode: bool = False,
+    trace: str | None = None,
+    stacks: str | None = None,
+    timeline: str | None = None,
+    collectors: str | None = None,
+    include: list[str] | None = None,
+    exclude: list[str] | None = None,
+):
+    """Profile all functions in a module. Set when to 'calling' to profile only the functions called by the target module.
+
+    `sample_interval` is the number of seconds between background memory/I/O/GPU readings.
+    `mode="sample"` samples thread stacks `hz` times per second instead of tracing every call.
+    `backend` picks how traced calls are observed: sys.monitoring on Python 3.12+ or sys.setprofile.
+    `report` controls when tables are printed: at exit (default), every `report_interval` seconds, live ("top"),
+    or on every call.
+    `async_mode` reports each coroutine once per await-to-completion, split into on-CPU and awaited time,
+    and records event-loop lag.
+    `trace` is a file to record every traced call to, read back with `mbench.trace.TraceReader`.
+    `stacks` is a file the call stacks are written to at exit: speedscope JSON for a .json file,
+    collapsed stacks for flamegraph.pl otherwise.
+    `timeline` is a Chrome Trace Event JSON file to stream every call, GC pause and resource sample to.
+    `collectors` picks the metrics measured per call: "time", "fast", "full" or a comma-separated list
+    of profile and collector names such as "full,alloc", see `FunctionProfiler.set_collectors`.
+    `include` and `exclude` are glob or regex rules over module, qualified name and file choosing the
+    functions to profile, such as ["myapp.db.*"] and ["*.__repr__"]; see `FunctionProfiler.set_filters`.
+    """
     global _profiler_instance, printed_profile
     if os.environ.get("MBENCH", "1") == "1":  # Default to "1" if not set
         if _profiler_instance is None:
             _profiler_instance = FunctionProfiler()
+            if sample_interval is not None:
+                _profiler_instance.sampler.interval = sample_interval
+            if collectors is not None:
+                _profiler_instance.set_collectors(collectors)
+            if report is not None or report_interval is not None:
+                _profiler_instance.set_reporting(report or _profiler_instance.report_mode, report_interval)
             import inspect
 
             current_frame = inspect.currentframe()
             called_frame = current_frame.f_back
             called_module = called_frame.f_globals["__name__"]
             _profiler_instance.set_target_module(called_module, when)
-            sys.setprofile(_profiler_instance.profile)
+            if include is not None or exclude is not None:
+                _profiler_instance.set_filters(include, exclude)
+            if async_mode:
+                _profiler_instance.enable_async()
+            if trace is not None:
+                _profiler_instance.start_trace(trace)
+            if stacks is not None:
+                _profiler_instance.stacks_file = stacks
+            if timeline is not None:
+                _profiler_instance.timeline_file = timeline
+                _profiler_instance.start_timeline(timeline)
+            if mode == "sample":
+                from mbench.statistical import StatisticalProfiler
+
+                _profiler_instance.stack_sampler = StatisticalProfiler(_profiler_instance, hz=hz)
+                _profiler_instance.stack_sampler.start()
+                atexit.register(_profiler_instance.stack_sampler.stop)
+            else:
+                _profiler_instance.install(backend)
             console.print(
                 f"[bold green] Profiling started for module: {called_module} in when: {when} [/bold green]"
             )
+            flush()
     elif not printed_profile:
         printed_profile = True
-        console.print("Profiling is not active. Set [bold pink]MBENCH=1[/bold pink] to enable profiling.")
+        in_memory_file.write(INACTIVE_NOTICE)
+
+
+def profile(func=None, *, lines=False):
+    """Decorator to profile a specific function, used as `@profile` or `@profile(lines=True)`.
+
+    Whether profiling is on is decided once, when decorating: with MBENCH=0 `func` itself
+    is returned. Otherwise its calls are timed by `FunctionProfiler.wrap`, which installs
+    no hook, so the rest of the program runs at full speed and a `profileme` hook stays in place.
+    With `lines=True` the hits and time of each of its lines are recorded too and shown as
+    annotated source next to the summary.
+    """
+    if func is None:
+        return functools.partial(profile, lines=lines)
+    if os.environ.get("MBENCH", "1") != "1":
+        return func
+    profiler = FunctionProfiler()
+    timed = profiler.wrap(func)
+    return profiler.profile_lines(func, timed) if lines else timed
 
 
-def profile(func):
-    """Decorator to profile a specific function."""
+def profiling(name="block", quiet=None, async_mode=False):
+    """Profile a block of code. With `async_mode`, a block inside a coroutine also reports how long it was awaiting.
 
-    def wrapper(*args, **kwargs):
-        global _profiler_instance, printed_profile
-        print(f"MBENCH environment variable: {os.environ.get('MBENCH')}")  # Debug print
-        if os.environ.get("MBENCH", "1") == "1":  # Default to "1" if not set
-            print("Creating FunctionProfiler instance")  # Debug print
-            _profiler_instance = FunctionProfiler()  # Always create a new instance
-            called_module = func.__module__
-            _profiler_instance.set_target_module(called_module, "called")
-            sys.setprofile(_profiler_instance.profile)
-            console.print(
-                f"[bold green] Profiling started for module: {called_module} [/bold green]"
-            )
-            try:
-                print("Starting profile")  # Debug print
-                _profiler_instance._start_profile(sys._getframe())
-                result = func(*args, **kwargs)
-                print("Ending profile")  # Debug print
-                _profiler_instance._end_profile(sys._getframe())
-                return result
-            finally:
-                sys.setprofile(None)  # Disable profiling after function execution
-        elif not printed_profile:
+    Every block keeps its own start state, so blocks can be nested and entered from several
+    threads at once. Blocks show up in the summary like functions; each one is also printed
+    as it ends only with the "call" report mode, unless `quiet` says otherwise. With MBENCH=0
+    this returns a do-nothing context manager.
+    """
+    global printed_profile
+    if os.environ.get("MBENCH", "1") != "1":  # Default to "1" if not set
+        if not printed_profile:
             printed_profile = True
-            console.print("Profiling is not active. Set [bold pink]MBENCH=1[/bold pink] to enable profiling.")
-        return func(*args, **kwargs)
-
-    return wrapper
-
+            in_memory_file.write(INACTIVE_NOTICE)
+        return nullcontext()
+    return _profiling(FunctionProfiler(), name, quiet, async_mode)
 
 
 @contextmanager
-def profiling(name="block", quiet=False):
-    global printed_profile, start_data, _profiler_instance
-    if os.environ.get("MBENCH", "1") == "1":  # Default to "1" if not set
-        if _profiler_instance is None:
-            _profiler_instance = FunctionProfiler()
-            _profiler_instance.set_target_module("__main__", "called")
-            sys.setprofile(_profiler_instance.profile)
-        gpu_usage, gpu_usages = _profiler_instance._get_gpu_usage()
-        start_data = {
-            "start_time": time.time(),
-            "cpu_start": time.process_time(),
-            "mem_start": _get_memory_usage(),
-            "gpu_start": gpu_usage,
-            "gpus_start": gpu_usages,
-            "io_start": _get_io_usage(),
-        }
-        _profiler_instance._start_profile(sys._getframe())
-    elif not printed_profile:
-        printed_profile = True
-        console.print("Profiling is not active. Set [bold pink]MBENCH=1[/bold pink] to enable profiling.")
+def _profiling(profiler, name, quiet, async_mode):
+    task_record = None
+    if async_mode:
+        from mbench.aio import ensure_task_record
+
+        profiler.enable_async()
+        task_record = ensure_task_record()
+    task_running = task_record.running_time() if task_record is not None else 0
+    if quiet is None:
+        quiet = profiler.report_mode != "call"
+    start_sample = profiler.sampler.latest()
+    alloc_token = profiler.memory.start()
+    # Integer ns like traced calls; converted to seconds once the block has ended.
+    start_ns = time.perf_counter_ns()
+    cpu_start_ns = time.thread_time_ns()
     try:
         yield  # Allow the code block to execute
     finally:
-        if os.getenv("MBENCH", "1") == "1":  # Default to "1" if not set
-            gpu_usage, gpu_usages = _profiler_instance._get_gpu_usage()
-            _profiler_instance._end_profile(sys._getframe())
-            end_time = time.time()
-            duration = end_time - start_data["start_time"]
-            cpu_usage = time.process_time() - start_data["cpu_start"]
-            mem_usage = psutil.virtual_memory().used - start_data["mem_start"]
-            gpu_usage = gpu_usage - start_data["gpu_start"]
-            gpu_usages = [gpu - start_data["gpus_start"][i] for i,gpu in enumerate(gpu_usages)]
-            io_usage = _get_io_usage() - start_data["io_start"]
-
-            # Update profiler data
-            if name not in _profiler_instance.profiles:
-                _profiler_instance.profiles[name] = {"calls": 0, "total_time": 0, "total_cpu": 0, "total_memory": 0, "total_gpu": 0, "total_io": 0, "notes": "", "total_gpus": [0] * _profiler_instance.num_gpus}
-            profile_data = _profiler_instance.profiles[name]
+        duration_ns = time.perf_counter_ns() - start_ns
+        cpu_ns = time.thread_time_ns() - cpu_start_ns
+        sample = profiler.sampler.latest()
+        duration = duration_ns / 1e9
+        cpu_usage = cpu_ns / 1e9
+        mem_usage = sample.memory - start_sample.memory
+        alloc_usage, peak_alloc = profiler.memory.stop(alloc_token)
+        gpu_usage = sample.gpu - start_sample.gpu
+        gpu_usages = [gpu - start_sample.gpus[i] for i, gpu in enumerate(sample.gpus)]
+        io_usage = sample.io - start_sample.io
+        awaited = 0.0
+        if task_record is not None:
+            awaited = (duration_ns - (task_record.running_time() - task_running)) / 1e9
+        if profiler.timeline is not None:
+            profiler.timeline.span(name, start_ns, duration_ns, category="block", args={"cpu_ms": cpu_ns / 1e6})
+
+        # Update profiler data; blocks of the same name can end on several threads at once.
+        with profiler._profiles_lock:
+            if name not in profiler.profiles:
+                profiler.profiles[name] = profiler._empty_profile()
+            profile_data = profiler.profiles[name]
             profile_data["calls"] += 1
             profile_data["total_time"] += duration
             profile_data["total_cpu"] += cpu_usage
             profile_data["total_memory"] += mem_usage
+            profile_data["total_alloc"] = profile_data.get("total_alloc", 0) + alloc_usage
+            profile_data["total_awaited"] = profile_data.get("total_awaited", 0) + awaited
+            profile_data["peak_alloc"] = max(profile_data.get("peak_alloc", 0), peak_alloc)
             profile_data["total_gpu"] += gpu_usage
             profile_data["total_io"] += io_usage
             profile_data["total_gpus"] = [gpu + profile_data.get("total_gpus", [0]*(i+1))[i] for i,gpu in enumerate(gpu_usages)]
-
-            # Print immediate profile
-            calls = profile_data["calls"]
-            avg_time = profile_data["total_time"] / calls
-            avg_cpu = profile_data["total_cpu"] / calls
-            avg_memory = profile_data["total_memory"] / calls
-            avg_gpu = profile_data["total_gpu"] / calls
-            avg_io = profile_data["total_io"] / calls
-            notes = profile_data.get("notes", "")
+            record_latency(profile_data, duration, cpu_usage)
 
             if not quiet:
+                # Print immediate profile
+                calls = profile_data["calls"]
+                avg_time = profile_data["total_time"] / calls
+                avg_cpu = profile_data["total_cpu"] / calls
+                avg_memory = profile_data["total_memory"] / calls
+                avg_gpu = profile_data["total_gpu"] / calls
+                avg_io = profile_data["total_io"] / calls
+                avg_gpus = [gpu / calls for gpu in profile_data.get("total_gpus", [0])]
+                notes = profile_data.get("notes", "")
+
+        if not quiet:
+            with output_lock:
                 display_profile_info(
                     name=name,
                     duration=duration,
@@ -636,5 +1644,9 @@ def profiling(name="block", quiet=False):
                     calls=calls,
                     notes=notes,
                     gpu_usages=gpu_usages,
-                    avg_gpus=[gpu / calls for gpu in profile_data.get("total_gpus", [0])]
+                    avg_gpus=avg_gpus,
+                    alloc_usage=alloc_usage,
+                    peak_alloc=peak_alloc,
+                    awaited=awaited,
                 )
+                flush()
@@ -0,0 +1,139 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import threading
+import time
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import psutil
+
+from mbench.memory import process_rss
+
+
+class Sample(NamedTuple):
+    """A single reading of the process resources. `memory` is this process's RSS."""
+
+    timestamp: float
+    memory: int
+    io: int
+    gpu: int
+    gpus: list
+
+
+class FakeNVML:
+    """Stand-in for the `pynvml` module with `devices` GPUs, for machines and tests without NVIDIA drivers.
+
+    Set `used[index]` to change what a device reports. MBENCH_GPU=fake (or fake:N for N
+    devices) makes the profiler use it instead of pynvml.
+    """
+
+    class NVMLError(Exception):
+        pass
+
+    def __init__(self, devices=1, total=16 * 1024**3):
+        self.used = [0] * devices
+        self.total = total
+        self.initialized = False
+
+    def nvmlInit(self):
+        self.initialized = True
+
+    def nvmlShutdown(self):
+        if not self.initialized:
+            raise self.NVMLError("Uninitialized")
+        self.initialized = False
+
+    def nvmlDeviceGetCount(self):
+        return len(self.used)
+
+    def nvmlDeviceGetHandleByIndex(self, index):
+        if not 0 <= index < len(self.used):
+            raise self.NVMLError("Invalid Argument")
+        return index
+
+    def nvmlDeviceGetMemoryInfo(self, handle):
+        if not self.initialized:
+            raise self.NVMLError("Uninitialized")
+        used = self.used[handle]
+        return SimpleNamespace(total=self.total, used=used, free=self.total - used)
+
+
+def nvml_module(setting="1"):
+    """The NVML implementation for an MBENCH_GPU setting: pynvml, a `FakeNVML`, or None for "0"."""
+    if setting == "0":
+        return None
+    if setting.startswith("fake"):
+        _, _, devices = setting.partition(":")
+        return FakeNVML(int(devices or 1))
+    import pynvml
+
+    return pynvml
+
+
+def poll_resources(gpu_handles=(), nvml=None):
+    """Read memory, disk I/O and GPU memory once. Failures read as 0. `nvml` defaults to pynvml."""
+    try:
+        memory = process_rss()
+    except Exception:  # noqa: BLE001
+        memory = 0
+    try:
+        io_counters = psutil.disk_io_counters()
+        io = (io_counters.read_bytes + io_counters.write_bytes) if io_counters else 0
+    except Exception:  # noqa: BLE001
+        io = 0
+    gpus = []
+    if gpu_handles and nvml is None:
+        import pynvml as nvml
+    for handle in gpu_handles:
+        try:
+            gpus.append(nvml.nvmlDeviceGetMemoryInfo(handle).used)
+        except nvml.NVMLError:
+            gpus.append(0)
+    return Sample(time.time(), memory, io, sum(gpus), gpus)
+
+
+class ResourceSampler(threading.Thread):
+    """Poll psutil/NVML at a fixed interval into a ring buffer.
+
+    Only the sampler thread writes. It stores a sample in the next slot and then
+    bumps ``_head``, so readers never take a lock: ``latest`` is a single index
+    read.
+    Callables in ``listeners`` are handed every new sample on the sampler thread.
+    """
+
+    def __init__(self, interval=0.01, size=256, gpu_handles=None, nvml=None):
+        super().__init__(name="mbench-sampler", daemon=True)
+        self.interval = interval
+        self.size = size
+        self.gpu_handles = list(gpu_handles or [])
+        self.nvml = nvml
+        self._buffer = [poll_resources(self.gpu_handles, nvml)] * size
+        self._head = 1
+        self.listeners = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            sample = poll_resources(self.gpu_handles, self.nvml)
+            self._buffer[self._head % self.size] = sample
+            self._head += 1
+            for listener in list(self.listeners):
+                listener(sample)
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout=1.0)
+
+    def latest(self):
+        """Most recent sample."""
+        return self._buffer[(self._head - 1) % self.size]
+
+    def samples(self):
+        """Samples still held in the buffer, oldest first."""
+        head = self._head
+        start = max(0, head - self.size)
+        return [self._buffer[i % self.size] for i in range(start, head)]
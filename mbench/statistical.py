@@ -0,0 +1,156 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import signal
+import sys
+import threading
+import time
+
+from mbench.callgraph import add_stack
+
+# Missing on Windows and macOS; sampled threads are then charged the whole period.
+pthread_getcpuclockid = getattr(time, "pthread_getcpuclockid", None)
+
+
+class StatisticalProfiler:
+    """Sample the stacks of all threads on a timer instead of tracing every call.
+
+    On POSIX the timer is ``SIGPROF`` driven by ``setitimer(ITIMER_PROF)``, so ticks
+    follow the CPU time consumed by the process. Where signals are not available
+    (Windows, or when started off the main thread) a daemon thread ticks on wall time.
+
+    Each tick charges every profiled function on a thread's stack (once per stack, so
+    recursion is not double counted), and self time to the innermost one, with the CPU
+    time that thread used since the previous tick. A ``SIGPROF`` tick is the process's
+    CPU time, so threads that did not run since the previous tick are not sampled and
+    their time is not counted. A wall-time tick charges ``1 / hz`` seconds of time to
+    every thread, but still only its own CPU time. Where per-thread CPU clocks are not
+    available, every thread is charged ``1 / hz`` seconds of both.
+
+    Results land in ``FunctionProfiler.profiles`` next to the ``profiling()`` blocks, with
+    ``calls`` holding the number of samples that saw the function. The stacks themselves
+    are counted in ``FunctionProfiler.stacks`` for flamegraphs. Both hold this process's
+    own data only, so exporters and child reports include it.
+    """
+
+    def __init__(self, profiler, hz=1000):
+        self.profiler = profiler
+        self.hz = hz
+        self.period = 1.0 / hz
+        self.samples = 0
+        self._keys = {}
+        # thread id -> its CPU clock id, and its CPU time in ns at the previous tick.
+        self._clocks = {}
+        self._cpu = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._previous_handler = None
+
+    def start(self):
+        for thread_id in sys._current_frames():
+            self._cpu_delta(thread_id)
+        if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGPROF, self._handle_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.period, self.period)
+        else:
+            self._thread = threading.Thread(target=self._run, name="mbench-stack-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        elif self._previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+            self._previous_handler = None
+
+    def _handle_signal(self, signum, frame):
+        self.sample()
+
+    def _run(self):
+        while not self._stop_event.wait(self.period):
+            self.sample()
+
+    def _key(self, frame):
+        """Profile key for `frame`, or None when it is not a profiling target.
+
+        In "called" mode the answer only depends on the code object, so it is cached.
+        """
+        code = frame.f_code
+        cached = self._keys.get(id(code))
+        if cached is not None:
+            return cached[1]
+        profiler = self.profiler
+        if not profiler._is_target(frame):
+            return None
+        key = profiler._get_qual_name(frame)
+        if profiler.when == "called":
+            # Keep the code object alive so its id cannot be reused.
+            self._keys[id(code)] = (code, key)
+        return key
+
+    def _cpu_delta(self, thread_id):
+        """CPU seconds `thread_id` used since the previous tick, 0.0 the first time it is
+        seen, or None when its CPU clock cannot be read."""
+        if pthread_getcpuclockid is None:
+            return None
+        try:
+            clock = self._clocks.get(thread_id)
+            if clock is None:
+                clock = self._clocks[thread_id] = pthread_getcpuclockid(thread_id)
+            now = time.clock_gettime_ns(clock)
+        except OSError:
+            return None
+        previous = self._cpu.get(thread_id)
+        self._cpu[thread_id] = now
+        return 0.0 if previous is None else (now - previous) / 1e9
+
+    def sample(self):
+        self.samples += 1
+        wall = self._thread is not None
+        own_thread = threading.get_ident()
+        frames = sys._current_frames()
+        for thread_id, frame in frames.items():
+            if thread_id == own_thread and wall:
+                continue
+            cpu = self._cpu_delta(thread_id)
+            if cpu is None:
+                cpu = self.period
+            elif not cpu and not wall:
+                continue
+            self._charge(frame, self.period if wall else cpu, cpu)
+        for thread_id in self._cpu.keys() - frames.keys():
+            del self._cpu[thread_id]
+            self._clocks.pop(thread_id, None)
+
+    def _charge(self, frame, elapsed, cpu):
+        """Add one sample of `elapsed` seconds and `cpu` CPU seconds to the stack ending at `frame`."""
+        profiles = self.profiler.profiles
+        seen = set()
+        leaf = True
+        path = []
+        while frame is not None:
+            key = self._key(frame)
+            if key is not None:
+                path.append(key)
+            if key is not None and key not in seen:
+                seen.add(key)
+                if key not in profiles:
+                    profiles[key] = self.profiler._empty_profile()
+                data = profiles[key]
+                data["calls"] += 1
+                data["total_time"] += elapsed
+                data["total_cpu"] += cpu
+                if leaf:
+                    data["total_self_time"] = data.get("total_self_time", 0) + elapsed
+                    leaf = False
+                data["notes"] = f"sampled at {self.hz} Hz; calls are sample counts"
+            frame = frame.f_back
+        path.reverse()
+        for depth in range(1, len(path) + 1):
+            self_time = elapsed if depth == len(path) else 0.0
+            add_stack(self.profiler.stacks, tuple(path[:depth]), 1, elapsed, self_time)
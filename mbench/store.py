@@ -0,0 +1,194 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import threading
+from array import array
+
+from mbench.histogram import Histogram
+
+# Columns summed per call. Times are integer nanoseconds, reported in seconds.
+TIME_FIELDS = ("total_time", "total_self_time", "total_cpu", "total_awaited")
+METRIC_FIELDS = ("total_memory", "total_alloc", "total_gpu", "total_io")
+SUM_FIELDS = TIME_FIELDS + METRIC_FIELDS
+# Per-slot state of adaptive sampling and of the sampled collectors, see `StatsStore`.
+SAMPLING_FIELDS = ("measured", "measured_time", "skip", "checkpoint_time", "checkpoint_calls", "collected", "collect_skip")
+
+
+class CodeRegistry:
+    """Give every profiled code object a small integer slot, shared by all threads.
+
+    Slots are looked up by ``id(code)``, which is much cheaper than hashing the code
+    object. The registry keeps each code object alive so its id cannot be reused.
+    Names are only built from the code and its module when a report asks for them.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.codes = []
+        self.modules = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def register(self, code, module):
+        """Slot of `code`, assigning the next free one the first time it is seen."""
+        with self._lock:
+            slot = self.slots.get(id(code))
+            if slot is None:
+                slot = len(self.codes)
+                self.codes.append(code)
+                self.modules.append(module)
+                self.slots[id(code)] = slot
+            return slot
+
+    def name(self, slot):
+        return f"{self.modules[slot]}.{self.codes[slot].co_name}"
+
+
+class StatsStore:
+    """Per-call counters of one thread in preallocated typed arrays indexed by slot.
+
+    Every column grows geometrically, so recording a call only indexes into arrays.
+    `active` counts the calls currently running per slot, which is how recursion
+    is spotted; it is live state and survives `clear`. Latency histograms are only
+    allocated for slots that recorded a call.
+
+    With adaptive sampling only 1 in `every` calls of a slot is measured on average.
+    `calls` still counts every call, `measured` the ones that were timed, and the
+    summed columns are scaled up by calls / measured when reported. The columns in
+    `sampled_fields` belong to collectors that only ran on `collected` of the measured
+    calls and are scaled by calls / collected instead.
+
+    `add_field` adds a column for a collector registered at run time; those columns
+    are in `extra` and reported under their field name.
+    """
+
+    def __init__(self, num_gpus=0, capacity=64):
+        self.capacity = 0
+        self.calls = array("q")
+        self.active = array("q")
+        self.peak_alloc = array("d")
+        for field in SAMPLING_FIELDS:
+            setattr(self, field, array("q"))
+        self.every = array("q")
+        for field in TIME_FIELDS:
+            setattr(self, field, array("q"))
+        for field in METRIC_FIELDS:
+            setattr(self, field, array("d"))
+        self.total_gpus = [array("d") for _ in range(num_gpus)]
+        self.extra = {}
+        self.sampled_fields = frozenset()
+        # Sparse: only functions whose calls set an allocation record have sites.
+        self.top_allocations = {}
+        self.time_histograms = []
+        self.cpu_histograms = []
+        self.grow(capacity)
+
+    def _columns(self):
+        yield self.calls
+        yield self.active
+        yield self.peak_alloc
+        for field in SAMPLING_FIELDS:
+            yield getattr(self, field)
+        for field in SUM_FIELDS:
+            yield getattr(self, field)
+        yield from self.total_gpus
+        yield from self.extra.values()
+
+    def add_field(self, field):
+        """Add a summed column for `field` unless the store already has one."""
+        if field not in self.extra and not hasattr(self, field):
+            self.extra[field] = array("d", [0]) * self.capacity
+
+    def column(self, field):
+        """The summed column of `field`."""
+        column = self.extra.get(field)
+        return getattr(self, field) if column is None else column
+
+    def grow(self, size):
+        """Make room for slots below `size`, at least doubling the capacity."""
+        if size <= self.capacity:
+            return
+        capacity = max(size, 2 * self.capacity)
+        extra = capacity - self.capacity
+        for column in self._columns():
+            column.extend(array(column.typecode, [0]) * extra)
+        self.every.extend(array("q", [1]) * extra)
+        self.time_histograms.extend([None] * extra)
+        self.cpu_histograms.extend([None] * extra)
+        self.capacity = capacity
+
+    def clear(self):
+        """Zero every counter, keeping the capacity and the calls in flight."""
+        for column in self._columns():
+            if column is not self.active:
+                column[:] = array(column.typecode, [0]) * self.capacity
+        self.every[:] = array("q", [1]) * self.capacity
+        self.top_allocations = {}
+        self.time_histograms = [None] * self.capacity
+        self.cpu_histograms = [None] * self.capacity
+
+    def measure_every_call(self):
+        """Stop adaptive sampling of every slot; the next call of each is measured."""
+        self.every[:] = array("q", [1]) * self.capacity
+        self.skip[:] = array("q", [0]) * self.capacity
+
+    def reset_slot(self, slot):
+        """Zero the counters of one slot."""
+        for column in self._columns():
+            if column is not self.active:
+                column[slot] = 0
+        self.every[slot] = 1
+        self.top_allocations.pop(slot, None)
+        self.time_histograms[slot] = None
+        self.cpu_histograms[slot] = None
+
+    def items(self, registry, empty_profile):
+        """(function name, aggregate) for every slot that recorded a call.
+
+        Distinct code objects can share a name, so callers merge repeated names.
+        """
+        calls = self.calls
+        for slot in range(min(self.capacity, len(registry))):
+            if calls[slot]:
+                yield registry.name(slot), self.profile(slot, empty_profile)
+
+    def profile(self, slot, empty_profile):
+        """Aggregate of one slot as a profile dict."""
+        data = empty_profile()
+        calls = data["calls"] = self.calls[slot]
+        measured = self.measured[slot]
+        # Unmeasured calls are assumed to cost as much as the measured ones on average.
+        scale = calls / measured if 0 < measured < calls else 1.0
+        collected = self.collected[slot]
+        sampled_scale = calls / collected if 0 < collected < calls else scale
+        sampled = self.sampled_fields
+        data["peak_alloc"] = self.peak_alloc[slot]
+        for field in TIME_FIELDS:
+            data[field] = getattr(self, field)[slot] * scale / 1e9
+        for field in METRIC_FIELDS:
+            data[field] = getattr(self, field)[slot] * (sampled_scale if field in sampled else scale)
+        gpu_scale = sampled_scale if "total_gpu" in sampled else scale
+        data["total_gpus"] = [column[slot] * gpu_scale for column in self.total_gpus]
+        for field, column in self.extra.items():
+            data[field] = column[slot] * (sampled_scale if field in sampled else scale)
+        if scale != 1.0:
+            data["notes"] = f"extrapolated from {measured} of {calls} calls"
+        if sampled and collected and sampled_scale != scale:
+            note = f"{', '.join(sorted(sampled))} extrapolated from {collected} of {calls} calls"
+            data["notes"] = f"{data['notes']}; {note}" if data.get("notes") else note
+        data["top_allocations"] = self.top_allocations.get(slot, [])
+        data["time_histogram"] = self.time_histograms[slot]
+        data["cpu_histogram"] = self.cpu_histograms[slot]
+        return data
+
+    def record_latency(self, slot, duration_ns, cpu_ns):
+        histogram = self.time_histograms[slot]
+        if histogram is None:
+            histogram = self.time_histograms[slot] = Histogram()
+            self.cpu_histograms[slot] = Histogram()
+        histogram.record_ns(duration_ns)
+        self.cpu_histograms[slot].record_ns(cpu_ns)
@@ -0,0 +1,193 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import gc
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+# Events a thread buffers before appending them to the file under the lock.
+BUFFER_EVENTS = 1024
+
+
+def part_path(path, pid):
+    """Timeline file of process `pid` when several processes record into `path`: run.json -> run.<pid>.json."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{pid}{path.suffix}")
+
+
+class TimelineWriter:
+    """Stream Chrome Trace Event JSON (the array format Perfetto and chrome://tracing load) to a file.
+
+    Every span becomes one complete ("X") event on the track of the thread that ran it,
+    and resource samples become counter ("C") events. Events are formatted as they
+    arrive, buffered per thread and appended to the file under a lock, so the document
+    is never held in memory. The closing bracket is optional in this format, so a run
+    cut short still loads up to its last flush. Timestamps are microseconds since the
+    writer was opened.
+    """
+
+    def __init__(self, path, pid=None, process_name=None, gc_events=True):
+        self.path = str(path)
+        self.pid = os.getpid() if pid is None else pid
+        self.count = 0
+        self.origin = time.perf_counter_ns()
+        self.wall_origin = time.time_ns()
+        self._names = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buffers = []
+        self._gc_start = None
+        self._file = open(self.path, "w")  # noqa: SIM115
+        self._file.write("[\n")
+        self._metadata("process_name", 0, process_name or f"pid {self.pid}")
+        self.gc_events = gc_events
+        if gc_events:
+            gc.callbacks.append(self._on_gc)
+
+    def _quoted(self, name):
+        quoted = self._names.get(name)
+        if quoted is None:
+            quoted = self._names[name] = json.dumps(name)
+        return quoted
+
+    def _metadata(self, kind, tid, name):
+        self._write([f'{{"name":"{kind}","ph":"M","pid":{self.pid},"tid":{tid},"args":{{"name":{json.dumps(name)}}}}}'])
+
+    def _buffer(self):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = []
+            thread = threading.current_thread()
+            self._local.tid = threading.get_native_id()
+            with self._lock:
+                self._buffers.append(buffer)
+            self._metadata("thread_name", self._local.tid, thread.name)
+        return buffer
+
+    def span(self, name, start, duration, category="call", args=None, tid=None):
+        """One complete event. `start` is a perf_counter_ns timestamp, `duration` nanoseconds."""
+        buffer = self._buffer()
+        event = (
+            f'{{"name":{self._quoted(name)},"cat":"{category}","ph":"X","ts":{(start - self.origin) / 1000:.3f},'
+            f'"dur":{duration / 1000:.3f},"pid":{self.pid},"tid":{self._local.tid if tid is None else tid}'
+        )
+        if args:
+            event += f',"args":{json.dumps(args)}'
+        buffer.append(event + "}")
+        if len(buffer) >= BUFFER_EVENTS:
+            self._flush(buffer)
+
+    def counters(self, sample):
+        """Memory, I/O and GPU counter events for one `mbench.sampler.Sample`."""
+        buffer = self._buffer()
+        ts = f"{(sample.timestamp * 1e9 - self.wall_origin) / 1000:.3f}"
+        buffer.append(f'{{"name":"memory","ph":"C","ts":{ts},"pid":{self.pid},"args":{{"rss":{sample.memory}}}}}')
+        buffer.append(f'{{"name":"io","ph":"C","ts":{ts},"pid":{self.pid},"args":{{"bytes":{sample.io}}}}}')
+        if sample.gpus:
+            gpus = ",".join(f'"gpu{index}":{used}' for index, used in enumerate(sample.gpus))
+            buffer.append(f'{{"name":"gpu memory","ph":"C","ts":{ts},"pid":{self.pid},"args":{{{gpus}}}}}')
+        if len(buffer) >= BUFFER_EVENTS:
+            self._flush(buffer)
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.perf_counter_ns()
+        elif self._gc_start is not None:
+            start, self._gc_start = self._gc_start, None
+            self.span(
+                f"gc (generation {info['generation']})",
+                start,
+                time.perf_counter_ns() - start,
+                category="gc",
+                args={"collected": info["collected"]},
+            )
+
+    def _write(self, events):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write((",\n" if self.count else "") + ",\n".join(events))
+            self.count += len(events)
+
+    def _flush(self, buffer):
+        events = buffer[:]
+        del buffer[: len(events)]
+        self._write(events)
+
+    def detach(self):
+        """Stop recording without touching the file, e.g. in a forked child that does not own it."""
+        if self.gc_events and self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        self._file = None
+
+    def close(self):
+        """Flush every thread's events and end the JSON array."""
+        if self.gc_events and self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        for buffer in list(self._buffers):
+            if buffer:
+                self._flush(buffer)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+
+
+def merge_timelines(path, parts):
+    """Concatenate timeline files written by `TimelineWriter` into `path`, one line at a time, and delete them."""
+    count = 0
+    with open(path, "w") as out:
+        out.write("[\n")
+        for part in parts:
+            with open(part) as f:
+                for line in f:
+                    event = line.strip().rstrip(",")
+                    if event in ("", "[", "]"):
+                        continue
+                    out.write((",\n" if count else "") + event)
+                    count += 1
+            os.remove(part)
+        out.write("\n]\n")
+    return count
+
+
+def from_trace(trace_path, path):
+    """Convert a binary trace written with `profileme(trace=...)` into a timeline at `path`."""
+    from mbench.trace import TraceReader
+
+    with TraceReader(trace_path) as reader:
+        writer = TimelineWriter(path, process_name=Path(trace_path).name, gc_events=False)
+        writer.origin = reader.epoch[0]
+        writer.wall_origin = reader.epoch[1]
+        for index, name in reader.threads.items():
+            writer._metadata("thread_name", index, name)
+        for slot, thread, _, _, start, duration, cpu, self_time, *_ in reader.records():
+            writer.span(
+                reader.name(slot),
+                start,
+                duration,
+                args={"cpu_ms": cpu / 1e6, "self_ms": self_time / 1e6},
+                tid=thread,
+            )
+        writer.close()
+    return writer.count
+
+
+def main(argv=None):
+    """`mbench timeline`: convert a binary trace into Chrome Trace Event JSON for Perfetto or chrome://tracing."""
+    parser = ArgumentParser(prog="mbench timeline", description=main.__doc__)
+    parser.add_argument("trace", help="binary trace written with profileme(trace=...) or MBENCH_TRACE")
+    parser.add_argument("-o", "--output", help="output file (default: the trace path with a .json suffix)")
+    args = parser.parse_args(argv)
+    output = args.output or str(Path(args.trace).with_suffix(".json"))
+    count = from_trace(args.trace, output)
+    print(f"Wrote {count} events to {output}")
+    return output
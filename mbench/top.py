@@ -0,0 +1,189 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from rich.console import Console
+from rich.live import Live
+from rich.table import Table
+
+SORT_KEYS = ("total", "self", "calls", "rate", "p99")
+
+
+def socket_path(pid=None):
+    """Default stats socket of process `pid` (this process by default)."""
+    return str(Path(tempfile.gettempdir()) / f"mbench-{os.getpid() if pid is None else pid}.sock")
+
+
+def stats_rows(profiles):
+    """One plain row per function with calls, for the dashboard and the stats socket."""
+    rows = []
+    for name, data in profiles.items():
+        if not data.get("calls"):
+            continue
+        histogram = data.get("time_histogram")
+        rows.append({
+            "name": name,
+            "calls": data["calls"],
+            "total_time": data["total_time"],
+            "self_time": data.get("total_self_time", 0),
+            "cpu": data["total_cpu"],
+            "p99": histogram.percentile(99) if histogram is not None else 0.0,
+        })
+    return rows
+
+
+class StatsServer:
+    """Serve snapshots of a profiler's aggregates on a local Unix socket.
+
+    Each connection receives one JSON document and is closed. The snapshot is taken
+    on the server thread and reused for `interval` seconds, so watchers never touch the
+    profiled threads and nothing is computed while nobody is watching.
+    """
+
+    def __init__(self, profiler, path=None, interval=0.25):
+        self.profiler = profiler
+        self.path = path or socket_path()
+        self.interval = interval
+        self._payload = b""
+        self._taken = 0.0
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen()
+        self._thread = threading.Thread(target=self._serve, name="mbench-stats-server", daemon=True)
+        self._thread.start()
+
+    def payload(self):
+        now = time.monotonic()
+        if now - self._taken >= self.interval:
+            self._payload = json.dumps({
+                "pid": os.getpid(),
+                "time": now,
+                "rows": stats_rows(self.profiler.snapshot(include_loaded=False)),
+            }).encode()
+            self._taken = now
+        return self._payload
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.sendall(self.payload())
+                except OSError:
+                    continue
+
+    def close(self):
+        self._socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def read_stats(path, timeout=2.0):
+    """Fetch one snapshot from a `StatsServer` socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path)
+        chunks = []
+        while chunk := conn.recv(65536):
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+class Top:
+    """Live table of the busiest functions, refreshed from successive snapshots.
+
+    `source` returns ``{"time": monotonic seconds, "rows": stats_rows(...)}``. Calls per
+    second come from the difference between the last two distinct snapshots.
+    """
+
+    def __init__(self, source, sort="total", limit=30, title="mbench top"):
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+        self.source = source
+        self.sort = sort
+        self.limit = limit
+        self.title = title
+        self._last = None
+        self._rates = {}
+
+    def table(self):
+        stats = self.source()
+        last = self._last
+        # A server hands out the same snapshot until it is `interval` old; keep the rates until it changes.
+        if last is None or stats["time"] != last["time"]:
+            if last is not None:
+                elapsed = stats["time"] - last["time"]
+                before = {row["name"]: row["calls"] for row in last["rows"]}
+                self._rates = {row["name"]: (row["calls"] - before.get(row["name"], 0)) / elapsed for row in stats["rows"]}
+            self._last = stats
+        rows = [{**row, "rate": self._rates.get(row["name"], 0.0)} for row in stats["rows"]]
+        key = {"total": "total_time", "self": "self_time"}.get(self.sort, self.sort)
+        rows.sort(key=lambda row: row[key], reverse=True)
+
+        table = Table(title=f"[bold blue]{self.title}[/bold blue]", caption=f"sorted by {self.sort}", border_style="bold")
+        table.add_column("Function", style="cyan", no_wrap=True)
+        for column in ("Calls", "Calls/s", "Total time", "Self time", "CPU time", "Avg", "p99"):
+            table.add_column(column, justify="right")
+        for row in rows[: self.limit]:
+            table.add_row(
+                row["name"],
+                str(row["calls"]),
+                f"{row['rate']:.1f}",
+                f"{row['total_time']:.6f}",
+                f"{row['self_time']:.6f}",
+                f"{row['cpu']:.6f}",
+                f"{row['total_time'] / row['calls']:.6f}",
+                f"{row['p99']:.6f}",
+            )
+        return table
+
+    def run(self, stop_event=None, refresh=0.25, console=None):
+        """Redraw every `refresh` seconds until `stop_event` is set or Ctrl-C."""
+        stop_event = stop_event or threading.Event()
+        with Live(self.table(), console=console or Console(), auto_refresh=False) as live:
+            try:
+                while not stop_event.wait(refresh):
+                    live.update(self.table(), refresh=True)
+            except KeyboardInterrupt:
+                pass
+
+
+def profiler_source(profiler):
+    """`Top` source reading a profiler in this process."""
+    return lambda: {"time": time.monotonic(), "rows": stats_rows(profiler.snapshot(include_loaded=False))}
+
+
+def main(argv=None):
+    """`mbench top`: live view of a process serving its stats with MBENCH_STATS_SOCKET."""
+    parser = ArgumentParser(prog="mbench top", description=main.__doc__)
+    parser.add_argument("target", help="PID of the profiled process, or the path of its stats socket")
+    parser.add_argument("--sort", choices=SORT_KEYS, default="total")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between refreshes")
+    parser.add_argument("--limit", type=int, default=30, help="number of functions to show")
+    args = parser.parse_args(argv)
+    path = socket_path(int(args.target)) if args.target.isdigit() else args.target
+    if not os.path.exists(path):
+        parser.error(f"no stats socket at {path}; start the process with MBENCH_STATS_SOCKET=1")
+    top = Top(lambda: read_stats(path), sort=args.sort, limit=args.limit, title=f"mbench top {args.target}")
+    try:
+        top.run(refresh=args.interval)
+    except OSError:
+        # The socket goes away when the process exits.
+        print(f"{args.target} stopped serving stats")
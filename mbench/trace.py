@@ -0,0 +1,190 @@
+# Copyright (c) 2024 mbodi ai
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+
+import json
+import mmap
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from mbench.histogram import record_latency
+
+MAGIC = b"MBTRACE1"
+# magic, record size, record count, string table offset, string table size
+HEADER = struct.Struct("<8sIxxxxQQQ")
+HEADER_SIZE = 64
+# slot, thread, flags, reserved, start ns, duration ns, cpu ns, self ns,
+# memory delta, net alloc, peak alloc, gpu delta, io delta
+RECORD = struct.Struct("<IIII9q")
+OUTERMOST = 1
+# Records a thread buffers before appending them to the file under the lock.
+BUFFER_RECORDS = 4096
+
+
+class TraceWriter:
+    """Append one fixed-size binary record per completed call to a memory-mapped file.
+
+    Each thread packs records into its own buffer and only takes the lock to copy a
+    full buffer into the map, which doubles in size whenever it runs out of room. The
+    record count in the header is updated on every flush, so a trace cut short by a
+    crash is still readable up to its last flush. Function and thread names go into a
+    JSON string table after the records when the writer is closed.
+    """
+
+    def __init__(self, path, initial_size=1 << 20):
+        self.path = str(path)
+        self.count = 0
+        self.threads = {}
+        # Start times come from perf_counter_ns; this pair maps them to wall-clock time.
+        self.epoch = (time.perf_counter_ns(), time.time_ns())
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buffers = []
+        self._file = open(self.path, "w+b")  # noqa: SIM115
+        self._file.truncate(max(initial_size, HEADER_SIZE + RECORD.size))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self._write_header(0, 0)
+
+    def _write_header(self, strings_offset, strings_size):
+        HEADER.pack_into(self._map, 0, MAGIC, RECORD.size, self.count, strings_offset, strings_size)
+
+    def _buffer(self):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = bytearray()
+            thread = threading.current_thread()
+            with self._lock:
+                self._local.thread = len(self.threads)
+                self.threads[self._local.thread] = thread.name
+                self._buffers.append(buffer)
+        return buffer
+
+    def write(self, slot, outermost, start, duration, cpu, self_time, memory, alloc, peak_alloc, gpu, io):
+        """Record one call. Times are integer nanoseconds, the rest bytes."""
+        buffer = self._buffer()
+        buffer += RECORD.pack(
+            slot,
+            self._local.thread,
+            OUTERMOST if outermost else 0,
+            0,
+            start,
+            duration,
+            cpu,
+            self_time,
+            int(memory),
+            int(alloc),
+            int(peak_alloc),
+            int(gpu),
+            int(io),
+        )
+        if len(buffer) >= BUFFER_RECORDS * RECORD.size:
+            self._flush(buffer)
+
+    def _flush(self, buffer):
+        with self._lock:
+            if self._map is None:
+                return
+            size = len(buffer)
+            offset = HEADER_SIZE + self.count * RECORD.size
+            if offset + size > len(self._map):
+                self._map.resize(max(2 * len(self._map), offset + size))
+            self._map[offset : offset + size] = buffer
+            self.count += size // RECORD.size
+            self._write_header(0, 0)
+            del buffer[:]
+
+    def close(self, names=()):
+        """Flush every thread's records and write the string table. `names` is indexed by slot."""
+        for buffer in list(self._buffers):
+            if buffer:
+                self._flush(buffer)
+        with self._lock:
+            if self._map is None:
+                return
+            strings = json.dumps({"functions": list(names), "threads": self.threads, "epoch": self.epoch}).encode()
+            offset = HEADER_SIZE + self.count * RECORD.size
+            self._map.resize(offset + len(strings))
+            self._map[offset:] = strings
+            self._write_header(offset, len(strings))
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+
+class TraceReader:
+    """Read a trace written by `TraceWriter` without loading it into memory.
+
+    Records are unpacked straight from the memory map in chunks, so the OS pages a
+    multi-gigabyte trace in and out as it is read.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = open(self.path, "rb")  # noqa: SIM115
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, record_size, self.count, strings_offset, strings_size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            self.close()
+            raise ValueError(f"{self.path} is not an mbench trace")
+        self.functions = []
+        self.threads = {}
+        self.epoch = (0, 0)
+        if strings_size:
+            strings = json.loads(bytes(self._map[strings_offset : strings_offset + strings_size]))
+            self.functions = strings["functions"]
+            self.threads = {int(index): name for index, name in strings["threads"].items()}
+            self.epoch = tuple(strings.get("epoch", self.epoch))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+    def __len__(self):
+        return self.count
+
+    def name(self, slot):
+        return self.functions[slot] if slot < len(self.functions) else f"<slot {slot}>"
+
+    def records(self, chunk=BUFFER_RECORDS * 16):
+        """Yield every record as a tuple in the field order of `RECORD`."""
+        view = memoryview(self._map)
+        try:
+            for first in range(0, self.count, chunk):
+                start = HEADER_SIZE + first * RECORD.size
+                end = HEADER_SIZE + min(self.count, first + chunk) * RECORD.size
+                yield from RECORD.iter_unpack(view[start:end])
+        finally:
+            view.release()
+
+    def aggregates(self, empty_profile):
+        """Rebuild the per-function aggregates `FunctionProfiler.load_data` returns."""
+        profiles = defaultdict(empty_profile)
+        slots = {}
+        for slot, _, flags, _, _, duration, cpu, self_time, memory, alloc, peak, gpu, io in self.records():
+            data = slots.get(slot)
+            if data is None:
+                data = slots[slot] = profiles[self.name(slot)]
+            data["calls"] += 1
+            data["total_self_time"] += self_time / 1e9
+            if flags & OUTERMOST:
+                data["total_time"] += duration / 1e9
+                data["total_cpu"] += cpu / 1e9
+                data["total_memory"] += memory
+                data["total_alloc"] += alloc
+                data["total_gpu"] += gpu
+                data["total_io"] += io
+            data["peak_alloc"] = max(data["peak_alloc"], peak)
+            record_latency(data, duration / 1e9, cpu / 1e9)
+        return profiles
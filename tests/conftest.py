@@ -0,0 +1,20 @@
+import pytest
+
+from mbench.profile import FunctionProfiler
+
+
+@pytest.fixture
+def profiler(request, tmp_path):
+    """The profiler writing to a temporary CSV and profiling the test module, reset afterwards."""
+    profiler = FunctionProfiler()
+    profiler.csv_file = str(tmp_path / "test.csv")
+    profiler.set_target_module(request.module.__name__, "called")
+    yield profiler
+    profiler.uninstall()
+    profiler.set_filters([], [])
+    profiler.profiles.clear()
+    profiler.loaded_profiles.clear()
+    profiler.stacks = {}
+    state = profiler._thread_state()
+    state.store.clear()
+    state.tree.clear()
@@ -0,0 +1,75 @@
+import pytest
+
+
+@pytest.fixture
+def profiler(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "adaptive", True)
+    return profiler
+
+
+def helper(x):
+    return x + 1
+
+
+def hot_loop(n):
+    total = 0
+    for _ in range(n):
+        total = helper(total)
+    return total
+
+
+def test_hot_function_is_throttled_but_counted(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "sample_max_rate", 0.0)
+    profiler.install("setprofile")
+    hot_loop(10_000)
+    profiler.uninstall()
+    store = profiler._thread_state().store
+    slot = profiler.registry.slots[id(helper.__code__)]
+    assert store.every[slot] > 1
+    assert store.measured[slot] < 10_000
+    data = profiler.snapshot(include_loaded=False)
+    assert data[f"{__name__}.helper"]["calls"] == 10_000
+    assert "extrapolated" in data[f"{__name__}.helper"]["notes"]
+    assert data[f"{__name__}.helper"]["total_time"] > 0
+    stacks = profiler.call_stacks(include_loaded=False)
+    assert sum(value["calls"] for path, value in stacks.items() if path[-1] == f"{__name__}.helper") == 10_000
+    # The caller ran once and was measured.
+    assert data[f"{__name__}.hot_loop"]["calls"] == 1
+    assert not data[f"{__name__}.hot_loop"]["notes"]
+
+
+def test_disabled_measures_every_call(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "adaptive", False)
+    monkeypatch.setattr(profiler, "sample_max_rate", 0.0)
+    profiler.install("setprofile")
+    hot_loop(2_000)
+    profiler.uninstall()
+    store = profiler._thread_state().store
+    slot = profiler.registry.slots[id(helper.__code__)]
+    assert store.measured[slot] == store.calls[slot] == 2_000
+    assert "extrapolated" not in profiler.snapshot(include_loaded=False)[f"{__name__}.helper"]["notes"]
+
+
+def test_unmeasured_calls_take_their_hooks_out_of_the_caller(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "sample_max_rate", 0.0)
+    profile = profiler.collector_profile
+    profiler.set_collectors("time")
+    state = profiler._thread_state()
+    slot = profiler.registry.register(helper.__code__, __name__)
+    totals = {False: [], True: []}
+    try:
+        # Alternate and keep the fastest run of each, so a busy machine does not decide the comparison.
+        for adaptive in (False, True) * 3:
+            monkeypatch.setattr(profiler, "adaptive", adaptive)
+            profiler.install("setprofile")
+            hot_loop(20_000)
+            profiler.uninstall()
+            totals[adaptive].append(profiler.snapshot(include_loaded=False)[f"{__name__}.hot_loop"]["total_time"])
+            skipped = state.store.calls[slot] - state.store.measured[slot]
+            state.store.clear()
+            state.tree.clear()
+    finally:
+        profiler.set_collectors(profile)
+    assert skipped > 10_000
+    # Uncorrected, the caller would also carry the hooks of every call that was only counted.
+    assert min(totals[True]) - min(totals[False]) < skipped * profiler.overhead.skip_ns / 1e9 / 2
@@ -0,0 +1,74 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+from mbench.aio import LOOP_LAG_KEY
+from mbench.profile import profiling
+
+
+@pytest.fixture
+def profiler(profiler, monkeypatch):
+    monkeypatch.setattr(sys.modules["mbench.profile"], "_profiler_instance", profiler)
+    profiler.enable_async(lag_interval=0.01)
+    yield profiler
+    profiler.uninstall()
+    profiler.async_tracker = None
+    for state in profiler.threads:
+        for key in [key for key in state.profiles if key.startswith(__name__) or key == LOOP_LAG_KEY]:
+            del state.profiles[key]
+
+
+async def waiter():
+    for _ in range(5):
+        await asyncio.sleep(0.01)
+    time.sleep(0.02)
+
+
+async def main():
+    await asyncio.gather(waiter(), waiter())
+
+
+@pytest.mark.parametrize("backend", ["setprofile", "auto"])
+def test_coroutine_counted_once_with_awaited_split(profiler, backend):
+    profiler.install(backend)
+    asyncio.run(main())
+    profiler.uninstall()
+    data = profiler.snapshot()[f"{__name__}.waiter"]
+    assert data["calls"] == 2
+    assert data["total_cpu"] >= 0.04
+    assert data["total_awaited"] >= 0.08
+    assert data["total_time"] == pytest.approx(data["total_cpu"] + data["total_awaited"])
+    assert profiler.snapshot()[f"{__name__}.main"]["calls"] == 1
+    assert profiler.snapshot()[LOOP_LAG_KEY]["calls"] > 0
+
+
+async def block():
+    with profiling("aio_block", quiet=True, async_mode=True):
+        await asyncio.sleep(0.05)
+
+
+def test_profiling_block_reports_awaited(profiler):
+    profiler.install("setprofile")
+    asyncio.run(block())
+    profiler.uninstall()
+    data = profiler.profiles.pop("aio_block")
+    assert data["total_awaited"] >= 0.04
+
+
+async def napper():
+    await asyncio.sleep(0.05)
+    return sum(range(200_000))
+
+
+def test_wrapped_coroutine_splits_running_and_awaited(profiler):
+    timed = profiler.wrap(napper)
+    assert asyncio.run(timed()) == sum(range(200_000))
+    data = profiler.snapshot(include_loaded=False)[f"{__name__}.napper"]
+    assert data["calls"] == 1
+    assert data["total_awaited"] >= 0.04
+    assert 0 < data["total_self_time"] < data["total_time"] - 0.04
+    assert data["total_cpu"] > 0
+    assert data["total_time"] == pytest.approx(data["total_self_time"] + data["total_awaited"])
+    assert data["time_histogram"].count == 1
@@ -0,0 +1,64 @@
+import pytest
+
+from mbench.bench import BENCHMARKS, BenchResult, bench, calibrate, run_all, run_benchmark
+
+
+def noop():
+    return None
+
+
+def test_result_statistics():
+    result = BenchResult("f", loops=10, values=[1.0, 2.0, 3.0], cpu_values=[1.0, 1.0, 1.0])
+    assert result.mean == 2.0
+    assert result.stdev == 1.0
+    assert result.min == 1.0
+    low, high = result.confidence_interval()
+    assert low == pytest.approx(2.0 - 4.303 / 3**0.5)
+    assert high == pytest.approx(2.0 + 4.303 / 3**0.5)
+    data = result.to_profile()
+    assert data["calls"] == 30
+    assert data["total_time"] == pytest.approx(60.0)
+    assert data["time_histogram"].count == 3
+    assert "95% CI" in data["notes"]
+
+
+def test_calibrate_reaches_min_time():
+    loops = calibrate(noop, min_time=0.001)
+    assert loops > 1
+    assert loops & (loops - 1) == 0
+
+
+def test_run_benchmark_in_process():
+    result = run_benchmark(noop, warmup=1, repeat=4, loops=100)
+    assert result.name == f"{__name__}.noop"
+    assert len(result.values) == 4
+    assert result.loops == 100
+
+
+def test_repeat_must_be_positive():
+    with pytest.raises(ValueError, match="repeat"):
+        run_benchmark(noop, repeat=0, loops=1)
+    with pytest.raises(ValueError, match="repeat"):
+        bench(repeat=0)
+
+
+def test_run_benchmark_in_processes():
+    result = run_benchmark(noop, warmup=0, repeat=2, loops=10, processes=2)
+    assert len(result.values) == 4
+    assert "in 2 processes" in result.summary()
+
+
+def test_decorator_registers_and_reports(tmp_path):
+    @bench(repeat=2, loops=5, name="square")
+    def square():
+        return 3 * 3
+
+    assert square() == 9
+    assert square in BENCHMARKS
+    try:
+        [result] = run_all([square], csv_file=tmp_path / "bench.csv", warmup=0)
+    finally:
+        BENCHMARKS.remove(square)
+    assert result.name == "square"
+    assert len(result.values) == 2
+    assert (tmp_path / "bench.csv").read_text().splitlines()[1].startswith("square,10,")
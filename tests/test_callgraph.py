@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from mbench.callgraph import CallTree, call_graph, export_stacks, to_collapsed, to_speedscope
+from mbench.profile import FunctionProfiler
+
+NAMES = ["mod.main", "mod.load", "mod.parse"]
+
+
+def test_tree_keeps_one_node_per_stack():
+    tree = CallTree()
+    main = tree.child(0, 0)
+    load = tree.child(main, 1)
+    assert tree.child(main, 1) == load
+    parse_in_load = tree.child(load, 2)
+    parse_in_main = tree.child(main, 2)
+    tree.record(parse_in_load, 1_000_000, 1_000_000)
+    tree.record(parse_in_main, 3_000_000, 3_000_000)
+    tree.record(load, 4_000_000, 3_000_000)
+    tree.record(main, 10_000_000, 3_000_000)
+    stacks = tree.stacks(NAMES.__getitem__)
+    assert stacks[("mod.main", "mod.load", "mod.parse")]["total_time"] == pytest.approx(0.001)
+    assert stacks[("mod.main", "mod.parse")]["total_time"] == pytest.approx(0.003)
+    edges = call_graph(stacks)
+    assert edges[("mod.load", "mod.parse")]["calls"] == 1
+    assert edges[("mod.main", "mod.load")]["total_self_time"] == pytest.approx(0.003)
+    assert edges[(None, "mod.main")]["total_time"] == pytest.approx(0.01)
+    tree.clear()
+    assert tree.stacks(NAMES.__getitem__) == {}
+    assert tree.child(main, 1) == load
+
+
+def test_exports():
+    stacks = {
+        ("mod.main",): {"calls": 1, "total_time": 0.01, "total_self_time": 0.003},
+        ("mod.main", "mod.parse"): {"calls": 2, "total_time": 0.007, "total_self_time": 0.007},
+    }
+    assert to_collapsed(stacks) == "mod.main 3000\nmod.main;mod.parse 7000\n"
+    document = to_speedscope(stacks)
+    assert [frame["name"] for frame in document["shared"]["frames"]] == ["mod.main", "mod.parse"]
+    [profile] = document["profiles"]
+    assert profile["samples"] == [[0], [0, 1]]
+    assert profile["endValue"] == pytest.approx(0.01)
+
+
+def outer():
+    inner()
+    inner()
+
+
+def inner():
+    return sum(range(20_000))
+
+
+def test_profiler_records_call_stacks(tmp_path):
+    profiler = FunctionProfiler()
+    profiler.csv_file = str(tmp_path / "test.csv")
+    profiler.set_target_module(__name__, "called")
+    profiler.install("setprofile")
+    try:
+        outer()
+    finally:
+        profiler.uninstall()
+    state = profiler._thread_state()
+    try:
+        stacks = profiler.call_stacks(include_loaded=False)
+        path = next(path for path in stacks if path[-2:] == (f"{__name__}.outer", f"{__name__}.inner"))
+        assert stacks[path]["calls"] == 2
+        assert stacks[path[:-1]]["calls"] == 1
+        assert stacks[path]["total_time"] > 0
+        assert stacks[path[:-1]]["total_time"] >= stacks[path]["total_time"]
+        document = json.loads(export_stacks(tmp_path / "run.json", stacks).read_text())
+        assert document["profiles"][0]["type"] == "sampled"
+        assert f"{__name__}.inner" in export_stacks(tmp_path / "run.folded", stacks).read_text()
+    finally:
+        state.store.clear()
+        state.tree.clear()
@@ -0,0 +1,122 @@
+import tracemalloc
+from collections import deque
+
+import pytest
+
+from mbench.collectors import Collector, GpuCollector
+from mbench.sampler import FakeNVML, ResourceSampler, nvml_module, poll_resources
+
+queue = deque()
+
+
+class QueueDepth(Collector):
+    name = "queue"
+    field = "queue_depth"
+    cost = 50
+
+    def stop(self, token):
+        return len(queue)
+
+
+@pytest.fixture
+def profiler(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "adaptive", False)
+    yield profiler
+    profiler.collectors.pop(QueueDepth.name, None)
+    profiler.set_collectors("full", 16)
+
+
+def work():
+    queue.append(None)
+    return [0] * 1000
+
+
+def test_fake_nvml_feeds_sampler_and_gpu_collector():
+    nvml = nvml_module("fake:2")
+    assert isinstance(nvml, FakeNVML)
+    assert nvml_module("0") is None
+    nvml.nvmlInit()
+    handles = [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(nvml.nvmlDeviceGetCount())]
+    nvml.used[1] = 1000
+    assert poll_resources(handles, nvml).gpus == [0, 1000]
+    sampler = ResourceSampler(interval=60, gpu_handles=handles, nvml=nvml)
+    gpu = GpuCollector(sampler)
+    token = gpu.start()
+    nvml.used[0] = 300
+    sampler._buffer[sampler._head % sampler.size] = poll_resources(handles, nvml)
+    sampler._head += 1
+    assert gpu.stop(token) == (300, [300, 0])
+    nvml.nvmlShutdown()
+    with pytest.raises(FakeNVML.NVMLError):
+        nvml.nvmlDeviceGetMemoryInfo(0)
+
+
+def test_custom_collector_is_summed(profiler):
+    profiler.add_collector(QueueDepth())
+    assert "queue" in profiler.collector_names
+    queue.clear()
+    timed = profiler.wrap(work)
+    for _ in range(3):
+        timed()
+    data = profiler.snapshot(include_loaded=False)[f"{__name__}.work"]
+    assert data["calls"] == 3
+    assert data["queue_depth"] == 1 + 2 + 3
+
+
+def test_time_profile_measures_wall_time_only(profiler):
+    profiler.set_collectors("time")
+    assert not profiler.memory.enabled
+    timed = profiler.wrap(work)
+    timed()
+    data = profiler.snapshot(include_loaded=False)[f"{__name__}.work"]
+    assert data["total_time"] > 0
+    assert data["total_cpu"] == 0
+    assert data["total_alloc"] == 0
+
+
+@pytest.mark.parametrize("profile", ["fast", "full"])
+def test_profiles_leave_tracemalloc_off(profiler, profile):
+    profiler.set_collectors(profile)
+    assert "alloc" not in profiler.collector_names
+    assert not profiler.memory.enabled
+    assert not tracemalloc.is_tracing()
+
+
+def test_tracemalloc_environment_variable_adds_alloc(profiler):
+    profiler.trace_allocations = True
+    try:
+        profiler.set_collectors("fast")
+        assert "alloc" in profiler.collector_names
+        assert tracemalloc.is_tracing()
+    finally:
+        profiler.trace_allocations = False
+        profiler.set_collectors("full")
+    assert not tracemalloc.is_tracing()
+
+
+def test_fast_profile_differs_from_full(profiler):
+    profiler.set_collectors("fast")
+    assert profiler._sampled_fields == {"total_gpu"}
+    profiler.set_collectors("full")
+    assert profiler._sampled_fields == frozenset()
+    assert profiler.collector_names == ["cpu", "rss", "io", "gpu"]
+
+
+def test_fast_profile_samples_expensive_collectors(profiler):
+    profiler.set_collectors("fast,alloc", 4)
+    assert profiler.memory.enabled
+    timed = profiler.wrap(work)
+    for _ in range(40):
+        timed()
+    store = profiler._thread_state().store
+    slot = profiler.registry.slots[id(work.__code__)]
+    assert store.measured[slot] == 40
+    assert store.collected[slot] == 10
+    data = profiler.snapshot(include_loaded=False)[f"{__name__}.work"]
+    assert data["total_cpu"] > 0
+    assert "total_alloc, total_gpu extrapolated from 10 of 40 calls" in data["notes"]
+
+
+def test_unknown_collector(profiler):
+    with pytest.raises(ValueError, match="nope"):
+        profiler.set_collectors("cpu,nope")
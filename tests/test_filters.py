@@ -0,0 +1,83 @@
+import pytest
+
+from mbench.filters import CodeFilter
+from mbench.monitoring import MONITORING_AVAILABLE
+
+BACKENDS = [
+    "setprofile",
+    pytest.param("monitoring", marks=pytest.mark.skipif(not MONITORING_AVAILABLE, reason="needs sys.monitoring")),
+]
+
+
+class Record:
+    def __repr__(self):
+        return "Record()"
+
+    def save(self):
+        return repr(self)
+
+
+def helper():
+    return Record().save()
+
+
+def test_rules():
+    code_filter = CodeFilter(["myapp.db.*", "file:*/jobs/*", "re:myapp\\.(api|web)\\."], ["*.__repr__", "qualname:_*"])
+    assert code_filter.matches("myapp.db.query", "run", "/src/myapp/db/query.py")
+    assert not code_filter.matches("myapp.db.models", "Row.__repr__", "/src/myapp/db/models.py")
+    assert not code_filter.matches("myapp.db.query", "_cursor", "/src/myapp/db/query.py")
+    assert code_filter.matches("tasks", "send", "/src/jobs/tasks.py")
+    assert code_filter.matches("myapp.web.views", "index", "/src/myapp/web/views.py")
+    assert not code_filter.matches("myapp.cli", "main", "/src/myapp/cli.py")
+    assert CodeFilter().matches("anything", "at_all", "x.py")
+
+
+def test_decision_is_cached_per_code():
+    code_filter = CodeFilter(["*.helper"])
+    assert code_filter(helper.__code__, __name__)
+    assert not code_filter(Record.save.__code__, __name__)
+    assert code_filter._cache[id(helper.__code__)] == (helper.__code__, True)
+    code_filter._include = {}
+    code_filter._exclude = CodeFilter(["*"])._include
+    assert code_filter(helper.__code__, __name__)
+
+
+def test_mbench_is_never_profiled(profiler):
+    profiler.set_filters(include=["*"])
+    assert not profiler.filter.matches("mbench", "profiling", "mbench/__init__.py")
+    assert not profiler.filter.matches("mbench.collectors", "CpuCollector.stop", "mbench/collectors.py")
+    assert profiler.filter.matches("mbenchmarks", "run", "mbenchmarks.py")
+
+
+def test_profiler_applies_exclude_rules(profiler):
+    profiler.set_filters(exclude=["*.__repr__"])
+    profiler.install("setprofile")
+    helper()
+    profiler.uninstall()
+    data = profiler.snapshot(include_loaded=False)
+    assert data[f"{__name__}.helper"]["calls"] == 1
+    assert data[f"{__name__}.save"]["calls"] == 1
+    assert f"{__name__}.__repr__" not in data
+
+
+def test_include_rules_replace_target_module(profiler):
+    profiler.set_filters(include=["qualname:Record.*"])
+    profiler.install("setprofile")
+    helper()
+    profiler.uninstall()
+    data = profiler.snapshot(include_loaded=False)
+    assert f"{__name__}.helper" not in data
+    assert data[f"{__name__}.save"]["calls"] == 1
+    assert data[f"{__name__}.__repr__"]["calls"] == 1
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_changed_rules_apply_to_functions_seen_before(profiler, backend):
+    profiler.set_filters(exclude=["*.helper"])
+    profiler.install(backend)
+    helper()
+    profiler.set_filters(exclude=[])
+    for _ in range(3):
+        helper()
+    profiler.uninstall()
+    assert profiler.snapshot(include_loaded=False)[f"{__name__}.helper"]["calls"] == 3
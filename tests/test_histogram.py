@@ -0,0 +1,73 @@
+import pytest
+
+from mbench.histogram import Histogram, merge_histograms
+
+
+def test_percentiles_keep_the_tail():
+    histogram = Histogram()
+    for _ in range(10_000):
+        histogram.record(0.001)
+    for _ in range(20):
+        histogram.record(0.5)
+    p50, p95, p99, p999 = histogram.percentiles()
+    assert p50 == pytest.approx(0.001, rel=0.02)
+    assert p99 == pytest.approx(0.001, rel=0.02)
+    assert p999 == pytest.approx(0.5, rel=0.02)
+
+
+def test_small_values_are_exact():
+    histogram = Histogram()
+    histogram.record(40e-9)
+    assert histogram.percentile(50) == pytest.approx(40e-9)
+
+
+def test_merge_is_lossless():
+    first, second, both = Histogram(), Histogram(), Histogram()
+    for i in range(1, 500):
+        first.record(i * 1e-4)
+        both.record(i * 1e-4)
+        second.record(i * 1e-2)
+        both.record(i * 1e-2)
+    merged = merge_histograms(None, first)
+    merged = merge_histograms(merged, second)
+    assert merged is not first
+    assert merged.counts == both.counts
+    assert merged.percentiles() == both.percentiles()
+    assert first.count == 499
+
+
+def test_text_round_trip():
+    histogram = Histogram()
+    for value in (1e-6, 1e-3, 1.0, 1e6):
+        histogram.record(value)
+    restored = Histogram.from_text(histogram.to_text())
+    assert restored.counts == histogram.counts
+    assert restored.count == 4
+
+
+def test_cumulative_buckets():
+    histogram = Histogram()
+    for value in (2e-6, 2e-3, 2e-3, 2.0):
+        histogram.record(value)
+    assert histogram.cumulative([1e-5, 1e-2, 1.0]) == [1, 3, 3]
+    assert histogram.total() == pytest.approx(2.004002, rel=0.02)
+
+
+def test_relative_error_shrinks_with_samples():
+    histogram = Histogram()
+    assert histogram.relative_error() == float("inf")
+    for i in range(100):
+        histogram.record(0.001 if i % 2 else 0.002)
+    error = histogram.relative_error()
+    for i in range(10_000):
+        histogram.record(0.001 if i % 2 else 0.002)
+    assert 0 < histogram.relative_error() < error / 5
+
+
+def test_only_hit_buckets_are_stored():
+    histogram = Histogram()
+    assert not histogram.counts
+    for _ in range(1000):
+        histogram.record(0.001)
+    histogram.record(2.0)
+    assert len(histogram.counts) == 2
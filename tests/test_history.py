@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from mbench.histogram import Histogram
+from mbench.history import RunHistory
+from mbench.profile import profiling
+from mbench.statistical import StatisticalProfiler
+
+
+def profile(calls, total_time):
+    histogram = Histogram()
+    for _ in range(calls):
+        histogram.record(total_time / calls)
+    return {"calls": calls, "total_time": total_time, "notes": "", "time_histogram": histogram}
+
+
+def test_runs_are_kept_separately(tmp_path):
+    with RunHistory(tmp_path / "history.db") as history:
+        first = history.record_run({"mod.f": profile(10, 1.0), "mod.unused": {"calls": 0}}, command="one")
+        second = history.record_run({"mod.f": profile(10, 3.0), "mod.g": profile(1, 0.5)}, command="two")
+        assert second > first
+        runs = history.runs()
+        assert [run["command"] for run in runs] == ["two", "one"]
+        assert [run["functions"] for run in runs] == [2, 1]
+        assert runs[0]["python"] and runs[0]["host"]
+
+        assert set(history.load_run(first)) == {"mod.f"}
+        latest = history.load_run()
+        assert set(latest) == {"mod.f", "mod.g"}
+        assert latest["mod.f"]["total_time"] == 3.0
+        assert latest["mod.f"]["time_histogram"].count == 10
+        assert latest["mod.g"]["cpu_histogram"] is None
+
+        assert [row[0] for row in history.function_history("mod.f")] == [second, first]
+        assert history.average_duration("mod.f") == pytest.approx(0.2)
+        assert history.average_duration("mod.f", last=1) == pytest.approx(0.3)
+        assert history.average_duration("mod.missing") is None
+
+
+def test_block_only_run_is_recorded(profiler, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "history_file", str(tmp_path / "history.db"))
+    with profiling("history_block", quiet=True):
+        pass
+    profiler.save_and_print_data()
+    with RunHistory(profiler.history_file) as history:
+        assert history.load_run()["history_block"]["calls"] == 1
+
+
+def sampled(sampler):
+    end = time.thread_time() + 0.01
+    while time.thread_time() < end:
+        pass
+    sampler.sample()
+
+
+def test_sample_mode_run_is_recorded(profiler, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "history_file", str(tmp_path / "history.db"))
+    sampler = StatisticalProfiler(profiler, hz=100)
+    sampler.start()
+    sampler.stop()
+    sampled(sampler)
+    profiler.save_and_print_data()
+    with RunHistory(profiler.history_file) as history:
+        assert history.load_run()[f"{__name__}.sampled"]["calls"] >= 1
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+
+# Cumulative `-X importtime` microseconds `import mbench` may take with profiling off.
+IMPORT_BUDGET_US = 100_000
+# Loaded only once something is profiled or reported.
+HEAVY = ("rich", "psutil", "pynvml", "asyncio", "funkify", "pandas", "multiprocessing", "concurrent", "sqlite3", "http")
+# Cheaper, but together they used to double the import time.
+DEFERRED = ("argparse", "json", "random", "re", "statistics", "typing")
+
+SCRIPT = """
+import json, sys
+import mbench
+mbench.profileme()
+with mbench.profiling("block"):
+    pass
+print(json.dumps(sorted({name.split(".")[0] for name in sys.modules})))
+"""
+
+IMPORT_ONLY = """
+import sys
+import mbench
+print("\\n".join({name.split(".")[0] for name in sys.modules}))
+"""
+
+
+def _run(*args):
+    env = {**os.environ, "MBENCH": "0"}
+    return subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True, check=True)
+
+
+def test_disabled_path_loads_no_heavy_modules():
+    loaded = set(json.loads(_run("-c", SCRIPT).stdout))
+    assert loaded.isdisjoint(HEAVY), sorted(loaded & set(HEAVY))
+
+
+def test_import_loads_no_deferred_stdlib_modules():
+    loaded = set(_run("-c", IMPORT_ONLY).stdout.split())
+    assert loaded.isdisjoint(DEFERRED), sorted(loaded & set(DEFERRED))
+
+
+def test_import_time_budget():
+    times = []
+    for _ in range(3):
+        lines = _run("-X", "importtime", "-c", "import mbench").stderr.splitlines()
+        # "import time: self [us] | cumulative | imported package"
+        cumulative = [int(line.split("|")[1]) for line in lines if line.split("|")[-1].strip() == "mbench"]
+        times.append(cumulative[0])
+    assert min(times) < IMPORT_BUDGET_US
@@ -0,0 +1,116 @@
+import sys
+import warnings
+
+import pytest
+
+from mbench.lines import LineProfiler, line_table
+from mbench.monitoring import MONITORING_AVAILABLE
+from mbench.profile import FunctionProfiler, profile
+
+BACKENDS = [
+    "settrace",
+    pytest.param("monitoring", marks=pytest.mark.skipif(not MONITORING_AVAILABLE, reason="needs sys.monitoring")),
+]
+
+
+def loop(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+def fails():
+    value = 1
+    raise ValueError(value)
+
+
+def countdown(n):
+    if n:
+        return countdown(n - 1)
+    return n
+
+
+def untouched():
+    return 1
+
+
+@pytest.fixture(params=BACKENDS)
+def lines(request):
+    profiler = LineProfiler(request.param)
+    yield profiler
+    profiler.stop()
+
+
+def test_counts_hits_per_line(lines):
+    traced = lines.wrap(loop)
+    assert traced(10) == 45
+    untouched()
+    results = lines.results()
+    assert list(results) == [loop.__code__]
+    first = loop.__code__.co_firstlineno
+    hits = {line - first: hits for line, (hits, _) in results[loop.__code__].items()}
+    assert hits[1] == 1
+    assert hits[3] == 10
+    assert hits[4] == 1
+    assert all(seconds >= 0 for _, seconds in results[loop.__code__].values())
+
+
+def test_exception_ends_frame(lines):
+    traced = lines.wrap(fails)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            traced()
+    assert lines._state().stack == []
+    first = fails.__code__.co_firstlineno
+    assert lines.results()[fails.__code__][first + 1][0] == 2
+
+
+def test_other_tracer_warns_and_counts_untraced_calls():
+    lines = LineProfiler("settrace")
+    traced = lines.wrap(loop)
+    previous = sys.gettrace()
+    sys.settrace(lambda frame, event, arg: None)
+    try:
+        with pytest.warns(RuntimeWarning, match="another trace function"):
+            traced(3)
+        traced(3)
+    finally:
+        sys.settrace(previous)
+    assert lines.results() == {}
+    assert lines.untraced == {id(loop.__code__): 2}
+
+
+def test_recursive_calls_are_traced():
+    global countdown
+    lines = LineProfiler("settrace")
+    original = countdown
+    countdown = lines.wrap(original)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            assert countdown(4) == 0
+    finally:
+        countdown = original
+    assert lines.untraced == {}
+    first = original.__code__.co_firstlineno
+    assert lines.results()[original.__code__][first + 1][0] == 5
+
+
+def test_profile_lines_decorator(tmp_path):
+    profiler = FunctionProfiler()
+    profiler.csv_file = str(tmp_path / "test.csv")
+
+    @profile(lines=True)
+    def decorated(n):
+        return loop(n) + 1
+
+    assert decorated(5) == 11
+    name = f"{__name__}.decorated"
+    assert profiler.snapshot(include_loaded=False)[name]["calls"] == 1
+    stats = profiler.line_stats()[name]
+    assert sum(hits for hits, _ in stats.values()) == 1
+    table = line_table(name, decorated.__wrapped__.__code__, stats)
+    assert table.row_count >= 2
+    profiler.reset()
+    assert name not in profiler.line_stats()
@@ -0,0 +1,55 @@
+import tracemalloc
+
+import pytest
+
+from mbench.memory import MemoryCollector, process_rss
+
+
+@pytest.fixture
+def collector():
+    collector = MemoryCollector(sites_min_bytes=0)
+    yield collector
+    collector.stop_tracing()
+
+
+def test_process_rss():
+    assert process_rss() > 0
+
+
+def test_net_and_peak(collector):
+    token = collector.start()
+    transient = bytearray(4 * 1024 * 1024)
+    del transient
+    kept = bytearray(1024 * 1024)
+    net, peak = collector.stop(token)
+    assert 1024 * 1024 <= net < 2 * 1024 * 1024
+    assert peak >= 4 * 1024 * 1024
+    assert kept
+
+
+def test_nested_peak_propagates(collector):
+    outer = collector.start()
+    inner = collector.start()
+    transient = bytearray(4 * 1024 * 1024)
+    del transient
+    collector.stop(inner)
+    _, outer_peak = collector.stop(outer)
+    assert outer_peak >= 4 * 1024 * 1024
+
+
+def test_disabled_collector():
+    collector = MemoryCollector(enabled=False)
+    assert collector.stop(collector.start()) == (0, 0)
+
+
+def allocate():
+    return [bytearray(1024) for _ in range(1024)]
+
+
+def test_top_sites(collector):
+    kept = allocate()
+    sites = collector.top_sites(allocate.__code__)
+    assert sites
+    assert sites[0][0].startswith(__file__)
+    assert kept
+    assert tracemalloc.is_tracing()
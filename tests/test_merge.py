@@ -0,0 +1,60 @@
+import pytest
+
+from mbench.histogram import Histogram
+from mbench.merge import main, merge_files, read_profiles
+from mbench.profile import empty_profile, read_csv, write_csv
+
+
+def host_profile(calls, seconds, peak):
+    histogram = Histogram()
+    for _ in range(calls):
+        histogram.record(seconds)
+    return {
+        **empty_profile(),
+        "calls": calls,
+        "total_time": calls * seconds,
+        "total_self_time": calls * seconds,
+        "total_cpu": calls * seconds / 2,
+        "peak_alloc": peak,
+        "time_histogram": histogram,
+    }
+
+
+@pytest.fixture
+def hosts(tmp_path):
+    for host, (calls, seconds) in enumerate([(1, 1.0), (99, 0.01), (10, 0.1)]):
+        directory = tmp_path / f"host{host}"
+        directory.mkdir()
+        write_csv(directory / "mbench_profile.csv", {"app.handle": host_profile(calls, seconds, peak=host * 100)})
+    return tmp_path
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_merge_sums_totals_and_histograms(hosts, workers):
+    profiles, files = merge_files([hosts], workers=workers, batch=1)
+    assert files == 3
+    data = profiles["app.handle"]
+    assert data["calls"] == 110
+    assert data["total_time"] == pytest.approx(1.0 + 0.99 + 1.0)
+    assert data["total_cpu"] == pytest.approx((1.0 + 0.99 + 1.0) / 2)
+    assert data["peak_alloc"] == 200
+    assert data["time_histogram"].count == 110
+    assert data["time_histogram"].percentile(50) == pytest.approx(0.01, rel=0.02)
+
+
+def test_merge_command_recomputes_averages(hosts, tmp_path):
+    output = tmp_path / "merged.csv"
+    main([str(hosts / "host*" / "*.csv"), "-o", str(output), "--workers", "1"])
+    merged = read_profiles(output)["app.handle"]
+    assert merged["calls"] == 110
+    # The mean of the three hosts' averages would be (1.0 + 0.01 + 0.1) / 3.
+    with open(output) as f:
+        assert f"{2.99 / 110:.6f}" in f.read()
+    assert read_csv(output)["app.handle"]["time_histogram"].count == 110
+
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / "profile.txt"
+    path.write_text("")
+    with pytest.raises(ValueError, match="no reader"):
+        merge_files([path], workers=1)
@@ -0,0 +1,76 @@
+import urllib.request
+
+from mbench.histogram import Histogram
+from mbench.metrics import CONTENT_TYPE, MetricsServer, MetricsSnapshot, render, write_textfile
+from mbench.profile import profiling
+
+
+def profiles():
+    histogram = Histogram()
+    for value in (2e-6, 2e-3, 2e-3):
+        histogram.record(value)
+    return {
+        'mod."odd"': {"calls": 3, "total_time": 0.004, "total_self_time": 0.003, "total_cpu": 0.002,
+                      "total_memory": -4096, "total_io": 10, "time_histogram": histogram},
+        "mod.unused": {"calls": 0},
+    }
+
+
+class FakeProfiler:
+    def __init__(self):
+        self.snapshots = 0
+
+    def snapshot(self, include_loaded=True):
+        self.snapshots += 1
+        return profiles()
+
+
+def test_render_openmetrics():
+    text = render(profiles())
+    lines = text.splitlines()
+    assert lines[-1] == "# EOF"
+    assert 'mbench_calls_total{function="mod.\\"odd\\""} 3' in lines
+    assert 'mbench_time_seconds_total{function="mod.\\"odd\\""} 0.004' in lines
+    assert 'mbench_memory_bytes{function="mod.\\"odd\\""} -4096' in lines
+    assert 'mbench_duration_seconds_bucket{function="mod.\\"odd\\"",le="1e-05"} 1' in lines
+    assert 'mbench_duration_seconds_bucket{function="mod.\\"odd\\"",le="+Inf"} 3' in lines
+    assert "mod.unused" not in text
+    assert "mbench_cpu_duration_seconds_count" not in text
+
+
+def test_server_serves_cached_snapshot():
+    profiler = FakeProfiler()
+    server = MetricsServer(profiler, port=0, interval=60)
+    try:
+        for _ in range(2):
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+                assert response.headers["Content-Type"] == CONTENT_TYPE
+                body = response.read().decode()
+    finally:
+        server.close()
+    assert "mbench_calls_total" in body
+    assert profiler.snapshots == 1
+
+
+def test_textfile(tmp_path):
+    path = write_textfile(tmp_path / "mbench.prom", profiles())
+    assert path.read_text().endswith("# EOF\n")
+    assert [p.name for p in tmp_path.iterdir()] == ["mbench.prom"]
+
+
+def test_profiling_blocks_are_exported(profiler):
+    profiler.loaded_profiles["mod.earlier_run"] = {**profiler._empty_profile(), "calls": 1}
+    with profiling("metrics_block", quiet=True):
+        pass
+    text = MetricsSnapshot(profiler).get().decode()
+    assert 'mbench_calls_total{function="metrics_block"} 1' in text
+    assert "earlier_run" not in text
+
+
+def test_counters_never_go_down():
+    floors = {}
+    render({"mod.f": {"calls": 10, "total_time": 2.0}}, floors=floors)
+    lines = render({"mod.f": {"calls": 12, "total_time": 1.5, "total_memory": -1}}, floors=floors).splitlines()
+    assert 'mbench_calls_total{function="mod.f"} 12' in lines
+    assert 'mbench_time_seconds_total{function="mod.f"} 2.0' in lines
+    assert 'mbench_memory_bytes{function="mod.f"} -1' in lines
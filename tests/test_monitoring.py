@@ -0,0 +1,32 @@
+import sys
+
+import pytest
+
+from mbench.monitoring import MONITORING_AVAILABLE
+
+
+def target():
+    return 1
+
+
+def test_setprofile_backend(profiler):
+    assert profiler.install("setprofile") == "setprofile"
+    assert sys.getprofile() == profiler.profile
+    profiler.uninstall()
+    assert sys.getprofile() is None
+
+
+def test_auto_backend(profiler):
+    expected = "monitoring" if MONITORING_AVAILABLE else "setprofile"
+    assert profiler.install() == expected
+
+
+@pytest.mark.skipif(not MONITORING_AVAILABLE, reason="sys.monitoring requires Python 3.12+")
+def test_monitoring_backend_profiles_target(profiler):
+    key = f"{__name__}.target"
+    profiler.install("monitoring")
+    target()
+    target()
+    profiler.uninstall()
+    assert profiler.snapshot()[key]["calls"] == 2
+    profiler._thread_state().store.clear()
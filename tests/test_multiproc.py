@@ -0,0 +1,43 @@
+import sys
+import textwrap
+
+from mbench.multiproc import run_command
+
+SCRIPT = textwrap.dedent(
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from mbench import profiling
+
+
+    def square(x):
+        with profiling("square_block", quiet=True):
+            return x * x
+
+
+    def run(method):
+        with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context(method)) as pool:
+            return list(pool.map(square, range(8)))
+
+
+    if __name__ == "__main__":
+        square(3)
+        run("spawn")
+        run("fork")
+    """
+)
+
+
+def test_run_command_collects_children(tmp_path):
+    (tmp_path / "job.py").write_text(SCRIPT)
+    returncode, collector = run_command(f"{sys.executable} job.py", tmp_path)
+    assert returncode == 0
+    # The command itself plus at least one worker per pool.
+    assert len(collector.results) >= 3
+    merged = collector.merged(dict)
+    squares = sum(data["calls"] for key, data in merged.items() if key.endswith(".square"))
+    assert squares == 17
+    assert merged["square_block"]["calls"] == 17
+    assert "pids:" in merged["__main__.square"]["notes"]
+    assert not (tmp_path / "mbench_profile.csv").exists()
@@ -0,0 +1,70 @@
+import pytest
+
+from mbench.overhead import Overhead
+from mbench.profile import empty_profile
+from mbench.trace import TraceReader
+
+
+def leaf():
+    pass
+
+
+def parent():
+    for _ in range(200):
+        leaf()
+
+
+def test_calibration_measures_the_hook(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "_calibrated", {})
+    profiler.install("setprofile")
+    overhead = profiler.overhead
+    # A Python-level hook costs microseconds per call; a millisecond would mean calibration measured something else.
+    assert 0 < overhead.call_ns < 1_000_000
+    assert 0 < overhead.call_cpu_ns < 1_000_000
+    assert 0 <= overhead.inner_ns <= overhead.call_ns
+    assert 0 <= overhead.skip_ns <= overhead.call_ns
+    # Calibration leaves no trace of its own calls behind.
+    assert not any(name.startswith("mbench.overhead") for name in profiler.snapshot(include_loaded=False))
+
+
+def test_calibration_stays_out_of_trace_timeline_and_reports(profiler, monkeypatch, tmp_path):
+    printed = []
+    monkeypatch.setattr(profiler, "_calibrated", {})
+    monkeypatch.setattr(profiler, "report_mode", "call")
+    monkeypatch.setattr(profiler, "_print_call", lambda name, *args: printed.append(name))
+    profiler.start_trace(tmp_path / "run.bin")
+    profiler.start_timeline(tmp_path / "run.json")
+    try:
+        profiler.install("setprofile")
+        leaf()
+        profiler.uninstall()
+    finally:
+        profiler.stop_trace()
+        profiler.stop_timeline()
+    assert printed == [f"{__name__}.leaf"]
+    with TraceReader(tmp_path / "run.bin") as reader:
+        assert list(reader.aggregates(empty_profile)) == [f"{__name__}.leaf"]
+    assert "mbench.overhead" not in (tmp_path / "run.json").read_text()
+
+
+def test_overhead_subtracted_from_inclusive_time(profiler, monkeypatch):
+    profiler.install("setprofile")
+    # A known cost per call instead of the calibrated one keeps the arithmetic exact.
+    monkeypatch.setattr(profiler, "overhead", Overhead(call_ns=10**9, call_cpu_ns=10**9, inner_ns=0, inner_cpu_ns=0))
+    parent()
+    profiler.uninstall()
+    data = profiler.snapshot(include_loaded=False)
+    # Each leaf only loses its inner part; the parent loses the full round trip of its 200 children,
+    # but never drops below the time they took.
+    assert data[f"{__name__}.leaf"]["total_time"] > 0
+    assert data[f"{__name__}.parent"]["total_time"] == pytest.approx(data[f"{__name__}.leaf"]["total_time"])
+    assert data[f"{__name__}.parent"]["total_self_time"] == 0
+    assert data[f"{__name__}.parent"]["total_cpu"] == 0
+
+
+def test_calibration_can_be_disabled(profiler, monkeypatch):
+    monkeypatch.setattr(profiler, "calibrate", False)
+    monkeypatch.setattr(profiler, "overhead", Overhead())
+    monkeypatch.setattr(profiler, "_calibrated", {})
+    profiler.install("setprofile")
+    assert profiler.overhead == Overhead()
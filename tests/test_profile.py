@@ -1,15 +1,15 @@
-import pytest
-from unittest.mock import patch, MagicMock
-from mbench.profile import FunctionProfiler, profileme, profile, profiling, display_profile_info, _get_memory_usage, _get_io_usage
 import os
+import sys
 import time
+from unittest.mock import MagicMock, patch
+
+import pytest
 from rich.console import Console
 
+from mbench.profile import display_profile_info, profile, profileme, profiling
+
 console = Console()
 
-@pytest.fixture
-def profiler():
-    return FunctionProfiler()
 
 def test_load_data(profiler, tmp_path):
     csv_file = tmp_path / "test.csv"
@@ -17,7 +17,8 @@ def test_load_data(profiler, tmp_path):
                         'test_func,1,1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0,1.0,\n')
     profiler.csv_file = str(csv_file)
     profiler.load_data()
-    assert profiler.profiles['test_func']['calls'] == 1
+    assert profiler.loaded_profiles['test_func']['calls'] == 1
+    assert 'test_func' not in profiler.snapshot(include_loaded=False)
 
 def test_save_and_print_data(profiler, tmp_path):
     csv_file = tmp_path / "test.csv"
@@ -35,19 +36,8 @@ def test_save_and_print_data(profiler, tmp_path):
     content = csv_file.read_text()
     assert 'test_func,1,1.000000,1.000000,1.000000,1.000000,1.000000,1.000000,1.000000,1.000000,1.000000,1.000000,' in content
 
-def test_get_gpu_usage(profiler):
-    total, usages = profiler._get_gpu_usage()
-    assert isinstance(total, int)
-    assert isinstance(usages, list)
-    assert len(usages) == profiler.num_gpus
-    assert all(isinstance(usage, int) for usage in usages)
-
-def test_get_io_usage():
-    io_usage = _get_io_usage()
-    assert isinstance(io_usage, int)
-
 def test_start_profile(profiler):
-    with patch('time.time', return_value=1.0), \
+    with patch('time.perf_counter_ns', return_value=1000), \
          patch('psutil.virtual_memory', return_value=MagicMock(used=1024)), \
          patch('pynvml.nvmlDeviceGetMemoryInfo', return_value=MagicMock(used=1024)):
         mock_frame = MagicMock()
@@ -55,7 +45,11 @@ def test_start_profile(profiler):
         mock_frame.f_code.co_name = 'test_func'
         profiler.set_target_module('test_module', 'all')
         profiler._start_profile(mock_frame)
-        assert profiler.current_calls['test_func']['start_time'] == 1.0
+        slot, frame, start_time, *_ = profiler._thread_state().stack.pop()
+        profiler._thread_state().store.active[slot] -= 1
+        assert profiler.registry.name(slot) == 'test_module.test_func'
+        assert frame is mock_frame
+        assert start_time == 1000
 
 
 
@@ -74,25 +68,82 @@ def test_profileme():
         profileme()
         assert mock_profiler.called
 
-def test_profile():
-    with patch('mbench.profile.FunctionProfiler') as mock_profiler, \
-         patch.dict(os.environ, {'MBENCH': '1'}), \
-         patch('mbench.profile._profiler_instance', mock_profiler.return_value):
-        mock_instance = mock_profiler.return_value
-        mock_instance._get_gpu_usage.return_value = 0
-        mock_instance.format_bytes.return_value = "0 B"
-        
-        @profile
-        def test_func():
-            pass
-        
-        test_func()
-        
-        mock_instance._start_profile.assert_called()
-        mock_instance._end_profile.assert_called()
-        assert mock_profiler.called
+def test_profile(profiler):
+    @profile
+    def decorated():
+        return worker()
+
+    hook = sys.getprofile()
+    decorated()
+    decorated()
+    # No hook is installed or removed around the call.
+    assert sys.getprofile() is hook
+    slot = profiler.registry.slots[id(decorated.__wrapped__.__code__)]
+    store = profiler._thread_state().store
+    assert store.calls[slot] == 2
+    assert store.total_time[slot] >= 0.02 * 1e9
+    store.reset_slot(slot)
+
+
+def test_profile_disabled_returns_function():
+    def plain():
+        pass
+
+    with patch.dict(os.environ, {'MBENCH': '0'}):
+        assert profile(plain) is plain
 
 
+def test_profile_not_counted_twice_by_hook(profiler):
+    @profile
+    def decorated():
+        return 1
+
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        decorated()
+    finally:
+        profiler.uninstall()
+    slot = profiler.registry.slots[id(decorated.__wrapped__.__code__)]
+    store = profiler._thread_state().store
+    assert store.calls[slot] == 1
+    store.reset_slot(slot)
+
+
+def test_profiling_nested_and_threaded(profiler):
+    import threading
+
+    def block():
+        with profiling("outer_block", quiet=True):
+            with profiling("inner_block", quiet=True):
+                time.sleep(0.01)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=block) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    outer = profiler.profiles.pop("outer_block")
+    inner = profiler.profiles.pop("inner_block")
+    assert outer["calls"] == inner["calls"] == 4
+    assert outer["total_time"] >= 0.08
+    assert inner["total_time"] >= 0.04
+    assert outer["total_time"] > inner["total_time"]
+
+
+def test_profiling_prints_only_in_call_mode(profiler, monkeypatch):
+    with patch("mbench.profile.display_profile_info") as mock_display:
+        with profiling("quiet_block"):
+            pass
+        mock_display.assert_not_called()
+        monkeypatch.setattr(profiler, "report_mode", "call")
+        with profiling("loud_block"):
+            pass
+        with profiling("silenced_block", quiet=True):
+            pass
+    assert [call.kwargs["name"] for call in mock_display.call_args_list] == ["loud_block"]
+    assert profiler.profiles["quiet_block"]["calls"] == 1
 
 
 def test_display_profile_info():
@@ -146,3 +197,147 @@ def test_display_profile_info():
             calls=1
         )
         mock_print.assert_called()
+
+
+def test_end_profile_only_updates_counters(profiler):
+    mock_frame = MagicMock()
+    mock_frame.f_globals = {'__name__': 'test_module'}
+    mock_frame.f_code.co_name = 'deferred_func'
+    profiler.set_target_module('test_module', 'called')
+    with patch('mbench.profile.display_profile_info') as mock_display:
+        profiler._start_profile(mock_frame)
+        profiler._end_profile(mock_frame)
+        mock_display.assert_not_called()
+        assert profiler.snapshot()['test_module.deferred_func']['calls'] == 1
+
+        profiler.set_reporting("call")
+        try:
+            profiler._start_profile(mock_frame)
+            profiler._end_profile(mock_frame)
+        finally:
+            profiler.set_reporting("exit")
+        mock_display.assert_called_once()
+    profiler._thread_state().store.clear()
+
+
+def test_print_summary(profiler):
+    profiler.profiles['summary_func'] = profiler._empty_profile()
+    profiler.profiles['summary_func'].update(calls=2, total_time=1.0)
+    with patch('mbench.profile.display_profile_info') as mock_display:
+        profiler.print_summary()
+    assert any(call.kwargs['name'] == 'summary_func' for call in mock_display.call_args_list)
+    del profiler.profiles['summary_func']
+
+
+def recurse(n):
+    if n:
+        recurse(n - 1)
+    time.sleep(0.01)
+
+
+def test_recursion_inclusive_and_self_time(profiler):
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        recurse(2)
+    finally:
+        profiler.uninstall()
+    data = profiler.snapshot(include_loaded=False)[f'{__name__}.recurse']
+    profiler._thread_state().store.clear()
+    assert data['calls'] == 3
+    # The outer call covers all three sleeps; inner calls must not be added again.
+    assert 0.03 <= data['total_time'] < 0.06
+    assert data['total_self_time'] == pytest.approx(data['total_time'], rel=0.2)
+
+
+def worker():
+    time.sleep(0.01)
+
+
+def test_threads_profiled_separately(profiler):
+    import threading
+
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        profiler.uninstall()
+    snapshot = profiler.snapshot()
+    assert snapshot[f'{__name__}.worker']['calls'] == 4
+    assert snapshot[f'{__name__}.worker']['total_time'] >= 0.04
+    for state in profiler.threads:
+        state.store.clear()
+
+
+def test_store_slots_by_code_object(profiler):
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        for _ in range(3):
+            worker()
+    finally:
+        profiler.uninstall()
+    slot = profiler.registry.slots[id(worker.__code__)]
+    store = profiler._thread_state().store
+    assert store.calls[slot] == 3
+    assert store.active[slot] == 0
+    assert profiler.snapshot(include_loaded=False)[f'{__name__}.worker']['calls'] == 3
+    store.clear()
+
+
+def test_percentiles_saved_and_loaded(profiler, tmp_path):
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        for _ in range(5):
+            worker()
+    finally:
+        profiler.uninstall()
+    profiler.csv_file = str(tmp_path / "test.csv")
+    with patch('mbench.profile.display_profile_info') as mock_display:
+        profiler.save_and_print_data()
+    shown = next(call.kwargs for call in mock_display.call_args_list if call.kwargs['name'] == f'{__name__}.worker')
+    assert shown['time_histogram'].count == 5
+    profiler.reset()
+    loaded = profiler.load_data()[f'{__name__}.worker']
+    assert loaded['time_histogram'].count == 5
+    assert loaded['time_histogram'].percentile(50) == pytest.approx(0.01, rel=0.5)
+    profiler.reset()
+
+
+def test_trace_rebuilds_aggregates(profiler, tmp_path):
+    profiler.set_target_module(__name__, 'called')
+    profiler.start_trace(tmp_path / "trace.bin")
+    profiler.install('setprofile')
+    try:
+        recurse(2)
+    finally:
+        profiler.uninstall()
+        profiler.stop_trace()
+    live = profiler.snapshot(include_loaded=False)[f'{__name__}.recurse']
+    profiler._thread_state().store.clear()
+    traced = profiler.load_trace(tmp_path / "trace.bin")[f'{__name__}.recurse']
+    assert traced['calls'] == live['calls'] == 3
+    assert traced['total_time'] == pytest.approx(live['total_time'], rel=1e-6)
+    assert traced['total_self_time'] == pytest.approx(live['total_self_time'], rel=1e-6)
+
+
+def test_save_records_run_history(profiler, tmp_path):
+    from mbench.history import RunHistory
+
+    profiler.set_target_module(__name__, 'called')
+    profiler.install('setprofile')
+    try:
+        worker()
+    finally:
+        profiler.uninstall()
+    profiler.csv_file = str(tmp_path / "profile.csv")
+    profiler.save_and_print_data()
+    profiler.reset()
+    with RunHistory(tmp_path / "profile.db") as history:
+        assert history.load_run()[f'{__name__}.worker']['calls'] == 1
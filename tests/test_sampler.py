@@ -0,0 +1,28 @@
+import time
+from unittest.mock import patch
+
+from mbench.sampler import ResourceSampler, Sample, poll_resources
+
+
+def test_poll_resources():
+    sample = poll_resources()
+    assert isinstance(sample.memory, int)
+    assert isinstance(sample.io, int)
+    assert sample.gpu == 0
+    assert sample.gpus == []
+
+
+def test_latest_reads_cached_sample():
+    sampler = ResourceSampler(interval=0.001, size=8)
+    sampler.start()
+    try:
+        time.sleep(0.05)
+        with patch("mbench.sampler.process_rss", side_effect=AssertionError("hot path must not poll")):
+            sample = sampler.latest()
+        assert isinstance(sample, Sample)
+        assert sampler._head > 1
+        assert len(sampler.samples()) == 8
+    finally:
+        sampler.stop()
+    assert not sampler.is_alive()
+
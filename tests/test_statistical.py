@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from mbench.statistical import StatisticalProfiler, pthread_getcpuclockid
+
+
+def spin(seconds):
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+def busy(sampler):
+    spin(0.01)
+    sampler.sample()
+
+
+def outer(sampler):
+    busy(sampler)
+
+
+def test_sample_attributes_stack(profiler):
+    sampler = StatisticalProfiler(profiler, hz=100)
+    sampler.start()
+    sampler.stop()
+    outer(sampler)
+    assert profiler.profiles[f"{__name__}.busy"]["calls"] == 1
+    assert profiler.profiles[f"{__name__}.outer"]["calls"] == 1
+    elapsed = profiler.profiles[f"{__name__}.outer"]["total_time"]
+    assert elapsed >= 0.01 or pthread_getcpuclockid is None
+    assert "sampled" in profiler.profiles[f"{__name__}.busy"]["notes"]
+    path = (f"{__name__}.test_sample_attributes_stack", f"{__name__}.outer", f"{__name__}.busy")
+    assert profiler.stacks[path]["total_self_time"] == pytest.approx(elapsed)
+    assert profiler.stacks[path[:2]]["total_self_time"] == 0
+
+
+def test_filter_changes_reach_cached_keys(profiler):
+    sampler = profiler.stack_sampler = StatisticalProfiler(profiler, hz=100)
+    try:
+        sampler.start()
+        sampler.stop()
+        outer(sampler)
+        profiler.set_filters(exclude=[f"{__name__}.busy"])
+        assert not sampler._keys
+        outer(sampler)
+    finally:
+        profiler.stack_sampler = None
+    assert profiler.profiles[f"{__name__}.outer"]["calls"] == 2
+    assert profiler.profiles[f"{__name__}.busy"]["calls"] == 1
+
+
+def idle(ready, event):
+    ready.set()
+    event.wait()
+
+
+@pytest.mark.skipif(pthread_getcpuclockid is None, reason="needs per-thread CPU clocks")
+def test_idle_threads_are_not_charged(profiler):
+    ready, event = threading.Event(), threading.Event()
+    thread = threading.Thread(target=idle, args=(ready, event))
+    thread.start()
+    try:
+        ready.wait()
+        time.sleep(0.05)
+        sampler = StatisticalProfiler(profiler, hz=100)
+        sampler.start()
+        sampler.stop()
+        for _ in range(3):
+            outer(sampler)
+    finally:
+        event.set()
+        thread.join()
+    assert profiler.profiles[f"{__name__}.busy"]["calls"] == 3
+    assert f"{__name__}.idle" not in profiler.profiles
+
+
+def test_timer_samples_running_code(profiler):
+    sampler = StatisticalProfiler(profiler, hz=1000)
+    sampler.start()
+    try:
+        spin(0.2)
+    finally:
+        sampler.stop()
+    assert sampler.samples > 0
+    assert profiler.profiles[f"{__name__}.spin"]["calls"] > 0
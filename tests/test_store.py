@@ -0,0 +1,37 @@
+from mbench.store import CodeRegistry, StatsStore
+
+
+def first():
+    pass
+
+
+def second():
+    pass
+
+
+def test_registry_assigns_slots_once():
+    registry = CodeRegistry()
+    assert registry.register(first.__code__, __name__) == 0
+    assert registry.register(second.__code__, __name__) == 1
+    assert registry.register(first.__code__, __name__) == 0
+    assert registry.name(1) == f"{__name__}.second"
+
+
+def test_store_grows_and_clears():
+    registry = CodeRegistry()
+    store = StatsStore(num_gpus=2, capacity=2)
+    for code in (first.__code__, second.__code__, (lambda: None).__code__):
+        registry.register(code, __name__)
+    store.grow(3)
+    assert store.capacity == 4
+    assert len(store.total_gpus[1]) == 4
+    store.calls[2] += 1
+    store.total_time[2] += 500_000_000
+    store.active[2] += 1
+    [(name, data)] = store.items(registry, dict)
+    assert name == f"{__name__}.<lambda>"
+    assert data["calls"] == 1 and data["total_time"] == 0.5
+    assert data["total_gpus"] == [0.0, 0.0]
+    store.clear()
+    assert list(store.items(registry, dict)) == []
+    assert store.active[2] == 1
@@ -0,0 +1,77 @@
+import gc
+import json
+
+import pytest
+
+from mbench.profile import FunctionProfiler
+from mbench.sampler import Sample
+from mbench.timeline import TimelineWriter, from_trace, merge_timelines, part_path
+from mbench.trace import TraceWriter
+
+
+def test_writer_streams_spans_counters_and_gc(tmp_path):
+    path = tmp_path / "run.json"
+    writer = TimelineWriter(path, pid=1)
+    start = writer.origin + 5_000
+    for i in range(3000):
+        writer.span("mod.work", start + i * 1000, 500)
+    writer.counters(Sample(writer.wall_origin / 1e9 + 0.001, 1024, 10, 7, [3, 4]))
+    # gc.collect() returns at once while another thread is collecting, so call the hook directly.
+    assert writer._on_gc in gc.callbacks
+    writer._on_gc("start", {"generation": 2, "collected": 0, "uncollectable": 0})
+    writer._on_gc("stop", {"generation": 2, "collected": 0, "uncollectable": 0})
+    writer.close()
+    assert writer._on_gc not in gc.callbacks
+    events = json.loads(path.read_text())
+    spans = [event for event in events if event["ph"] == "X" and event["cat"] == "call"]
+    assert len(spans) == 3000
+    assert spans[0]["ts"] == 5.0 and spans[0]["dur"] == 0.5
+    counters = {event["name"]: event for event in events if event["ph"] == "C"}
+    assert counters["memory"]["args"] == {"rss": 1024}
+    assert counters["gpu memory"]["args"] == {"gpu0": 3, "gpu1": 4}
+    assert counters["memory"]["ts"] == pytest.approx(1000.0, abs=1.0)
+    assert any(event["cat"] == "gc" for event in events if event["ph"] == "X")
+    assert {event["name"] for event in events if event["ph"] == "M"} == {"process_name", "thread_name"}
+
+
+def test_merge_parts(tmp_path):
+    parts = []
+    for pid in (10, 20):
+        parts.append(part_path(tmp_path / "run.json", pid))
+        writer = TimelineWriter(parts[-1], pid=pid, gc_events=False)
+        writer.span("mod.work", writer.origin, 1000)
+        writer.close()
+    assert parts[0].name == "run.10.json"
+    merge_timelines(tmp_path / "run.json", parts)
+    events = json.loads((tmp_path / "run.json").read_text())
+    assert {event["pid"] for event in events if event["ph"] == "X"} == {10, 20}
+    assert not parts[0].exists()
+
+
+def test_from_trace(tmp_path):
+    trace = TraceWriter(tmp_path / "run.bin")
+    trace.write(0, True, trace.epoch[0] + 2_000, 1_000, 800, 1_000, 0, 0, 0, 0, 0)
+    trace.close(["mod.work"])
+    from_trace(tmp_path / "run.bin", tmp_path / "run.json")
+    [span] = [event for event in json.loads((tmp_path / "run.json").read_text()) if event["ph"] == "X"]
+    assert span["name"] == "mod.work" and span["ts"] == 2.0 and span["tid"] == 0
+
+
+def work():
+    return sum(range(1000))
+
+
+def test_profiler_streams_calls(tmp_path):
+    profiler = FunctionProfiler()
+    profiler.csv_file = str(tmp_path / "test.csv")
+    profiler.set_target_module(__name__, "called")
+    profiler.start_timeline(tmp_path / "run.json")
+    profiler.install("setprofile")
+    try:
+        work()
+    finally:
+        profiler.uninstall()
+        profiler.stop_timeline()
+        profiler._thread_state().store.clear()
+    events = json.loads((tmp_path / "run.json").read_text())
+    assert any(event["name"] == f"{__name__}.work" for event in events if event["ph"] == "X")
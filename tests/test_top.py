@@ -0,0 +1,78 @@
+import io
+import socket
+
+import pytest
+from rich.console import Console
+
+from mbench.histogram import Histogram
+from mbench.profile import profiling
+from mbench.top import StatsServer, Top, profiler_source, read_stats, stats_rows
+
+
+class FakeProfiler:
+    def __init__(self):
+        self.calls = 0
+        self.snapshots = 0
+
+    def snapshot(self, include_loaded=True):
+        self.snapshots += 1
+        histogram = Histogram()
+        histogram.record(0.002)
+        return {
+            "mod.work": {"calls": self.calls, "total_time": 0.5, "total_self_time": 0.25, "total_cpu": 0.4,
+                         "time_histogram": histogram},
+            "mod.idle": {"calls": 0, "total_time": 0, "total_cpu": 0},
+        }
+
+
+def test_stats_rows_skip_functions_without_calls():
+    profiler = FakeProfiler()
+    profiler.calls = 3
+    [row] = stats_rows(profiler.snapshot())
+    assert row["name"] == "mod.work"
+    assert row["p99"] == pytest.approx(0.002, rel=0.02)
+
+
+def test_profiler_source_shows_blocks(profiler):
+    profiler.loaded_profiles["mod.earlier_run"] = {**profiler._empty_profile(), "calls": 1}
+    with profiling("top_block", quiet=True):
+        pass
+    names = [row["name"] for row in profiler_source(profiler)()["rows"]]
+    assert "top_block" in names
+    assert "mod.earlier_run" not in names
+
+
+def test_top_computes_rates_between_snapshots():
+    snapshots = iter([
+        {"time": 1.0, "rows": [{"name": "a", "calls": 10, "total_time": 1.0, "self_time": 1.0, "cpu": 1.0, "p99": 0.1}]},
+        {"time": 1.0, "rows": [{"name": "a", "calls": 10, "total_time": 1.0, "self_time": 1.0, "cpu": 1.0, "p99": 0.1}]},
+        {"time": 3.0, "rows": [{"name": "a", "calls": 30, "total_time": 2.0, "self_time": 1.5, "cpu": 2.0, "p99": 0.1},
+                               {"name": "b", "calls": 4, "total_time": 3.0, "self_time": 3.0, "cpu": 3.0, "p99": 0.2}]},
+    ])
+    top = Top(lambda: next(snapshots), sort="rate")
+    top.table()
+    top.table()
+    table = top.table()
+    assert top._rates == {"a": 10.0, "b": 2.0}
+    console = Console(file=io.StringIO(), width=200)
+    console.print(table)
+    output = console.file.getvalue()
+    assert output.index(" a ") < output.index(" b ")
+    with pytest.raises(ValueError):
+        Top(lambda: None, sort="bogus")
+
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+def test_server_reuses_snapshots(tmp_path):
+    profiler = FakeProfiler()
+    profiler.calls = 5
+    server = StatsServer(profiler, str(tmp_path / "stats.sock"), interval=60)
+    try:
+        first = read_stats(server.path)
+        second = read_stats(server.path)
+    finally:
+        server.close()
+    assert first == second
+    assert first["rows"][0]["calls"] == 5
+    assert profiler.snapshots == 1
+    assert not (tmp_path / "stats.sock").exists()
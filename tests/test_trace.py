@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from mbench.profile import FunctionProfiler, trace_path
+from mbench.trace import TraceReader, TraceWriter
+
+
+def empty_profile():
+    return {
+        "calls": 0,
+        "total_time": 0,
+        "total_self_time": 0,
+        "total_cpu": 0,
+        "total_memory": 0,
+        "total_alloc": 0,
+        "peak_alloc": 0,
+        "total_gpu": 0,
+        "total_io": 0,
+    }
+
+
+def test_round_trip_grows_the_map(tmp_path):
+    path = tmp_path / "trace.bin"
+    writer = TraceWriter(path, initial_size=128)
+    for i in range(10_000):
+        writer.write(i % 2, True, 1_000_000_000, 2_000_000, 1_000_000, 2_000_000, 10, 5, 7, 0, 1)
+    writer.write(0, False, 1_000_000_000, 1_000_000, 1_000_000, 1_000_000, 10, 5, 99, 0, 1)
+    writer.close(["mod.even", "mod.odd"])
+    with TraceReader(path) as reader:
+        assert len(reader) == 10_001
+        assert reader.threads == {0: "MainThread"}
+        profiles = reader.aggregates(empty_profile)
+    even = profiles["mod.even"]
+    assert even["calls"] == 5001
+    assert even["total_time"] == pytest.approx(5000 * 0.002)
+    assert even["total_self_time"] == pytest.approx(5000 * 0.002 + 0.001)
+    assert even["total_memory"] == 50_000
+    assert even["peak_alloc"] == 99
+    assert even["time_histogram"].count == 5001
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"\0" * 128)
+    with pytest.raises(ValueError):
+        TraceReader(path)
+
+
+def helper(x):
+    return x + 1
+
+
+def test_profiler_traces_every_call_of_hot_functions(tmp_path, monkeypatch):
+    profiler = FunctionProfiler()
+    profiler.csv_file = str(tmp_path / "test.csv")
+    monkeypatch.setattr(profiler, "adaptive", True)
+    monkeypatch.setattr(profiler, "sample_max_rate", 0.0)
+    profiler.set_target_module(__name__, "called")
+    profiler.start_trace(tmp_path / "run.bin")
+    profiler.install("setprofile")
+    try:
+        for i in range(5_000):
+            helper(i)
+    finally:
+        profiler.uninstall()
+        profiler.stop_trace()
+        state = profiler._thread_state()
+        state.store.clear()
+        state.tree.clear()
+    with TraceReader(tmp_path / "run.bin") as reader:
+        assert reader.aggregates(empty_profile)[f"{__name__}.helper"]["calls"] == 5_000
+
+
+def test_each_process_gets_its_own_trace_file(monkeypatch):
+    monkeypatch.delenv("MBENCH_COLLECT", raising=False)
+    monkeypatch.delenv("MBENCH_TRACE_PID", raising=False)
+    assert trace_path("run.bin") == "run.bin"
+    assert trace_path("run.bin") == "run.bin"
+    part = f"run.{os.getpid()}.bin"
+    monkeypatch.setenv("MBENCH_TRACE_PID", "1")
+    assert trace_path("run.bin") == part
+    monkeypatch.setenv("MBENCH_TRACE_PID", str(os.getpid()))
+    monkeypatch.setenv("MBENCH_COLLECT", "socket")
+    assert trace_path("run.bin") == part